@@ -0,0 +1,53 @@
+"""Measure how long it takes to import each web3ref module
+
+Usage::
+
+    python bench_import.py [-n RUNS] [module ...]
+
+Every import runs in a fresh interpreter, so nothing is cached between
+runs; the time of an empty interpreter ('python -c pass') is subtracted,
+and the median of 'RUNS' runs is reported in milliseconds.
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+MODULES = [
+    'web3ref.util', 'web3ref.handlers', 'web3ref.validate',
+    'web3ref.cache', 'web3ref.conditional', 'web3ref.static', 'web3ref.forms',
+    'web3ref.workers', 'web3ref.streaming', 'web3ref.simple_server',
+    'web3ref.gateways', 'web3ref.fastcgi',
+]
+
+def run_once(code):
+    start = time.time()
+    subprocess.check_call([sys.executable, '-c', code])
+    return time.time() - start
+
+def median(times):
+    times = sorted(times)
+    middle = len(times) // 2
+    if len(times) % 2:
+        return times[middle]
+    return (times[middle - 1] + times[middle]) / 2
+
+def bench(code, runs):
+    return median([run_once(code) for i in range(runs)])
+
+def main(argv):
+    runs = 20
+    if argv[:1] == ['-n']:
+        runs = int(argv[1])
+        argv = argv[2:]
+    modules = argv or MODULES
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    baseline = bench('pass', runs)
+    print('%-24s %8.1f ms' % ('(interpreter)', baseline * 1000))
+    for name in modules:
+        elapsed = bench('import ' + name, runs) - baseline
+        print('%-24s %8.1f ms' % (name, elapsed * 1000))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,68 @@
+"""Replay captured traffic against an application or a server
+
+Usage::
+
+    python bench_replay.py [-s SPEED] [-t THREADS] CAPTURE TARGET
+
+CAPTURE is a file written by 'web3ref.capture.Recorder'.  TARGET is either
+'module:callable', an application run in this process through
+'handlers.SimpleHandler', or an 'http://host:port' URL of a running server,
+reached through a 'proxy.Proxy'.  Requests are sent as fast as possible
+from THREADS threads (default 1), or at SPEED times the recorded pace.
+Reports the request rate, latency percentiles in milliseconds and the
+count of each status.
+"""
+
+import sys
+import time
+
+from web3ref.capture import read_records
+from web3ref.capture import replay
+
+def load_target(target):
+    if target.startswith('http://'):
+        from web3ref.proxy import Proxy
+        return Proxy(target)
+    module, sep, name = target.partition(':')
+    if not sep:
+        raise SystemExit('target must be module:callable or http://host:port')
+    __import__(module)
+    return getattr(sys.modules[module], name)
+
+def percentile(times, fraction):
+    return times[min(len(times) - 1, int(len(times) * fraction))]
+
+def main(argv):
+    speed = None
+    threads = 1
+    while argv[:1] in (['-s'], ['-t']):
+        if argv[0] == '-s':
+            speed = float(argv[1])
+        else:
+            threads = int(argv[1])
+        argv = argv[2:]
+    if len(argv) != 2:
+        raise SystemExit(__doc__)
+    records = list(read_records(argv[0]))
+    app = load_target(argv[1])
+    start = time.time()
+    results = replay(records, app, speed, threads)
+    elapsed = time.time() - start
+    if not results:
+        print('no requests in %s' % argv[0])
+        return
+    times = sorted([duration for status, bytes_sent, duration in results])
+    statuses = {}
+    for status, bytes_sent, duration in results:
+        status = (status or b'---')[:3].decode('ascii')
+        statuses[status] = statuses.get(status, 0) + 1
+    print('%d requests in %.3f s: %.1f requests/s'
+          % (len(results), elapsed, len(results) / elapsed))
+    for label, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+        print('%-6s %8.3f ms' % (label, percentile(times, fraction) * 1000))
+    print('%-6s %8.3f ms' % ('max', times[-1] * 1000))
+    for status in sorted(statuses):
+        print('%-6s %8d' % (status, statuses[status]))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -13,6 +13,5 @@ setup(
     long_description = open('README.txt').read(),
     test_suite  = 'web3ref.tests',
     packages    = ['web3ref'],
-    use_2to3 = True,
     )
 
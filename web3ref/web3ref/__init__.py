@@ -8,6 +8,40 @@ Current Contents:
 
 * simple_server -- a simple BaseHTTPServer that supports WSGI
 
+* workers -- thread pool and pre-fork concurrency for the servers
+
+* streaming -- a sender thread delivering responses to slow clients
+
+* accesslog -- access logging from a background writer thread
+
+* errorlog -- rate-limited, deduplicated error logging
+
+* memtrack -- per-route allocation statistics from tracemalloc
+
+* sse -- Server-Sent Events with broadcast fan-out
+
+* gateways -- SCGI and uwsgi protocol servers
+
+* fastcgi -- a FastCGI responder server for Web3 applications
+
+* conditional -- middleware answering conditional GETs with 304
+
+* cache -- in-process response cache middleware
+
+* static -- application serving static files, with range support
+
+* forms -- streaming parser for urlencoded and multipart form bodies
+
+* ratelimit -- rate limiting middleware shared by worker processes
+
+* capture -- traffic capture and replay for benchmarking
+
+* testing -- in-process client for testing applications without sockets
+
+* proxy -- reverse proxy application with pooled upstream connections
+
+* websocket -- WebSocket connections over the server's upgrade extension
+
 * validate -- validation wrapper that sits between an app and a server
   to detect errors in either
 
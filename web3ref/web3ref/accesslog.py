@@ -0,0 +1,186 @@
+"""Access logging off the request path
+
+Writing a log line from the thread that served the request means formatting
+it and waiting for the stream, for every request.  An AccessLog instead
+copies a few fixed fields into a preallocated ring buffer, and a background
+thread formats them and writes them out in batches::
+
+    log = AccessLog(stream=open('access.log', 'a'), size=8192)
+    log.record(start, '10.0.0.1', 'GET / HTTP/1.1', b'200', 1234, 0.004)
+
+The writer is woken by the first record queued, and writes it straight
+away if 'interval' seconds have passed since it last wrote; otherwise it
+collects records until then, or until the buffer is half full.  So busy
+servers write in batches, while no record waits more than 'interval' for
+the writer, however quiet the server goes after it.  When the buffer is
+full, new records are dropped rather than making requests wait; the
+writer reports how many with the next batch, and the 'dropped' attribute
+keeps the total.  'flush()' writes out everything pending at once; the
+server calls it on shutdown.
+
+Lines are produced with 'format % fields', where the fields are:
+
+    remote_addr     client address
+    time            start of the request, as '10/Oct/2000:13:55:36 +0000'
+    timestamp       start of the request, in seconds since the epoch
+    request_line    e.g. 'GET / HTTP/1.1'
+    status          three-digit status code
+    bytes_sent      size of the response body
+    duration        time taken to serve the request, in seconds
+    duration_ms     the same, in milliseconds
+
+'simple_server.make_server(..., access_log=True)' logs to stderr in
+COMMON_FORMAT.
+"""
+
+import os
+import sys
+import threading
+import time
+
+__all__ = ['AccessLog', 'COMMON_FORMAT', 'TIMED_FORMAT']
+
+COMMON_FORMAT = ('%(remote_addr)s - - [%(time)s] "%(request_line)s" '
+                 '%(status)s %(bytes_sent)s\n')
+TIMED_FORMAT = COMMON_FORMAT[:-1] + ' %(duration_ms).3f\n'
+
+_months = [None, 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+           'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+if bytes is str:
+    def _text(value):
+        return value
+else:
+    def _text(value):
+        if isinstance(value, bytes):
+            return value.decode('latin-1')
+        return value
+
+class AccessLog:
+    """Ring buffer of access log records, written by a background thread
+
+    The thread is started on first use, and again in a forked child.
+    """
+
+    _FIELDS = 6     # start, remote_addr, request_line, status, bytes, duration
+
+    def __init__(self, stream=None, format=COMMON_FORMAT, size=4096,
+                 interval=1.0):
+        self.stream = stream
+        self.format = format
+        self.size = size
+        self.interval = interval
+        self.slots = [[None] * self._FIELDS for i in range(size)]
+        self.head = 0           # next slot to fill
+        self.count = 0          # filled slots, ending just before 'head'
+        self.dropped = 0
+        self.reported = 0       # drops already mentioned in the log
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.next_write = 0
+        self.pid = None
+        self.clock = (None, None)
+
+    def record(self, start, remote_addr, request_line, status, bytes_sent,
+               duration):
+        """Queue one request for logging; never blocks on the stream"""
+        if self.pid != os.getpid():
+            self.start()
+        with self.lock:
+            if self.count == self.size:
+                self.dropped += 1
+                return
+            slot = self.slots[self.head]
+            slot[0] = start
+            slot[1] = remote_addr
+            slot[2] = request_line
+            slot[3] = status
+            slot[4] = bytes_sent
+            slot[5] = duration
+            self.head = (self.head + 1) % self.size
+            self.count += 1
+            if self.count == 1 or self.count == self.size // 2:
+                self.wakeup.set()
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            # Records inherited over fork() are the parent's to write
+            self.count = 0
+            self.wakeup = threading.Event()
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.pid = os.getpid()
+
+    def run(self):
+        """Main loop of the writer thread"""
+        while 1:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            delay = self.next_write - time.time()
+            if delay > 0 and self.count < self.size // 2:
+                self.wakeup.wait(delay)     # or until half full
+                self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                pass            # nowhere to report it; try again later
+
+    def take(self):
+        """Remove and return the pending records, oldest first"""
+        with self.lock:
+            count, self.count = self.count, 0
+            start = self.head - count
+            if start >= 0:
+                slots = self.slots[start:self.head]
+            else:
+                slots = self.slots[start:] + self.slots[:self.head]
+            records = [tuple(slot) for slot in slots]
+            for slot in slots:
+                slot[1] = slot[2] = None    # don't keep the strings alive
+            dropped = self.dropped
+        return records, dropped
+
+    def flush(self):
+        """Write out all pending records"""
+        with self.write_lock:
+            self.next_write = time.time() + self.interval
+            records, dropped = self.take()
+            lines = [self.format_record(record) for record in records]
+            if dropped != self.reported:
+                lines.append('access log: %d records dropped\n'
+                             % (dropped - self.reported))
+                self.reported = dropped
+            if not lines:
+                return
+            stream = self.stream or sys.stderr
+            stream.write(''.join(lines))
+            stream.flush()
+
+    def format_record(self, record):
+        start, remote_addr, request_line, status, bytes_sent, duration = \
+            record
+        return self.format % {
+            'remote_addr': _text(remote_addr) or '-',
+            'time': self.format_time(start),
+            'timestamp': start,
+            'request_line': _text(request_line),
+            'status': _text(status),
+            'bytes_sent': bytes_sent,
+            'duration': duration,
+            'duration_ms': duration * 1000,
+        }
+
+    def format_time(self, timestamp):
+        """Return 'timestamp' in Common Log Format, cached per second"""
+        second = int(timestamp)
+        cached_second, text = self.clock
+        if cached_second != second:
+            year, month, day, hh, mm, ss, wd, y, z = time.gmtime(second)
+            text = '%02d/%s/%04d:%02d:%02d:%02d +0000' % (
+                day, _months[month], year, hh, mm, ss)
+            self.clock = (second, text)
+        return text
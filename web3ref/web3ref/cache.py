@@ -0,0 +1,209 @@
+"""In-process response cache middleware
+
+Usage::
+
+    app = CacheMiddleware(app, ttl=30, vary=['Accept-Encoding'])
+
+Responses to GET and HEAD requests are materialized and kept in memory,
+keyed on the request method, SCRIPT_NAME, PATH_INFO, QUERY_STRING and the
+values of the request headers named in 'vary'.  Only wrap applications (or
+the parts of one) whose responses are safe to share between clients.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+__all__ = ['ResponseCache', 'CacheMiddleware']
+
+class ResponseCache:
+    """Size-bounded LRU mapping of keys to materialized responses
+
+    Each entry is a '(status, headers, data)' tuple, where 'data' is the
+    complete response body as bytes, and expires 'ttl' seconds after it was
+    stored.  When the summed size of the stored responses exceeds
+    'max_size' bytes, the least recently used entries are evicted.
+    """
+
+    def __init__(self, max_size=16*1024*1024, timer=time.time):
+        self.max_size = max_size
+        self.timer = timer
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Return the fresh response stored under 'key', or None"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, size, response = entry
+            if expires <= self.timer():
+                self.size -= size
+                return None
+            self.entries[key] = entry   # most recently used goes last
+            return response
+
+    def set(self, key, response, ttl):
+        """Store 'response' under 'key' for 'ttl' seconds"""
+        status, headers, data = response
+        size = len(status) + len(data)
+        for name, value in headers:
+            size += len(name) + len(value)
+        if size > self.max_size:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (self.timer() + ttl, size, response)
+            self.size += size
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+class _Flight:
+    """A cache miss being computed on behalf of several waiting requests"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+
+def _directives(value):
+    return [d.strip().lower() for d in value.split(b',')]
+
+class CacheMiddleware:
+    """Serve repeated GET/HEAD requests for 'application' from memory
+
+    'ttl' is the default lifetime of a cached response in seconds; a
+    'max-age' in the response's 'Cache-Control' header takes precedence.
+    Responses marked 'no-store', 'no-cache' or 'private', responses that set
+    cookies and responses to requests carrying 'Authorization' are never
+    cached, nor are asynchronous responses.  A response whose 'Vary' header
+    names a request header not listed in 'vary' is not cached either.
+
+    Under a multithreaded server ('web3.multithread'), concurrent misses for
+    the same key are collapsed: one request calls the application while the
+    others wait for, and share, its response.
+    """
+
+    cacheable_status = (b'200', b'203', b'300', b'301', b'404', b'410')
+
+    def __init__(self, application, ttl=60, vary=(), cache=None,
+                 max_size=16*1024*1024):
+        self.application = application
+        self.ttl = ttl
+        self.vary = [name.lower() for name in vary]
+        self.vary_keys = [
+            'HTTP_' + name.upper().replace('-', '_') for name in vary]
+        if cache is None:
+            cache = ResponseCache(max_size)
+        self.cache = cache
+        self.flights = {}
+        self.flights_lock = threading.Lock()
+
+    def __call__(self, environ):
+        if (environ.get('REQUEST_METHOD') not in (b'GET', b'HEAD')
+            or 'HTTP_AUTHORIZATION' in environ):
+            return self.application(environ)
+
+        key = self.make_key(environ)
+        response = self.cache.get(key)
+        if response is not None:
+            return self.replay(response)
+
+        if not environ.get('web3.multithread'):
+            return self.fill(key, environ)
+
+        with self.flights_lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.response is not None:
+                return self.replay(flight.response)
+            # the leader's response wasn't shareable; compute our own
+            return self.application(environ)
+
+        try:
+            result = self.fill(key, environ, flight)
+        finally:
+            with self.flights_lock:
+                del self.flights[key]
+            flight.done.set()
+        return result
+
+    def make_key(self, environ):
+        key = (
+            environ['REQUEST_METHOD'],
+            environ.get('SCRIPT_NAME', b''),
+            environ.get('PATH_INFO', b''),
+            environ.get('QUERY_STRING', b''),
+        )
+        if self.vary_keys:
+            key += tuple([environ.get(name) for name in self.vary_keys])
+        return key
+
+    def fill(self, key, environ, flight=None):
+        """Call the application and cache its response if possible"""
+        result = self.application(environ)
+        if hasattr(result, '__call__'):
+            return result
+
+        status, headers, body = result
+        ttl = self.cache_ttl(status, headers)
+        if ttl is None:
+            return result
+
+        try:
+            data = b''.join(body)
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+        response = (status, headers, data)
+        self.cache.set(key, response, ttl)
+        if flight is not None:
+            flight.response = response
+        return self.replay(response)
+
+    def cache_ttl(self, status, headers):
+        """Return how long a response may be cached, or None if it can't"""
+        if status[:3] not in self.cacheable_status:
+            return None
+        ttl = self.ttl
+        for name, value in headers:
+            name = name.lower()
+            if name == b'cache-control':
+                for directive in _directives(value):
+                    if directive in (b'no-store', b'no-cache', b'private'):
+                        return None
+                    if directive.startswith(b'max-age='):
+                        try:
+                            ttl = int(directive[8:])
+                        except ValueError:
+                            return None
+            elif name == b'set-cookie':
+                return None
+            elif name == b'vary':
+                for header in _directives(value):
+                    if header.decode('latin-1') not in self.vary:
+                        return None
+        if ttl <= 0:
+            return None
+        return ttl
+
+    def replay(self, response):
+        status, headers, data = response
+        return status, list(headers), [data]
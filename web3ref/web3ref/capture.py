@@ -0,0 +1,278 @@
+"""Capture real traffic to a file, and replay it for benchmarking
+
+Wrap an application with a Recorder to log its requests::
+
+    app = Recorder(app, 'traffic.cap', sample=10)
+
+Each recorded request is the time it arrived, the request's CGI variables
+and HTTP_* headers (see REQUEST_KEYS; the server's process environment,
+which handlers copy into every environ, is left out) and the request body.
+The request thread only copies those; a background thread encodes them and
+appends them to the file in batches, at most 'interval' seconds apart.
+Requests are dropped from the capture rather than made to wait when
+'max_pending' of them are waiting for the writer, or when their body is
+larger than 'max_body'; the 'dropped' attribute counts them.
+
+'read_records()' reads a capture back, and 'replay()' runs it through an
+application with 'handlers.SimpleHandler', at the recorded pace or as fast
+as possible, from one or more threads.  To replay against a running server
+instead, replay through a 'proxy.Proxy' for it.  'bench_replay.py' does
+either from the command line.
+
+The file starts with MAGIC, followed by one record per request: a header
+'(time, environ size, body size)' in network byte order ('!dII'), the
+environ as '(key size, value size)' headers ('!HI') each followed by the key
+and value, then the body.
+"""
+
+import os
+import struct
+import threading
+import time
+from collections import deque
+from itertools import count
+
+from web3ref.handlers import SimpleHandler
+from web3ref.util import BytesIO
+
+__all__ = ['Recorder', 'read_records', 'replay', 'MAGIC', 'REQUEST_KEYS']
+
+MAGIC = b'WEB3CAP1'
+
+# Environ variables describing the request, besides the HTTP_* headers
+REQUEST_KEYS = frozenset([
+    'REQUEST_METHOD', 'SCRIPT_NAME', 'PATH_INFO', 'RAW_PATH_INFO',
+    'QUERY_STRING', 'CONTENT_TYPE', 'CONTENT_LENGTH', 'SERVER_NAME',
+    'SERVER_PORT', 'SERVER_PROTOCOL', 'REMOTE_ADDR',
+])
+
+_record = struct.Struct('!dII')
+_pair = struct.Struct('!HI')
+
+if bytes is str:
+    def _key_bytes(key):
+        return key
+    _key_native = _key_bytes
+else:
+    def _key_bytes(key):
+        return key.encode('latin-1')
+    def _key_native(key):
+        return key.decode('latin-1')
+
+def encode_record(timestamp, items, body):
+    """Return the bytes of one record; 'items' are '(key, value)' pairs"""
+    chunks = [None]
+    for key, value in items:
+        key = _key_bytes(key)
+        chunks.append(_pair.pack(len(key), len(value)))
+        chunks.append(key)
+        chunks.append(value)
+    environ = b''.join(chunks[1:])
+    chunks[1:] = [environ, body]
+    chunks[0] = _record.pack(timestamp, len(environ), len(body))
+    return b''.join(chunks)
+
+def read_records(path):
+    """Yield '(time, environ, body)' for each request in a capture file"""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a capture file' % path)
+        while 1:
+            header = f.read(_record.size)
+            if len(header) < _record.size:
+                return          # the end, or a record cut short by a crash
+            timestamp, environ_size, body_size = _record.unpack(header)
+            data = f.read(environ_size + body_size)
+            if len(data) < environ_size + body_size:
+                return
+            environ = {}
+            pos = 0
+            while pos < environ_size:
+                key_size, value_size = _pair.unpack_from(data, pos)
+                pos += _pair.size
+                key = _key_native(data[pos:pos + key_size])
+                pos += key_size
+                environ[key] = data[pos:pos + value_size]
+                pos += value_size
+            yield timestamp, environ, data[environ_size:]
+
+class Recorder:
+    """Middleware appending requests to a capture file at 'path'
+
+    Records every 'sample'th request; see the module docstring.  Of the
+    environ, the variables in 'keys' and the HTTP_* headers are recorded.
+    The writer thread is started on first use, and again in a forked
+    child.  Call 'flush()' to write out pending records, and 'close()',
+    which stops the writer, when done.
+    """
+
+    def __init__(self, app, path, sample=1, max_body=1024*1024,
+                 max_pending=1000, interval=1.0, keys=REQUEST_KEYS):
+        self.app = app
+        self.keys = keys
+        self.path = path
+        self.sample = sample
+        self.max_body = max_body
+        self.max_pending = max_pending
+        self.interval = interval
+        self.dropped = 0
+        self.counter = count(1)
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.next_write = 0
+        self.stream = None
+        self.pid = None
+        self.thread = None
+        self.closed = False
+
+    def __call__(self, environ):
+        if self.sample > 1 and next(self.counter) % self.sample:
+            return self.app(environ)
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        if length > self.max_body or len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            return self.app(environ)
+        now = time.time()
+        body = b''
+        if length:
+            body = environ['web3.input'].read(length)
+            environ['web3.input'] = BytesIO(body)
+        keys = self.keys
+        items = [(key, value) for key, value in environ.items()
+                 if (key in keys or key[:5] == 'HTTP_') and
+                 type(value) is bytes]
+        if self.pid != os.getpid():
+            self.start()
+        with self.lock:
+            self.pending.append((now, items, body))
+            pending = len(self.pending)
+        if pending == 1 or pending >= self.max_pending // 2:
+            self.wakeup.set()
+        return self.app(environ)
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            # Records inherited over fork() are the parent's to write
+            self.pending.clear()
+            self.stream = None
+            self.wakeup = threading.Event()
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def run(self):
+        """Main loop of the writer thread"""
+        while not self.closed:
+            self.wakeup.wait()      # set by the first record pending
+            self.wakeup.clear()
+            if self.closed:
+                return
+            delay = self.next_write - time.time()
+            if delay > 0 and len(self.pending) < self.max_pending // 2:
+                self.wakeup.wait(delay)
+                self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+    def flush(self):
+        """Write out the pending records"""
+        with self.write_lock:
+            self.next_write = time.time() + self.interval
+            chunks = []
+            pending = self.pending
+            while pending:
+                chunks.append(encode_record(*pending.popleft()))
+            if not chunks:
+                return
+            if self.stream is None:
+                self.stream = open(self.path, 'ab')
+                if not os.path.getsize(self.path):
+                    self.stream.write(MAGIC)
+            self.stream.write(b''.join(chunks))
+            self.stream.flush()
+
+    def close(self):
+        self.closed = True
+        if self.pid == os.getpid():
+            self.wakeup.set()
+            self.thread.join()
+        self.flush()
+        with self.write_lock:
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+
+class _Discard:
+    """Output and error stream of replayed requests"""
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+class _Result:
+    """Stands in for the request handler, which is told the status"""
+
+    status = None
+    bytes_sent = 0
+
+    def log_response(self, status, bytes_sent):
+        self.status = status
+        self.bytes_sent = bytes_sent
+
+def replay(records, app, speed=None, threads=1, environ=None):
+    """Run captured requests through 'app'; return their timings
+
+    'records' are '(time, environ, body)' tuples, as from 'read_records()'.
+    With 'speed', requests start at the recorded pace ('speed=2' for twice
+    as fast) instead of as fast as possible; either way, at most 'threads'
+    run at once.  'environ' overrides recorded variables.  Returns a list
+    of '(status, bytes_sent, duration)' tuples, in the order the requests
+    finished; failed requests have the handler's 'error_status'.
+    """
+    records = iter(records)
+    results = []
+    lock = threading.Lock()
+    errors = _Discard()
+    origin = [None]
+    def work():
+        while 1:
+            with lock:
+                record = next(records, None)
+                if record is None:
+                    return
+                timestamp, env, body = record
+                if origin[0] is None:
+                    origin[0] = timestamp, time.time()
+            if speed:
+                first, started = origin[0]
+                delay = started + (timestamp - first) / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            if environ:
+                env = dict(env, **environ)
+            handler = SimpleHandler(BytesIO(body), _Discard(), errors, env,
+                                    multithread=threads > 1)
+            handler.request_handler = result = _Result()
+            start = time.time()
+            handler.run(app)
+            duration = time.time() - start
+            with lock:
+                results.append((result.status, result.bytes_sent, duration))
+    if threads <= 1:
+        work()
+        return results
+    workers = [threading.Thread(target=work) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results
@@ -0,0 +1,160 @@
+"""Conditional GET middleware (ETag / Last-Modified revalidation)
+
+Wrap an application with 'conditional' to answer 'If-None-Match' and
+'If-Modified-Since' requests with '304 Not Modified'.  Usage::
+
+    app = conditional(app)
+
+or, when the application can tell whether a resource changed without doing
+the work of producing it::
+
+    def validators(environ):
+        doc = lookup(environ['PATH_INFO'])
+        return doc.etag, doc.mtime
+
+    app = conditional(app, validators)
+"""
+
+from hashlib import md5
+
+from web3ref.handlers import format_date_time
+from web3ref.handlers import parse_date_time
+from web3ref.util import apply_filter
+
+__all__ = ['conditional', 'is_not_modified', 'not_modified']
+
+# Headers that a 304 response may (and should) repeat from the full response
+_not_modified_headers = {
+    b'cache-control':1, b'content-location':1, b'date':1, b'etag':1,
+    b'expires':1, b'last-modified':1, b'vary':1,
+    }
+
+def _opaque_tag(tag):
+    """Return the opaque part of an entity tag (weak comparison)"""
+    tag = tag.strip()
+    if tag[:2] == b'W/':
+        tag = tag[2:]
+    return tag
+
+def is_not_modified(environ, etag=None, last_modified=None):
+    """Return true if the client's cached copy of the resource is current
+
+    'etag' is the entity tag of the current representation (bytes,
+    including the quotes) and 'last_modified' its modification time, either
+    as a timestamp or as an HTTP date.  As required by RFC 2616,
+    'If-None-Match' takes precedence over 'If-Modified-Since', and only GET
+    and HEAD requests are ever considered.
+    """
+    if environ.get('REQUEST_METHOD') not in (b'GET', b'HEAD'):
+        return False
+
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        if etag is None:
+            return False
+        if if_none_match.strip() == b'*':
+            return True
+        etag = _opaque_tag(etag)
+        for tag in if_none_match.split(b','):
+            if _opaque_tag(tag) == etag:
+                return True
+        return False
+
+    if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since is not None and last_modified is not None:
+        since = parse_date_time(if_modified_since)
+        if since is None:
+            return False
+        if isinstance(last_modified, bytes):
+            last_modified = parse_date_time(last_modified)
+            if last_modified is None:
+                return False
+        return int(last_modified) <= since
+
+    return False
+
+def not_modified(headers):
+    """Return a '304 Not Modified' response repeating the cache headers"""
+    return (
+        b'304 Not Modified',
+        [(k, v) for k, v in headers if k.lower() in _not_modified_headers],
+        [],
+    )
+
+def conditional(application, validators=None, compute_etag=False):
+    """Answer conditional requests for 'application' with '304 Not Modified'
+
+    If 'validators' is given, it is called with the environ before the
+    application and must cheaply return an '(etag, last_modified)' pair
+    (either may be None, and 'last_modified' is a timestamp).  When those
+    validators satisfy the request, the application is not called at all;
+    otherwise they are added to the application's response unless it
+    supplies its own.
+
+    Without a validators callable, the 'ETag' and 'Last-Modified' headers of
+    the application's response are used: if they satisfy the request, the
+    response body is closed without being iterated.
+
+    If 'compute_etag' is true, successful responses that carry neither
+    validator get a strong ETag computed from a digest of the body.  This
+    necessarily materializes the whole body, so it only pays off for
+    modestly-sized responses that are expensive to transmit.
+    """
+    def conditional_app(environ):
+        etag = last_modified = None
+        if validators is not None:
+            etag, last_modified = validators(environ)
+            if is_not_modified(environ, etag, last_modified):
+                headers = []
+                if etag is not None:
+                    headers.append((b'ETag', etag))
+                if last_modified is not None:
+                    headers.append(
+                        (b'Last-Modified', format_date_time(last_modified)))
+                return not_modified(headers)
+
+        def filter_func(status, headers, body):
+            if status[:3] != b'200':
+                return status, headers, body
+
+            app_etag = app_last_modified = None
+            for name, value in headers:
+                name = name.lower()
+                if name == b'etag':
+                    app_etag = value
+                elif name == b'last-modified':
+                    app_last_modified = value
+
+            # The application's list may be shared between responses, or
+            # a tuple, so the validators go on a new one
+            added = []
+            if app_etag is None and etag is not None:
+                app_etag = etag
+                added.append((b'ETag', etag))
+            if app_last_modified is None and last_modified is not None:
+                app_last_modified = format_date_time(last_modified)
+                added.append((b'Last-Modified', app_last_modified))
+
+            if app_etag is None and app_last_modified is None and compute_etag:
+                try:
+                    data = b''.join(body)
+                finally:
+                    if hasattr(body, 'close'):
+                        body.close()
+                body = [data]
+                digest = md5(data).hexdigest().encode('ascii')
+                app_etag = b'"' + digest + b'"'
+                added.append((b'ETag', app_etag))
+            if added:
+                headers = list(headers) + added
+
+            if is_not_modified(environ, app_etag, app_last_modified):
+                if hasattr(body, 'close'):
+                    body.close()
+                return not_modified(headers)
+
+            return status, headers, body
+
+        return apply_filter(application, environ, filter_func)
+
+    return conditional_app
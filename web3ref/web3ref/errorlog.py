@@ -0,0 +1,151 @@
+"""Rate-limited, deduplicated reporting of application errors
+
+When an application starts failing, it usually fails the same way on every
+request, and printing thousands of identical tracebacks a second only slows
+down the workers further.  An ErrorReporter fingerprints each exception by
+its type and the code locations in its traceback, and writes the full trace
+of a fingerprint at most once per 'window' seconds; repeats are only
+counted, and the count is reported with the next trace written for it, or
+by 'flush()'::
+
+    reporter = ErrorReporter(window=60)
+    try:
+        ...
+    except:
+        reporter.report(sys.exc_info())
+
+'report()' does little more than walk the traceback; formatting and writing
+happen in a background thread.  Handlers use a reporter for
+'log_exception()' when their 'error_reporter' is set; see
+'simple_server.Web3Server.enable_error_reporter()'.
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import deque
+from traceback import format_exception
+
+__all__ = ['ErrorReporter']
+
+class ErrorReporter:
+    """Writes each distinct error once per window, from a background thread
+
+    At most 'max_pending' traces wait for the writer; errors beyond that are
+    counted as repeats.  The thread is started on first use, and again in a
+    forked child.
+    """
+
+    def __init__(self, stream=None, window=60, max_pending=100,
+                 max_fingerprints=1000):
+        self.stream = stream
+        self.window = window
+        self.max_pending = max_pending
+        self.max_fingerprints = max_fingerprints
+        self.seen = {}          # fingerprint -> [window end, repeats]
+        self.pending = deque()  # (exc_info, limit, repeats) to be written
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pid = None
+
+    def fingerprint(self, exc_info):
+        """Return a hashable key identifying where and how it failed"""
+        frames = []
+        tb = exc_info[2]
+        while tb is not None:
+            frames.append((tb.tb_frame.f_code, tb.tb_lineno))
+            tb = tb.tb_next
+        return exc_info[0], tuple(frames)
+
+    def report(self, exc_info, limit=None):
+        """Have 'exc_info' written, unless it was written recently
+
+        'limit' is passed on to 'traceback.format_exception()'.
+        """
+        if self.pid != os.getpid():
+            self.start()
+        key = self.fingerprint(exc_info)
+        now = time.time()
+        with self.lock:
+            entry = self.seen.get(key)
+            if entry is None:
+                if len(self.seen) >= self.max_fingerprints:
+                    self.expire(now)
+                entry = self.seen[key] = [0, 0]
+            if now < entry[0] or len(self.pending) >= self.max_pending:
+                entry[1] += 1
+                return
+            repeats, entry[1] = entry[1], 0
+            entry[0] = now + self.window
+            self.pending.append((exc_info, limit, repeats))
+        self.wakeup.set()
+
+    def expire(self, now):
+        """Forget fingerprints whose window is over; called with 'lock' held"""
+        for key, (end, repeats) in list(self.seen.items()):
+            if end <= now and not repeats:
+                del self.seen[key]
+        if len(self.seen) >= self.max_fingerprints:
+            self.seen.clear()       # every one of them is busy; start over
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            # What was inherited over fork() is the parent's to write
+            self.pending.clear()
+            self.seen.clear()
+            self.wakeup = threading.Event()
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.pid = os.getpid()
+
+    def run(self):
+        """Main loop of the writer thread"""
+        while 1:
+            self.wakeup.wait()      # every report sets it
+            self.wakeup.clear()
+            try:
+                self.write_pending()
+            except Exception:
+                pass
+
+    def write_pending(self):
+        with self.write_lock:
+            chunks = []
+            while 1:
+                with self.lock:
+                    if not self.pending:
+                        break
+                    exc_info, limit, repeats = self.pending.popleft()
+                try:
+                    if repeats:
+                        chunks.append('[%d repeats since last reported]\n'
+                                      % repeats)
+                    chunks.extend(format_exception(
+                        exc_info[0], exc_info[1], exc_info[2], limit))
+                finally:
+                    exc_info = None
+            self.write(chunks)
+
+    def flush(self):
+        """Write out pending traces, and the repeats counted so far"""
+        self.write_pending()
+        chunks = []
+        with self.lock:
+            for (exc_type, frames), entry in self.seen.items():
+                if entry[1]:
+                    chunks.append('[%s: %d repeats since last reported]\n'
+                                  % (exc_type.__name__, entry[1]))
+                    entry[1] = 0
+        with self.write_lock:
+            self.write(chunks)
+
+    def write(self, chunks):
+        if chunks:
+            stream = self.stream or sys.stderr
+            stream.write(''.join(chunks))
+            stream.flush()
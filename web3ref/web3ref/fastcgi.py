@@ -0,0 +1,444 @@
+"""FastCGI responder server for Web3 applications
+
+Usage::
+
+    from web3ref.fastcgi import make_server
+    server = make_server('/run/app.sock', app)     # or ('127.0.0.1', 9000)
+    server.serve_forever()
+
+The front-end web server talks the FastCGI record protocol to us over a
+Unix or TCP socket; every request is run through a 'FastCGIHandler' (a
+BaseCGIHandler), so no process is started per request as with CGIHandler.
+
+Requests multiplexed on one connection are served concurrently, each in its
+own thread; past the server's 'max_reqs' requests at once on a connection,
+new ones are refused with FCGI_OVERLOADED, and a front-end beginning a
+request with the id of one still in progress is hung up on.  FCGI_PARAMS
+are decoded straight into the environ as bytes, FCGI_STDIN is spooled (to
+a temporary file once it grows large) and becomes 'web3.input', and
+response output is coalesced into as few FCGI_STDOUT records as the Web3
+flushing rules allow.
+"""
+
+import os
+import socket
+import struct
+import sys
+import threading
+try:
+    from socketserver import BaseRequestHandler
+    from socketserver import TCPServer
+    from socketserver import ThreadingMixIn
+    from socketserver import UnixStreamServer
+except ImportError:     # Python 2
+    from SocketServer import BaseRequestHandler
+    from SocketServer import TCPServer
+    from SocketServer import ThreadingMixIn
+    from SocketServer import UnixStreamServer
+from tempfile import SpooledTemporaryFile
+
+from web3ref.handlers import BaseCGIHandler
+
+__all__ = [
+    'FastCGIHandler', 'FastCGIRequestHandler', 'FastCGIServer',
+    'UnixFastCGIServer', 'make_server',
+]
+
+FCGI_VERSION_1 = 1
+
+FCGI_BEGIN_REQUEST = 1
+FCGI_ABORT_REQUEST = 2
+FCGI_END_REQUEST = 3
+FCGI_PARAMS = 4
+FCGI_STDIN = 5
+FCGI_STDOUT = 6
+FCGI_STDERR = 7
+FCGI_DATA = 8
+FCGI_GET_VALUES = 9
+FCGI_GET_VALUES_RESULT = 10
+FCGI_UNKNOWN_TYPE = 11
+
+FCGI_KEEP_CONN = 1
+
+FCGI_RESPONDER = 1
+
+FCGI_REQUEST_COMPLETE = 0
+FCGI_CANT_MPX_CONN = 1
+FCGI_OVERLOADED = 2
+FCGI_UNKNOWN_ROLE = 3
+
+FCGI_MAX_CONTENT = 65535
+
+_header = struct.Struct('!BBHHBx')
+_begin_body = struct.Struct('!HB5x')
+_end_body = struct.Struct('!LB3x')
+_long_length = struct.Struct('!L')
+_padding = [b'\0' * n for n in range(8)]
+
+def encode_records(record_type, request_id, data):
+    """Return the records carrying 'data' as a list of bytes chunks
+
+    Empty 'data' yields a single empty record, which marks the end of a
+    stream.  Content is padded to a multiple of 8 bytes, as recommended.
+    """
+    chunks = []
+    length = len(data)
+    offset = 0
+    while 1:
+        size = min(length - offset, FCGI_MAX_CONTENT)
+        padding = -size & 7
+        chunks.append(_header.pack(
+            FCGI_VERSION_1, record_type, request_id, size, padding))
+        if size:
+            chunks.append(data[offset:offset + size])
+        if padding:
+            chunks.append(_padding[padding])
+        offset += size
+        if offset >= length:
+            return chunks
+
+def decode_pairs(data):
+    """Decode FastCGI name-value pairs into a dictionary
+
+    Names become native strings, as required for environ keys; values stay
+    bytes.
+    """
+    pairs = {}
+    offset = 0
+    end = len(data)
+    native = bytes is not str
+    while offset < end:
+        lengths = []
+        for i in (0, 1):
+            length = ord(data[offset:offset + 1])
+            if length & 0x80:
+                length = _long_length.unpack(
+                    data[offset:offset + 4])[0] & 0x7fffffff
+                offset += 4
+            else:
+                offset += 1
+            lengths.append(length)
+        name_length, value_length = lengths
+        name = data[offset:offset + name_length]
+        offset += name_length
+        value = data[offset:offset + value_length]
+        offset += value_length
+        if native:
+            name = name.decode('latin-1')
+        pairs[name] = value
+    return pairs
+
+def encode_pairs(pairs):
+    """Encode a sequence of '(name, value)' bytes pairs"""
+    chunks = []
+    for name, value in pairs:
+        for item in name, value:
+            if len(item) < 128:
+                chunks.append(struct.pack('!B', len(item)))
+            else:
+                chunks.append(_long_length.pack(len(item) | 0x80000000))
+        chunks.append(name)
+        chunks.append(value)
+    return b''.join(chunks)
+
+class _RecordStream:
+    """Output stream that sends what is written as FastCGI records
+
+    Writes are buffered until 'flush()' (or until 'coalesce' bytes are
+    pending), so that e.g. the response headers and the first body block
+    travel in one record.  Text written to the stream (as by error logging)
+    is encoded as UTF-8.
+    """
+
+    def __init__(self, connection, record_type, request_id, coalesce=8192):
+        self.connection = connection
+        self.record_type = record_type
+        self.request_id = request_id
+        self.coalesce = coalesce
+        self.buffer = []
+        self.size = 0
+        self.used = False
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8', 'replace')
+        if data:
+            self.buffer.append(data)
+            self.size += len(data)
+            self.used = True
+            if self.size >= self.coalesce:
+                self.flush()
+
+    def writelines(self, seq):
+        for data in seq:
+            self.write(data)
+
+    def flush(self):
+        if self.size:
+            self.connection.send(encode_records(
+                self.record_type, self.request_id, self.take()))
+
+    def take(self):
+        """Return and forget the pending data"""
+        data = b''.join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        return data
+
+class _Request:
+    """State of one FastCGI request while its input is being received"""
+
+    def __init__(self, request_id, keep_conn, spool_size):
+        self.request_id = request_id
+        self.keep_conn = keep_conn
+        self.params = []
+        self.environ = None
+        self.stdin = SpooledTemporaryFile(spool_size)
+
+class FastCGIHandler(BaseCGIHandler):
+    """BaseCGIHandler for one request received over FastCGI
+
+    The front-end server supplies the complete CGI environment, so the
+    process environment isn't merged into the request's.
+    """
+
+    os_environ = {}
+
+class FastCGIRequestHandler(BaseRequestHandler):
+    """Serve the FastCGI requests arriving on one connection"""
+
+    handler_class = FastCGIHandler
+    spool_size = 1024 * 1024   # stdin beyond this many bytes goes to disk
+
+    def setup(self):
+        self.rfile = self.request.makefile('rb', -1)
+        self.send_lock = threading.Lock()
+        self.requests = {}
+        self.workers = []
+        self.active = set()     # ids of requests begun and not yet ended
+        self.active_lock = threading.Lock()
+        self.closing = False
+
+    def handle(self):
+        while not self.closing:
+            record = self.read_record()
+            if record is None:
+                break
+            record_type, request_id, content = record
+            if request_id == 0:
+                self.handle_management(record_type, content)
+            elif record_type == FCGI_BEGIN_REQUEST:
+                self.begin_request(request_id, content)
+            elif request_id not in self.requests:
+                continue    # ignore records of unknown or finished requests
+            elif record_type == FCGI_PARAMS:
+                self.receive_params(self.requests[request_id], content)
+            elif record_type == FCGI_STDIN:
+                self.receive_stdin(self.requests[request_id], content)
+            elif record_type == FCGI_ABORT_REQUEST:
+                self.abort_request(self.requests[request_id])
+            elif record_type == FCGI_DATA:
+                pass        # only used by the Filter role
+            else:
+                self.send(encode_records(
+                    FCGI_UNKNOWN_TYPE, 0, struct.pack('!B7x', record_type)))
+
+    def finish(self):
+        for worker in self.workers:
+            worker.join()
+        self.rfile.close()
+
+    def read_record(self):
+        """Return '(type, request_id, content)' of the next record or None"""
+        header = self.rfile.read(_header.size)
+        if len(header) < _header.size:
+            return None
+        version, record_type, request_id, length, padding = \
+            _header.unpack(header)
+        content = self.rfile.read(length)
+        if padding:
+            self.rfile.read(padding)
+        if len(content) < length:
+            return None
+        return record_type, request_id, content
+
+    def send(self, chunks):
+        with self.send_lock:
+            self.request.sendall(b''.join(chunks))
+
+    def handle_management(self, record_type, content):
+        if record_type == FCGI_GET_VALUES:
+            server = self.server
+            values = {
+                b'FCGI_MAX_CONNS': server.max_conns,
+                b'FCGI_MAX_REQS': server.max_reqs,
+                b'FCGI_MPXS_CONNS': server.multiplexed and b'1' or b'0',
+            }
+            wanted = decode_pairs(content)
+            if bytes is not str:
+                wanted = [name.encode('latin-1') for name in wanted]
+            result = [(name, values[name]) for name in wanted
+                      if name in values]
+            self.send(encode_records(
+                FCGI_GET_VALUES_RESULT, 0, encode_pairs(result)))
+        else:
+            self.send(encode_records(
+                FCGI_UNKNOWN_TYPE, 0, struct.pack('!B7x', record_type)))
+
+    def begin_request(self, request_id, content):
+        role, flags = _begin_body.unpack(content[:_begin_body.size])
+        keep_conn = flags & FCGI_KEEP_CONN
+        if request_id in self.active:
+            self.closing = True     # its records would be mixed up
+        elif role != FCGI_RESPONDER:
+            self.end_request(request_id, keep_conn, FCGI_UNKNOWN_ROLE)
+        elif self.requests and not self.server.multiplexed:
+            self.end_request(request_id, True, FCGI_CANT_MPX_CONN)
+        elif len(self.active) >= int(self.server.max_reqs):
+            self.end_request(request_id, True, FCGI_OVERLOADED)
+        else:
+            with self.active_lock:
+                self.active.add(request_id)
+            self.requests[request_id] = _Request(
+                request_id, keep_conn, self.spool_size)
+
+    def receive_params(self, request, content):
+        if content:
+            request.params.append(content)
+        else:
+            environ = request.environ = decode_pairs(b''.join(request.params))
+            request.params = None
+            for key in 'SCRIPT_NAME', 'PATH_INFO', 'QUERY_STRING':
+                environ.setdefault(key, b'')
+
+    def receive_stdin(self, request, content):
+        if content:
+            request.stdin.write(content)
+            return
+        request.stdin.seek(0)
+        del self.requests[request.request_id]
+        if request.environ is None:     # misbehaving front-end
+            request.environ = {'SCRIPT_NAME': b'', 'PATH_INFO': b'',
+                               'QUERY_STRING': b''}
+        if self.server.multiplexed:
+            worker = threading.Thread(target=self.run_request,
+                                      args=(request,))
+            worker.daemon = True
+            self.workers = [w for w in self.workers if w.is_alive()]
+            self.workers.append(worker)
+            worker.start()
+        else:
+            self.run_request(request)
+
+    def abort_request(self, request):
+        del self.requests[request.request_id]
+        request.stdin.close()
+        with self.active_lock:
+            self.active.discard(request.request_id)
+        self.end_request(request.request_id, request.keep_conn)
+
+    def run_request(self, request):
+        """Run the application for a request whose input is complete"""
+        stdout = _RecordStream(self, FCGI_STDOUT, request.request_id)
+        stderr = _RecordStream(self, FCGI_STDERR, request.request_id)
+        app_status = 0
+        try:
+            handler = self.handler_class(
+                request.stdin, stdout, stderr, request.environ,
+                multithread=self.server.multithread,
+                multiprocess=self.server.multiprocess,
+            )
+            handler.run(self.server.get_app())
+        except Exception:
+            app_status = 1
+            stdout.take()   # never send half a response after an error
+        finally:
+            request.stdin.close()
+            chunks = []
+            data = stdout.take()
+            if data:
+                chunks.extend(encode_records(
+                    FCGI_STDOUT, request.request_id, data))
+            chunks.extend(encode_records(FCGI_STDOUT, request.request_id, b''))
+            if stderr.used:
+                data = stderr.take()
+                if data:
+                    chunks.extend(encode_records(
+                        FCGI_STDERR, request.request_id, data))
+                chunks.extend(encode_records(
+                    FCGI_STDERR, request.request_id, b''))
+            # Before the front-end can learn that it may send another
+            with self.active_lock:
+                self.active.discard(request.request_id)
+            self.end_request(request.request_id, request.keep_conn,
+                             FCGI_REQUEST_COMPLETE, app_status, chunks)
+
+    def end_request(self, request_id, keep_conn,
+                    protocol_status=FCGI_REQUEST_COMPLETE, app_status=0,
+                    chunks=None):
+        """Send FCGI_END_REQUEST, preceded by any final 'chunks'"""
+        chunks = list(chunks or ())
+        chunks.extend(encode_records(FCGI_END_REQUEST, request_id,
+            _end_body.pack(app_status, protocol_status)))
+        self.send(chunks)
+        if not keep_conn:
+            self.closing = True
+            if self.server.multiplexed:
+                # wake up the reading thread
+                try:
+                    self.request.shutdown(socket.SHUT_RD)
+                except (IOError, OSError):
+                    pass
+
+class _FastCGIServerMixin(ThreadingMixIn):
+    """FastCGI server settings shared by the TCP and Unix socket servers"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    # Serve the requests multiplexed on one connection concurrently
+    multiplexed = True
+    multithread = True
+    multiprocess = False
+    max_conns = b'100'
+    max_reqs = b'100'
+
+    application = None
+
+    def get_app(self):
+        return self.application
+
+    def set_app(self, application):
+        self.application = application
+
+class FastCGIServer(_FastCGIServerMixin, TCPServer):
+    """FastCGI server listening on a TCP '(host, port)' address"""
+
+class UnixFastCGIServer(_FastCGIServerMixin, UnixStreamServer):
+    """FastCGI server listening on a Unix domain socket path"""
+
+    def server_bind(self):
+        """Replace a stale socket file left behind by a previous run"""
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+        UnixStreamServer.server_bind(self)
+
+def make_server(address, app, server_class=None,
+                handler_class=FastCGIRequestHandler):
+    """Create a FastCGI server for 'app' on a '(host, port)' or socket path
+    """
+    if server_class is None:
+        if isinstance(address, tuple):
+            server_class = FastCGIServer
+        else:
+            server_class = UnixFastCGIServer
+    server = server_class(address, handler_class)
+    server.set_app(app)
+    return server
+
+if __name__ == '__main__':
+    from web3ref.simple_server import demo_app
+    address = sys.argv[1:2] and sys.argv[1] or ('127.0.0.1', 9000)
+    make_server(address, demo_app).serve_forever()
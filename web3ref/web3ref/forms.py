@@ -0,0 +1,296 @@
+"""Streaming parser for form submissions in 'web3.input'
+
+Usage::
+
+    from web3ref.forms import parse_form
+    fields, files = parse_form(environ)
+    for name, value in fields:          # bytes, bytes
+        ...
+    for name, part in files:            # bytes, Part
+        save(part.filename, part.file)
+
+Both 'application/x-www-form-urlencoded' and 'multipart/form-data' bodies
+are read in blocks of 'blksize' bytes, so that memory use doesn't grow with
+the size of the request: plain fields are kept in memory (up to
+'max_field_size' bytes each), while file uploads go to a
+'SpooledTemporaryFile', which moves them to disk once they outgrow
+'spool_size'.  Everything stays bytes, like the rest of the Web3 environ;
+decoding names and values is up to the application.
+
+The body can only be read once, so the result is stored in the environ
+under 'web3ref.form' and returned from there by later calls.
+"""
+
+from tempfile import SpooledTemporaryFile
+
+from web3ref.util import unquote_plus
+
+__all__ = ['FormError', 'Part', 'parse_form', 'parse_options']
+
+class FormError(ValueError):
+    """The request body isn't a well-formed form, or exceeds a limit"""
+
+class Part:
+    """A file uploaded in a 'multipart/form-data' body
+
+    'headers' is the part's list of '(name, value)' header tuples, with
+    lower-cased names; 'file' is positioned at the start of the content.
+    """
+
+    def __init__(self, name, filename, headers, file, size):
+        self.name = name
+        self.filename = filename
+        self.headers = headers
+        self.file = file
+        self.size = size
+
+    def __repr__(self):
+        return '<Part %r %r (%d bytes)>' % (self.name, self.filename,
+                                            self.size)
+
+    @property
+    def content_type(self):
+        for name, value in self.headers:
+            if name == b'content-type':
+                return value
+        return b'application/octet-stream'
+
+    def read(self):
+        """Return the whole content; mind the size of large uploads"""
+        self.file.seek(0)
+        return self.file.read()
+
+    def close(self):
+        self.file.close()
+
+def parse_options(value):
+    """Split a header value like 'form-data; name="a"' into its parts
+
+    Returns the lower-cased main value and a dict of its parameters, with
+    lower-cased names and quotes removed.
+    """
+    parts = _split_params(value)
+    options = {}
+    for part in parts[1:]:
+        name, sep, param = part.partition(b'=')
+        if not sep:
+            continue
+        param = param.strip()
+        if param[:1] == b'"' and param[-1:] == b'"' and len(param) > 1:
+            param = param[1:-1].replace(b'\\\\', b'\\').replace(b'\\"', b'"')
+        options[name.strip().lower()] = param
+    return parts[0].strip().lower(), options
+
+def _split_params(value):
+    """Split on semicolons that aren't inside a quoted string"""
+    parts = []
+    start = 0
+    quoted = False
+    i = 0
+    length = len(value)
+    while i < length:
+        c = value[i:i+1]
+        if c == b'"':
+            quoted = not quoted
+        elif c == b'\\' and quoted:
+            i += 1
+        elif c == b';' and not quoted:
+            parts.append(value[start:i])
+            start = i + 1
+        i += 1
+    parts.append(value[start:])
+    return parts
+
+def _blocks(environ, blksize, max_size):
+    """Yield the request body in blocks of at most 'blksize' bytes"""
+    try:
+        remaining = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        raise FormError('invalid Content-Length')
+    if max_size is not None and remaining > max_size:
+        raise FormError('request body too large')
+    stream = environ['web3.input']
+    while remaining > 0:
+        data = stream.read(min(blksize, remaining))
+        if not data:
+            raise FormError('request body truncated')
+        remaining -= len(data)
+        yield data
+
+def parse_form(environ, spool_size=1024*1024, max_field_size=1024*1024,
+               max_size=None, max_parts=1000, blksize=65536):
+    """Parse a form submitted in the request body
+
+    Returns '(fields, files)', lists of '(name, value)' and '(name, Part)'
+    tuples in the order they were sent; for other content types both are
+    empty and the body is left unread.  Raises FormError for a malformed
+    body, for more than 'max_parts' fields and files, or if any limit is
+    exceeded.
+    """
+    try:
+        return environ['web3ref.form']
+    except KeyError:
+        pass
+    content_type, options = parse_options(environ.get('CONTENT_TYPE', b''))
+    if content_type == b'application/x-www-form-urlencoded':
+        result = (_parse_urlencoded(_blocks(environ, blksize, max_size),
+                                    max_field_size, max_parts), [])
+    elif content_type == b'multipart/form-data':
+        boundary = options.get(b'boundary')
+        if not boundary or len(boundary) > 200:
+            raise FormError('missing or invalid multipart boundary')
+        result = _parse_multipart(_blocks(environ, blksize, max_size),
+                                  boundary, spool_size, max_field_size,
+                                  max_parts)
+    else:
+        result = ([], [])
+    environ['web3ref.form'] = result
+    return result
+
+def _parse_urlencoded(blocks, max_field_size, max_parts):
+    fields = []
+    def add(pair):
+        if not pair:
+            return
+        if len(fields) >= max_parts:
+            raise FormError('too many fields')
+        name, sep, value = pair.partition(b'=')
+        fields.append((unquote_plus(name), unquote_plus(value)))
+    tail = b''
+    for data in blocks:
+        pairs = (tail + data).split(b'&')
+        tail = pairs.pop()
+        if len(tail) > max_field_size:
+            raise FormError('form field too large')
+        for pair in pairs:
+            add(pair)
+    add(tail)
+    return fields
+
+_PREAMBLE, _HEADERS, _CONTENT, _EPILOGUE = range(4)
+
+def _parse_multipart(blocks, boundary, spool_size, max_field_size,
+                     max_parts, max_header_size=16384):
+    fields = []
+    files = []
+    # Every boundary is preceded by CRLF, so pretend the first one is too
+    delimiter = b'\r\n--' + boundary
+    keep = len(delimiter) + 4       # could be the start of a delimiter line
+    buf = b'\r\n'
+    state = _PREAMBLE
+    part = None
+    try:
+        for data in blocks:
+            buf += data
+            while 1:
+                if state == _CONTENT:
+                    # bytes.find() is a fast (Boyer-Moore-Horspool style)
+                    # search, so scanning large uploads stays cheap
+                    end = buf.find(delimiter)
+                    if end < 0:
+                        if len(buf) > keep:
+                            part.write(buf[:-keep])
+                            buf = buf[-keep:]
+                        break
+                    part.write(buf[:end])
+                    part.finish(fields, files)
+                    part = None
+                    buf = buf[end:]
+                    state = _PREAMBLE
+                if state == _PREAMBLE:
+                    start = buf.find(delimiter)
+                    if start < 0:
+                        buf = buf[-keep:]       # discard the preamble
+                        break
+                    after = buf[start + len(delimiter):]
+                    if len(after) < 2:
+                        break
+                    if after[:2] == b'--':
+                        state = _EPILOGUE
+                        break
+                    end = after.find(b'\r\n')
+                    if end < 0:
+                        if len(after) > 1024:
+                            raise FormError('malformed multipart boundary')
+                        break
+                    if after[:end].strip(b' \t'):
+                        raise FormError('malformed multipart boundary')
+                    buf = after[end + 2:]
+                    state = _HEADERS
+                if state == _HEADERS:
+                    if buf[:2] == b'\r\n':
+                        head, buf = b'', buf[2:]  # a part without headers
+                    else:
+                        end = buf.find(b'\r\n\r\n')
+                        if end < 0:
+                            if len(buf) > max_header_size:
+                                raise FormError('multipart headers too large')
+                            break
+                        head, buf = buf[:end], buf[end + 4:]
+                    if len(fields) + len(files) >= max_parts:
+                        raise FormError('too many parts')
+                    part = _PartReader(head, spool_size, max_field_size)
+                    state = _CONTENT
+                if state == _EPILOGUE:
+                    break
+            if state == _EPILOGUE:
+                buf = b''                       # ignore anything after it
+        if state != _EPILOGUE:
+            raise FormError('multipart body truncated')
+    except:
+        if part is not None:
+            part.discard()
+        for name, upload in files:
+            upload.close()
+        raise
+    return fields, files
+
+class _PartReader:
+    """Collects one multipart part's content while it streams in"""
+
+    def __init__(self, head, spool_size, max_field_size):
+        self.headers = []
+        for line in head and head.split(b'\r\n') or ():
+            name, sep, value = line.partition(b':')
+            if not sep:
+                raise FormError('malformed multipart header')
+            self.headers.append((name.strip().lower(), value.strip()))
+        self.name = self.filename = None
+        for name, value in self.headers:
+            if name == b'content-disposition':
+                disposition, options = parse_options(value)
+                self.name = options.get(b'name')
+                self.filename = options.get(b'filename')
+        if self.name is None:
+            raise FormError('multipart part without a name')
+        self.size = 0
+        self.max_field_size = max_field_size
+        if self.filename is None:
+            self.chunks = []
+            self.file = None
+        else:
+            self.file = SpooledTemporaryFile(spool_size)
+
+    def write(self, data):
+        if not data:
+            return
+        self.size += len(data)
+        if self.file is not None:
+            self.file.write(data)
+        elif self.size > self.max_field_size:
+            raise FormError('form field too large')
+        else:
+            self.chunks.append(data)
+
+    def finish(self, fields, files):
+        if self.file is None:
+            fields.append((self.name, b''.join(self.chunks)))
+        else:
+            self.file.seek(0)
+            files.append((self.name, Part(self.name, self.filename,
+                                          self.headers, self.file,
+                                          self.size)))
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
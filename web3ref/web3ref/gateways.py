@@ -0,0 +1,222 @@
+"""SCGI and uwsgi protocol servers for Web3 applications
+
+Usage::
+
+    from web3ref.gateways import make_scgi_server, make_uwsgi_server
+    server = make_scgi_server('/run/app.sock', app, threads=8)
+    server = make_uwsgi_server(('127.0.0.1', 3031), app, processes=4)
+    server.serve_forever()
+
+Both protocols have the front-end web server send the request's CGI
+environment as ready-made key/value pairs, followed by the request body, so
+no HTTP parsing happens here: the pairs go straight into the environ as
+bytes and the body becomes a length-delimited 'web3.input'.  An address is
+either a '(host, port)' tuple or the path of a Unix domain socket.
+Concurrency is configured with the 'threads' and 'processes' options of
+'workers.WorkerMixIn'.
+"""
+
+import os
+import struct
+import sys
+try:
+    from socketserver import StreamRequestHandler
+    from socketserver import TCPServer
+    from socketserver import UnixStreamServer
+except ImportError:     # Python 2
+    from SocketServer import StreamRequestHandler
+    from SocketServer import TCPServer
+    from SocketServer import UnixStreamServer
+
+from web3ref.handlers import BaseCGIHandler
+from web3ref.handlers import SimpleHandler
+from web3ref.util import LimitedInput
+from web3ref.workers import WorkerMixIn
+
+__all__ = [
+    'SCGIHandler', 'UWSGIHandler', 'SCGIRequestHandler',
+    'UWSGIRequestHandler', 'GatewayServer', 'UnixGatewayServer',
+    'make_server', 'make_scgi_server', 'make_uwsgi_server',
+]
+
+_native = bytes is not str      # environ keys must be native strings
+
+class SCGIHandler(BaseCGIHandler):
+    """BaseCGIHandler for a request received over SCGI
+
+    SCGI responses are CGI-style (a 'Status:' header rather than a status
+    line), and the front-end supplies the complete environment.
+    """
+
+    os_environ = {}
+
+class UWSGIHandler(SimpleHandler):
+    """SimpleHandler for a request received over the uwsgi protocol
+
+    uwsgi front-ends expect a complete HTTP response, status line included.
+    """
+
+    os_environ = {}
+
+class GatewayRequestHandler(StreamRequestHandler):
+    """Serve one request whose environment arrives pre-parsed
+
+    Subclasses implement 'read_environ()' for their wire format.
+    """
+
+    handler_class = None
+
+    def read_environ(self):
+        """Return the request's environ dict, or None if there is none"""
+        raise NotImplementedError
+
+    def get_stderr(self):
+        return sys.stderr
+
+    def log_response(self, status, bytes_sent):
+        """Called when a response is complete; the front-end logs it"""
+
+    def handle(self):
+        try:
+            environ = self.read_environ()
+            if environ is None:
+                return
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except (ValueError, struct.error):
+            return          # garbage from the front-end; just hang up
+        for key in 'SCRIPT_NAME', 'PATH_INFO', 'QUERY_STRING':
+            environ.setdefault(key, b'')
+        environ.setdefault('SERVER_PROTOCOL', b'HTTP/1.0')
+        handler = self.handler_class(
+            LimitedInput(self.rfile, length), self.wfile, self.get_stderr(),
+            environ, multithread=self.server.multithread,
+            multiprocess=self.server.multiprocess,
+        )
+        handler.request_handler = self      # backpointer for logging
+        handler.run(self.server.get_app())
+
+class SCGIRequestHandler(GatewayRequestHandler):
+    """Read a request in SCGI format
+
+    The environment is a netstring of NUL-terminated names and values:
+    '<length>:NAME\\0value\\0...,'.
+    """
+
+    handler_class = SCGIHandler
+    max_header = 1024 * 1024
+
+    def read_environ(self):
+        digits = []
+        while 1:
+            c = self.rfile.read(1)
+            if not c:
+                return None
+            if c == b':':
+                break
+            digits.append(c)
+            if len(digits) > 8:
+                raise ValueError('SCGI header too large')
+        length = int(b''.join(digits))
+        if length > self.max_header:
+            raise ValueError('SCGI header too large')
+        data = self.rfile.read(length + 1)
+        if len(data) != length + 1 or data[-1:] != b',':
+            return None
+        items = data[:-1].split(b'\0')
+        environ = {}
+        for i in range(0, len(items) - 1, 2):
+            name = items[i]
+            if _native:
+                name = name.decode('latin-1')
+            environ[name] = items[i + 1]
+        return environ
+
+_uwsgi_header = struct.Struct('<BHB')
+_uwsgi_length = struct.Struct('<H')
+
+class UWSGIRequestHandler(GatewayRequestHandler):
+    """Read a request in the uwsgi binary format
+
+    A 4-byte header (modifier1, little-endian 16-bit size, modifier2) is
+    followed by 'size' bytes of variables, each name and value preceded by
+    its little-endian 16-bit length.  Only modifier1 0 (a request with its
+    CGI variables) is supported.
+    """
+
+    handler_class = UWSGIHandler
+
+    def read_environ(self):
+        header = self.rfile.read(_uwsgi_header.size)
+        if len(header) < _uwsgi_header.size:
+            return None
+        modifier1, size, modifier2 = _uwsgi_header.unpack(header)
+        if modifier1 != 0:
+            raise ValueError('unsupported uwsgi packet %d' % modifier1)
+        data = self.rfile.read(size)
+        if len(data) < size:
+            return None
+        environ = {}
+        offset = 0
+        unpack = _uwsgi_length.unpack_from
+        while offset < size:
+            length = unpack(data, offset)[0]
+            offset += 2
+            name = data[offset:offset + length]
+            offset += length
+            length = unpack(data, offset)[0]
+            offset += 2
+            value = data[offset:offset + length]
+            offset += length
+            if _native:
+                name = name.decode('latin-1')
+            environ[name] = value
+        return environ
+
+class _GatewayServerMixin(WorkerMixIn):
+
+    allow_reuse_address = True
+
+    application = None
+
+    def get_app(self):
+        return self.application
+
+    def set_app(self, application):
+        self.application = application
+
+class GatewayServer(_GatewayServerMixin, TCPServer):
+    """Protocol server listening on a TCP '(host, port)' address"""
+
+class UnixGatewayServer(_GatewayServerMixin, UnixStreamServer):
+    """Protocol server listening on a Unix domain socket path"""
+
+    def server_bind(self):
+        """Replace a stale socket file left behind by a previous run"""
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+        UnixStreamServer.server_bind(self)
+
+def make_server(address, app, handler_class, threads=8, processes=1,
+                server_class=None):
+    """Create a server for 'app' on a '(host, port)' or socket path"""
+    if server_class is None:
+        if isinstance(address, tuple):
+            server_class = GatewayServer
+        else:
+            server_class = UnixGatewayServer
+    server = server_class(address, handler_class)
+    server.set_workers(threads, processes)
+    server.set_app(app)
+    return server
+
+def make_scgi_server(address, app, threads=8, processes=1, **kw):
+    """Create an SCGI server; see 'make_server'"""
+    return make_server(address, app, SCGIRequestHandler, threads, processes,
+                       **kw)
+
+def make_uwsgi_server(address, app, threads=8, processes=1, **kw):
+    """Create a uwsgi protocol server; see 'make_server'"""
+    return make_server(address, app, UWSGIRequestHandler, threads, processes,
+                       **kw)
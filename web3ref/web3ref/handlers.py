@@ -1,16 +1,32 @@
 """Base classes for server/gateway implementations"""
 
-import locale
+import errno
 import os
+import select
 import sys
+import threading
 import time
+from collections import deque
+from datetime import date
+from socket import timeout as socket_timeout
 from traceback import print_exception
+try:
+    from queue import Queue
+except ImportError:     # Python 2
+    from Queue import Queue
 
+from web3ref.util import FileWrapper
 from web3ref.util import guess_scheme
 from web3ref.util import is_hop_by_hop
 from web3ref.util import CRLF
 
-__all__ = ['BaseHandler', 'SimpleHandler', 'BaseCGIHandler', 'CGIHandler']
+__all__ = [
+    'BaseHandler', 'SimpleHandler', 'ReusableHandler', 'HandlerPool',
+    'BaseCGIHandler', 'CGIHandler', 'OffloadedApp',
+]
+
+# Zero-copy file transmission (Python 3.3+ on most Unixes)
+_sendfile = getattr(os, 'sendfile', None)
 
 # Weekday and month names for HTTP date/time formatting; always English!
 _weekdayname = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
@@ -29,21 +45,153 @@ def format_date_time(timestamp):
         # Python 2
         return date
 
+# Parsed If-Modified-Since values; clients revalidating the same resource
+# send the same date over and over, so this is small and very effective.
+_parsed_dates = {}
+_parsed_dates_max = 256
+
+_months = dict((name, number) for number, name in enumerate(
+    [b'jan', b'feb', b'mar', b'apr', b'may', b'jun',
+     b'jul', b'aug', b'sep', b'oct', b'nov', b'dec'], 1))
+_epoch = date(1970, 1, 1).toordinal()
+
+def _parse_http_date(value):
+    # 'Sun, 06 Nov 1994 08:49:37 GMT', 'Sunday, 06-Nov-94 08:49:37 GMT' or
+    # 'Sun Nov  6 08:49:37 1994'; parsed by hand, as email.utils is slow to
+    # import and does far more than this needs
+    fields = value.replace(b',', b' ').replace(b'-', b' ').split()
+    if fields[1][:3].lower() in _months:
+        weekday, month, day, clock, year = fields[:5]
+    else:
+        weekday, day, month, year, clock = fields[:5]
+    month = _months[month[:3].lower()]
+    year = int(year)
+    if year < 100:
+        year += year < 70 and 2000 or 1900
+    hour, minute, second = [int(part) for part in clock.split(b':')]
+    days = date(year, month, int(day)).toordinal() - _epoch
+    return ((days * 24 + hour) * 60 + minute) * 60 + second
+
+def parse_date_time(value):
+    """Return the timestamp for an HTTP date, or None if it can't be parsed
+
+    This is the inverse of 'format_date_time', but also accepts the obsolete
+    RFC 850 and asctime() formats.  Results are remembered in a small cache.
+    """
+    try:
+        return _parsed_dates[value]
+    except KeyError:
+        pass
+    try:
+        timestamp = _parse_http_date(value)
+    except (KeyError, IndexError, TypeError, ValueError, OverflowError):
+        timestamp = None
+    if len(_parsed_dates) >= _parsed_dates_max:
+        _parsed_dates.clear()
+    _parsed_dates[value] = timestamp
+    return timestamp
+
+# Pre-serialized response lines.  Most responses repeat the same handful of
+# status lines and headers ('200 OK', 'Content-Type: text/html; ...'), so
+# these are interned as complete lines.  A dict that fills up (with values
+# that turn out to be unique after all) is cleared, as '_parsed_dates' is,
+# so the common lines get back in.
+_status_lines = {}
+_header_lines = {}
+_line_cache_max = 1024
+
+# Headers whose values are (nearly) unique per response; never interned
+_volatile_headers = {
+    b'age':1, b'content-length':1, b'content-md5':1, b'content-range':1,
+    b'date':1, b'etag':1, b'expires':1, b'last-modified':1, b'location':1,
+    b'set-cookie':1,
+    }
+
+def status_line(http_version, status):
+    """Return the complete 'HTTP/x.y status' line, with its CRLF"""
+    try:
+        return _status_lines[http_version, status]
+    except KeyError:
+        line = b'HTTP/' + http_version + b' ' + status + CRLF
+        if len(_status_lines) >= _line_cache_max:
+            _status_lines.clear()
+        _status_lines[http_version, status] = line
+        return line
+
+def header_line(header):
+    """Return the complete 'name: value' line for a header tuple
+
+    'header' is the '(name, value)' pair itself, which doubles as the cache
+    key, so that a cache hit costs no allocation at all.
+    """
+    try:
+        return _header_lines[header]
+    except KeyError:
+        name, value = header
+        line = name + b': ' + value + CRLF
+        if name.lower() not in _volatile_headers:
+            if len(_header_lines) >= _line_cache_max:
+                _header_lines.clear()
+            _header_lines[header] = line
+        return line
+    except TypeError:
+        # not hashable (e.g. a list); let the concatenation complain
+        name, value = header
+        return name + b': ' + value + CRLF
+
+_date_line = (None, None)
+
+def date_line(timestamp):
+    """Return the 'Date' header line for 'timestamp', cached per second"""
+    global _date_line
+    second = int(timestamp)
+    cached_second, line = _date_line
+    if cached_second != second:
+        line = b'Date: ' + format_date_time(second) + CRLF
+        _date_line = (second, line)
+    return line
+
 def get_environ():
-    d = {}
-    for k, v in os.environ.items():
-        # Python 3 compatibility
-        if not isinstance(v, bytes):
-            # We must explicitly encode the string to bytes under 
-            # Python 3.1+
-            encoding = locale.getpreferredencoding()
-            v = v.encode(encoding, 'surrogateescape')
-        d[k] = v
-    return d
-
-class BaseHandler:
+    environb = getattr(os, 'environb', None)
+    if environb is None:
+        return dict(os.environ)     # Python 2: already bytes
+    # Python 3: native string keys, with the original bytes as values
+    return dict((key.decode(sys.getfilesystemencoding(), 'surrogateescape'),
+                 value) for key, value in environb.items())
+
+def check_response(status, headers):
+    """Raise AssertionError unless 'status' and 'headers' are valid Web3"""
+    if not isinstance(status, bytes):
+        raise AssertionError(
+            "Status must be bytes: %r" % status)
+    if not len(status)>=4:
+        raise AssertionError(
+            "Status must be at least 4 characters: %r" % status)
+    if not int(status[:3]):
+        raise AssertionError(
+            "Status message must begin w/3-digit code: %r" % status)
+    if not status[3:4]==b" ":
+        raise AssertionError(
+            "Status message must have a space after code: %r" % status)
+
+    for name, val in headers:
+        if not isinstance(name, bytes):
+            raise AssertionError(
+                "Header names must be bytes: %r" % name)
+        if not isinstance(val, bytes):
+            raise AssertionError(
+                "Header values must be bytes: %r" % val)
+        if is_hop_by_hop(name):
+            raise AssertionError(
+                "Hop-by-hop headers not allowed: %r" % name)
+
+class BaseHandler(object):
     """Manage the invocation of a WEB3 application"""
 
+    # No instance dict here, so that subclasses can be fully slotted (see
+    # ReusableHandler); subclasses that don't declare __slots__ get one.
+    __slots__ = ()
+
     # Configuration parameters; can override per-subclass or per-instance
     web3_version = (1,0)
     web3_multithread = True
@@ -62,6 +210,8 @@ class BaseHandler:
 
     # Error handling (also per-subclass or per-instance)
     traceback_limit = None  # Print entire traceback to self.get_stderr()
+    error_reporter = None   # or an 'errorlog.ErrorReporter' to use instead
+    allocation_tracker = None   # or a 'memtrack.AllocationTracker'
     error_status = b"500 Dude, this is whack!"
     error_headers = [(b'Content-Type', b'text/plain')]
     error_body = [b"A server error occurred. Contact the administrator."]
@@ -72,20 +222,32 @@ class BaseHandler:
     headers_sent = False
     headers = None
     bytes_sent = 0
+    request_handler = None  # if set, its log_response() is called by close()
 
     def run(self, application):
         """Invoke the application"""
+        tracker = self.allocation_tracker
+        if tracker is not None:
+            mark = tracker.begin()
+        route = None
         try:
-            self.setup_environ()
-            self.result = application(self.environ)
-            self.finish_response()
-        except:
             try:
-                self.handle_error()
+                self.setup_environ()
+                if tracker is not None:
+                    # before the application rewrites PATH_INFO
+                    route = tracker.route(self.environ)
+                self.result = application(self.environ)
+                self.finish_response()
             except:
-                # If we get an error handling an error, just give up already!
-                self.close()
-                raise   # ...and let the actual server figure it out.
+                try:
+                    self.handle_error()
+                except:
+                    # If we get an error handling an error, just give up!
+                    self.close()
+                    raise   # ...and let the actual server figure it out.
+        finally:
+            if tracker is not None:
+                tracker.end(mark, route)
 
     def setup_environ(self):
         """Set up the environment for one request"""
@@ -123,42 +285,43 @@ class BaseHandler:
 
         status, headers, body = self.result
 
-        if not isinstance(status, bytes):
-            raise AssertionError(
-                "Status must be bytes: %r" % status)
-        if not len(status)>=4:
-            raise AssertionError(
-                "Status must be at least 4 characters: %r" % status)
-        if not int(status[:3]):
-            raise AssertionError(
-                "Status message must begin w/3-digit code: %r" % status)
-        if not status[3:4]==b" ":
-            import pdb; pdb.set_trace()
-            raise AssertionError(
-                "Status message must have a space after code: %r" % status)
-
-        for name, val in headers:
-            if not isinstance(name, bytes):
-                raise AssertionError(
-                    "Header names must be bytes: %r" % name)
-            if not isinstance(val, bytes):
-                raise AssertionError(
-                    "Header values must be bytes: %r" % val)
-            if is_hop_by_hop(name):
-                raise AssertionError(
-                    "Hop-by-hop headers not allowed: %r" % name)
+        check_response(status, headers)
 
         self.status = status
         self.headers = headers
         self.body = body
 
-        self.send_headers()
-
-        for data in body:
-            self.write(data)
-
+        if getattr(self.request_handler, 'upgraded', False):
+            # The application took the connection over (see the server's
+            # 'web3ref.upgrade'), so the response is only used for logging
+            self.headers_sent = True
+        else:
+            self.send_headers()
+            self.send_body()
         self.close()
 
+    def send_body(self):
+        """Transmit 'self.body', with 'sendfile()' or by iterating over it"""
+        body = self.body
+        if not (isinstance(body, FileWrapper) and self.sendfile()):
+            for data in body:
+                self.write(data)
+
+    def sendfile(self):
+        """Platform-specific file transmission
+
+        Override this method in subclasses to support platform-specific
+        file transmission.  It is only called if the application's body
+        ('self.body') is an instance of 'util.FileWrapper', after the headers
+        have been sent.
+
+        This method should return a true value if it was able to actually
+        transmit the wrapped file's contents (adding the count to
+        'self.bytes_sent'), and false if the body should be iterated over
+        normally instead.
+        """
+        return False   # No platform-specific transmission by default
+
     def get_scheme(self):
         """Return the URL scheme being used"""
         return guess_scheme(self.environ)
@@ -173,14 +336,12 @@ class BaseHandler:
         """Transmit version/status/date/server, via self._write()"""
         if self.origin_server:
             if self.client_is_modern():
-                self._write(
-                    b'HTTP/' + self.http_version + b' ' + self.status + CRLF)
+                lines = [status_line(self.http_version, self.status)]
                 if not self.has_header(b'Date'):
-                    self._write(
-                        b'Date: ' + format_date_time(time.time()) + CRLF
-                    )
+                    lines.append(date_line(time.time()))
                 if self.server_software and not self.has_header(b'Server'):
-                    self._write(b'Server: ' + self.server_software + CRLF)
+                    lines.append(b'Server: ' + self.server_software + CRLF)
+                self._write(b''.join(lines))
         else:
             self._write(b'Status: ' + self.status + CRLF)
 
@@ -206,17 +367,30 @@ class BaseHandler:
             if hasattr(self.body, 'close'):
                 self.body.close()
         finally:
-            self.result=self.body=self.headers=self.status=self.environ = None
-            self.bytes_sent = 0; self.headers_sent = False
+            try:
+                if self.request_handler is not None and self.status:
+                    self.request_handler.log_response(self.status,
+                                                      self.bytes_sent)
+            finally:
+                self.result = self.body = self.headers = None
+                self.status = self.environ = None
+                self.bytes_sent = 0; self.headers_sent = False
+
+    def get_write_timeout(self):
+        """Seconds to wait for the client to accept output, or None"""
+        connection = getattr(self.request_handler, 'connection', None)
+        if connection is None:
+            return None
+        return connection.gettimeout()
 
     def send_headers(self):
         """Transmit headers to the client, via self._write()"""
         self.headers_sent = True
         if not self.origin_server or self.client_is_modern():
             self.send_preamble()
-            for k, v in self.headers:
-                self._write(k + b': ' + v + CRLF)
-            self._write(CRLF)
+            lines = [header_line(header) for header in self.headers]
+            lines.append(CRLF)
+            self._write(b''.join(lines))
 
     def client_is_modern(self):
         """True if client can accept status and headers"""
@@ -226,7 +400,12 @@ class BaseHandler:
         """Log the 'exc_info' tuple in the server log
 
         Subclasses may override to retarget the output or change its format.
+        With an 'error_reporter', repeated errors are only counted, and the
+        traceback is written by the reporter's thread.
         """
+        if self.error_reporter is not None:
+            self.error_reporter.report(exc_info, self.traceback_limit)
+            return
         try:
             stderr = self.get_stderr()
             print_exception(
@@ -329,6 +508,155 @@ class SimpleHandler(BaseHandler):
         self.stdout.flush()
         self._flush = self.stdout.flush
 
+    def sendfile(self):
+        """Send a 'FileWrapper' body with os.sendfile(), if possible
+
+        This only works when 'stdout' is backed by a file descriptor (such as
+        a socket) and the wrapped file by an operating system file.
+        """
+        if _sendfile is None:
+            return False
+        file_range = self.body.file_range()
+        if file_range is None:
+            return False
+        try:
+            out = self.stdout.fileno()
+        except (AttributeError, IOError, OSError, ValueError):
+            return False
+        fd, offset, length = file_range
+        self._flush()
+        timeout = self.get_write_timeout()
+        while length > 0:
+            try:
+                sent = _sendfile(out, fd, offset, length)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                # The socket has a timeout set, which select() doesn't know
+                if not select.select([], [out], [], timeout)[1]:
+                    raise socket_timeout('timed out sending the file')
+                continue
+            if not sent:
+                break                           # file shrank underneath us
+            offset += sent
+            length -= sent
+            self.bytes_sent += sent
+        return True
+
+
+class ReusableHandler(BaseHandler):
+    """Slotted SimpleHandler equivalent that is reset and reused
+
+    Creating a SimpleHandler (and its instance dict) for every request adds
+    up at high request rates.  A ReusableHandler has no instance dict, and
+    instead of being thrown away after a request it is 'reset()' with the
+    next request's streams and environment::
+
+        handler = ReusableHandler()
+        handler.reset(inp, out, err, env)
+        handler.run(app)
+        handler.reset(inp2, out2, err2, env2)
+        handler.run(app)
+
+    'close()', which ends every request, drops all per-request state and, if
+    the handler came from a HandlerPool, returns it to that pool.  Because
+    of the slots, configuration attributes such as 'origin_server' or
+    'http_version' can only be changed by subclassing.
+    """
+
+    __slots__ = (
+        'stdin', 'stdout', 'stderr', 'base_env', 'environ',
+        'status', 'result', 'body', 'headers', 'headers_sent', 'bytes_sent',
+        'web3_multithread', 'web3_multiprocess', 'request_handler', 'pool',
+        'error_reporter', 'allocation_tracker', '_write', '_flush',
+    )
+
+    def __init__(self):
+        self.stdin = self.stdout = self.stderr = self.base_env = None
+        self.environ = self.status = self.result = None
+        self.body = self.headers = None
+        self.headers_sent = False
+        self.bytes_sent = 0
+        self.web3_multithread = True
+        self.web3_multiprocess = False
+        self.request_handler = self.pool = self.error_reporter = None
+        self.allocation_tracker = None
+        self._write = self._flush = None
+
+    def reset(self, stdin, stdout, stderr, environ, multithread=True,
+              multiprocess=False):
+        """Prepare for a request; arguments are those of SimpleHandler"""
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.base_env = environ
+        self.web3_multithread = multithread
+        self.web3_multiprocess = multiprocess
+        # Bind once per request rather than rebinding on first use
+        self._write = stdout.write
+        self._flush = stdout.flush
+
+    def get_stdin(self):
+        return self.stdin
+
+    def get_stderr(self):
+        return self.stderr
+
+    def add_cgi_vars(self):
+        self.environ.update(self.base_env)
+
+    sendfile = SimpleHandler.__dict__['sendfile']
+
+    def close(self):
+        """Close the iterable, then drop the request and rejoin the pool"""
+        try:
+            BaseHandler.close(self)
+        finally:
+            if self.stdout is not None:
+                self.stdin = self.stdout = self.stderr = self.base_env = None
+                self.request_handler = self.error_reporter = None
+                self.allocation_tracker = None
+                self._write = self._flush = None
+                pool, self.pool = self.pool, None
+                if pool is not None:
+                    pool.release(self)
+
+class HandlerPool:
+    """Per-thread free lists of ReusableHandler instances
+
+    Usage::
+
+        handler = pool.acquire(inp, out, err, env)
+        handler.run(app)    # returns the handler to the pool when done
+
+    Each thread keeps at most 'size' idle handlers, so the pool needs no
+    locking and a handler never migrates between worker threads.
+    """
+
+    def __init__(self, handler_class=ReusableHandler, size=2):
+        self.handler_class = handler_class
+        self.size = size
+        self.local = threading.local()
+
+    def acquire(self, stdin, stdout, stderr, environ, multithread=True,
+                multiprocess=False):
+        """Return a handler reset for the given request"""
+        free = getattr(self.local, 'free', None)
+        if free:
+            handler = free.pop()
+        else:
+            handler = self.handler_class()
+        handler.reset(stdin, stdout, stderr, environ, multithread,
+                      multiprocess)
+        handler.pool = self
+        return handler
+
+    def release(self, handler):
+        free = getattr(self.local, 'free', None)
+        if free is None:
+            free = self.local.free = []
+        if len(free) < self.size:
+            free.append(handler)
 
 class BaseCGIHandler(SimpleHandler):
 
@@ -375,6 +703,164 @@ class CGIHandler(BaseCGIHandler):
 
     def __init__(self):
         BaseCGIHandler.__init__(
-            self, sys.stdin, sys.stdout, sys.stderr, get_environ(),
+            self, getattr(sys.stdin, 'buffer', sys.stdin),
+            getattr(sys.stdout, 'buffer', sys.stdout), sys.stderr,
+            get_environ(),
             multithread=False, multiprocess=True
         )
+
+
+class OffloadedApp:
+    """Run a synchronous application on a bounded pool of its own threads
+
+    Usage::
+
+        app = OffloadedApp(legacy_app, threads=4, max_queue=16)
+
+    For servers that poll asynchronous responses (see 'web3.async'), e.g.
+    from an event loop, the wrapped application and the iteration over its
+    body run on this pool, so a slow application never blocks the server's
+    thread.  The response is returned as a polling callable; its body
+    yields each chunk as the pool produces it, and an empty chunk when
+    there is none yet, so the server can turn to other connections instead
+    of waiting.  At most 'buffered' chunks are held per response before the
+    application's thread waits for the server to catch up.
+
+    Each OffloadedApp has its own threads, so a slow or stuck application
+    only exhausts its own pool.  Once 'max_queue' requests are waiting for
+    a thread, further requests are answered with 503 straight away.  Where
+    'web3.async' is false the application is simply called.
+    """
+
+    busy_status = b'503 Service Unavailable'
+    busy_headers = [(b'Content-Type', b'text/plain'), (b'Retry-After', b'1')]
+    busy_body = [b'Server is too busy.\n']
+
+    def __init__(self, app, threads=4, max_queue=16, buffered=16):
+        self.app = app
+        self.threads = threads
+        self.max_queue = max_queue
+        self.buffered = buffered
+        self.queued = 0
+        self.lock = threading.Lock()
+        self.queue = None
+        self.pid = None
+
+    def __call__(self, environ):
+        if not environ.get('web3.async'):
+            return self.app(environ)
+        if self.pid != os.getpid():
+            self.start()
+        with self.lock:
+            if self.queued >= self.max_queue:
+                return self.busy_status, self.busy_headers, self.busy_body
+            self.queued += 1
+        environ['web3.multithread'] = True
+        response = _OffloadedResponse(self.app, environ, self.buffered)
+        self.queue.put(response)
+        return response.poll
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = Queue()
+            self.queued = 0
+            for i in range(self.threads):
+                thread = threading.Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+            self.pid = os.getpid()
+
+    def work(self):
+        while 1:
+            response = self.queue.get()
+            with self.lock:
+                self.queued -= 1
+            response.run()
+
+class _OffloadedResponse:
+    """One request of an OffloadedApp, shared by its thread and the server"""
+
+    def __init__(self, app, environ, buffered):
+        self.app = app
+        self.environ = environ
+        self.buffered = buffered
+        self.cond = threading.Condition(threading.Lock())
+        self.head = None        # (status, headers) once the app returned
+        self.chunks = deque()
+        self.error = None
+        self.done = False       # the application's body is exhausted
+        self.closed = False     # the server is done with the response
+
+    def run(self):
+        """Call the application and iterate over its body, in the pool"""
+        cond = self.cond
+        body = None
+        try:
+            try:
+                result = self.app(self.environ)
+                while hasattr(result, '__call__'):
+                    result = result() or result     # poll it here, then
+                    time.sleep(0.001)
+                status, headers, body = result
+                with cond:
+                    self.head = status, headers
+                for data in body:
+                    with cond:
+                        while (len(self.chunks) >= self.buffered and
+                               not self.closed):
+                            cond.wait()
+                        if self.closed:
+                            break
+                        self.chunks.append(data)
+            finally:
+                self.app = self.environ = None
+                if hasattr(body, 'close'):
+                    body.close()
+        except Exception as e:
+            with cond:
+                self.error = e
+        with cond:
+            self.done = True
+
+    def poll(self):
+        """The polling callable returned to the server"""
+        with self.cond:
+            if self.head is None:
+                if self.error is not None:
+                    raise self.error
+                return None
+            status, headers = self.head
+        return status, headers, _OffloadedBody(self)
+
+class _OffloadedBody:
+    """Body of an offloaded response; yields b'' until more is ready"""
+
+    def __init__(self, response):
+        self.response = response
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        response = self.response
+        with response.cond:
+            if response.chunks:
+                data = response.chunks.popleft()
+                response.cond.notify()
+                return data
+            if response.error is not None:
+                raise response.error
+            if response.done or response.closed:
+                raise StopIteration
+            return b''
+
+    __next__ = next     # Python 3
+
+    def close(self):
+        response = self.response
+        with response.cond:
+            response.closed = True
+            response.chunks.clear()
+            response.cond.notify()
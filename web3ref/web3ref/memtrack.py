@@ -0,0 +1,189 @@
+"""Per-route allocation tracking, for finding what makes workers grow
+
+An AllocationTracker measures the memory each request leaves allocated,
+and adds it up per route, i.e. per leading segments of PATH_INFO::
+
+    tracker = AllocationTracker(depth=1, sample=100, path='alloc.txt')
+    server.enable_allocation_tracker(tracker)
+    ...
+    print(tracker.report())
+
+For every request, 'BaseHandler.run()' takes the traced memory and the
+number of allocated blocks before and after it, which costs little.  Every
+'sample'th request is also measured with a pair of 'tracemalloc' snapshots,
+and the call sites whose allocations grew are added to its route's list, so
+'report()' can name the top allocating lines of the routes that allocate
+the most.  Snapshots cover the whole heap, so they are slow: keep 'sample'
+well above one in production.
+
+'tracemalloc' measures the process, not the request: with several requests
+in flight the figures include whatever the other threads allocated
+meanwhile.  Over many requests that evens out between routes, but for
+exact call sites serve one request at a time.  Snapshots are not taken
+while another one is in progress.
+
+The report is served as text by the 'app' method, which can be mounted as
+a stats endpoint, and written to 'path' by 'dump()', which the server calls
+on shutdown.  Requires Python 3.4 or later.
+"""
+
+import sys
+import threading
+from itertools import count
+try:
+    import tracemalloc
+except ImportError:     # Python 2
+    tracemalloc = None
+
+__all__ = ['AllocationTracker', 'RouteStats']
+
+class RouteStats:
+    """What the requests for one route left allocated"""
+
+    def __init__(self):
+        self.requests = 0
+        self.size = 0           # bytes
+        self.blocks = 0
+        self.sampled = 0
+        self.sites = {}         # traceback -> [bytes, blocks], when sampled
+
+class AllocationTracker:
+    """Collects allocation statistics per route; see the module docstring
+
+    Routes are the first 'depth' segments of PATH_INFO; past 'max_routes',
+    new ones are counted under 'other_route'.  Snapshots record 'frames'
+    frames per allocation, and each route keeps its 'max_sites' largest
+    call sites.
+    """
+
+    other_route = b'(other)'
+
+    def __init__(self, depth=1, sample=100, frames=1, max_routes=100,
+                 max_sites=50, path=None):
+        if tracemalloc is None:
+            raise RuntimeError('allocation tracking requires tracemalloc '
+                               '(Python 3.4 or later)')
+        self.depth = depth
+        self.sample = sample
+        self.frames = frames
+        self.max_routes = max_routes
+        self.max_sites = max_sites
+        self.path = path
+        self.routes = {}
+        self.lock = threading.Lock()
+        self.snapshot_lock = threading.Lock()
+        self.counter = count(1)
+        self.filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+        ]
+
+    def route(self, environ):
+        """Return the route of a request"""
+        path = environ.get('PATH_INFO') or b'/'
+        return b'/'.join(path.split(b'/', self.depth + 1)[:self.depth + 1])
+
+    def begin(self):
+        """Start measuring a request; returns what 'end()' needs"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        snapshot = None
+        if self.sample and next(self.counter) % self.sample == 0 and \
+                self.snapshot_lock.acquire(False):
+            snapshot = tracemalloc.take_snapshot()
+        return (tracemalloc.get_traced_memory()[0], sys.getallocatedblocks(),
+                snapshot)
+
+    def end(self, mark, route):
+        """Add up the request started by 'begin()' returning 'mark'
+
+        'route' is what 'route()' returned for the request before the
+        application saw it, or None if there was no environ to take it from.
+        """
+        size, blocks, before = mark
+        size = tracemalloc.get_traced_memory()[0] - size
+        blocks = sys.getallocatedblocks() - blocks
+        diffs = ()
+        if before is not None:
+            try:
+                after = tracemalloc.take_snapshot()
+            finally:
+                self.snapshot_lock.release()
+            key_type = self.frames > 1 and 'traceback' or 'lineno'
+            diffs = after.filter_traces(self.filters).compare_to(
+                before.filter_traces(self.filters), key_type)
+        if route is None:
+            route = b'/'
+        with self.lock:
+            stats = self.routes.get(route)
+            if stats is None:
+                if len(self.routes) >= self.max_routes:
+                    route = self.other_route
+                stats = self.routes.setdefault(route, RouteStats())
+            stats.requests += 1
+            stats.size += size
+            stats.blocks += blocks
+            if before is None:
+                return
+            stats.sampled += 1
+            sites = stats.sites
+            for diff in diffs:
+                if diff.size_diff > 0:
+                    site = sites.get(diff.traceback)
+                    if site is None:
+                        sites[diff.traceback] = [diff.size_diff,
+                                                 diff.count_diff]
+                    else:
+                        site[0] += diff.size_diff
+                        site[1] += diff.count_diff
+            if len(sites) > 2 * self.max_sites:
+                largest = sorted(sites.items(), key=lambda item: item[1][0],
+                                 reverse=True)
+                stats.sites = dict(largest[:self.max_sites])
+
+    def report(self, top=10):
+        """Return the statistics as text, routes allocating most first
+
+        For each route: the requests served, the bytes and blocks they left
+        allocated in all, and the 'top' call sites from sampled requests.
+        """
+        with self.lock:
+            routes = [(route, stats.requests, stats.size, stats.blocks,
+                       stats.sampled, sorted(stats.sites.items(),
+                                             key=lambda item: item[1][0],
+                                             reverse=True)[:top])
+                      for route, stats in self.routes.items()]
+        routes.sort(key=lambda route: route[2], reverse=True)
+        lines = []
+        for route, requests, size, blocks, sampled, sites in routes:
+            lines.append('%s: %d requests, %+d bytes, %+d blocks '
+                         '(%+.1f bytes per request), %d sampled'
+                         % (route.decode('latin-1'), requests, size, blocks,
+                            float(size) / requests, sampled))
+            for traceback, (site_size, site_blocks) in sites:
+                frame = traceback[0]
+                lines.append('    %+d bytes, %+d blocks: %s:%d'
+                             % (site_size, site_blocks, frame.filename,
+                                frame.lineno))
+                for frame in traceback[1:]:
+                    lines.append('        from %s:%d'
+                                 % (frame.filename, frame.lineno))
+        return ''.join([line + '\n' for line in lines])
+
+    def dump(self, path=None):
+        """Write the report to 'path', by default the tracker's own"""
+        path = path or self.path
+        if path:
+            with open(path, 'w') as f:
+                f.write(self.report())
+
+    def reset(self):
+        with self.lock:
+            self.routes = {}
+
+    def app(self, environ):
+        """Web3 application serving the report, as plain text"""
+        return (b'200 OK', [(b'Content-Type', b'text/plain; charset=utf-8'),
+                            (b'Cache-Control', b'no-cache')],
+                [self.report().encode('utf-8')])
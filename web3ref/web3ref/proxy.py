@@ -0,0 +1,281 @@
+"""Reverse proxy application forwarding requests to an upstream HTTP server
+
+Usage::
+
+    from web3ref.proxy import Proxy
+    app = Proxy('http://127.0.0.1:8080/backend', pool_size=16)
+
+The request line, headers and body go upstream, and the upstream response
+comes back as the Web3 response.  Neither body is read into memory: the
+request body is sent in blocks as it is read from 'web3.input', and the
+response body is an iterable reading from the upstream connection.
+
+Connections to each upstream '(host, port)' are kept alive and reused, up
+to 'pool_size' idle ones per host; a connection returns to its pool once
+the server closes the response body, if the response was read to the end.
+Hop-by-hop headers (see 'util.is_hop_by_hop'), and those named in a
+'Connection' header, are not forwarded in either direction.
+
+The Host header sent upstream is that of the request, or the value of an
+'X-Host' header if there is one, as in the PEP's 'proxy_and_timing_support'
+example; with 'preserve_host=False' it names the upstream server instead.
+Override 'route()' to pick the upstream per request.
+"""
+
+import socket
+import threading
+try:
+    from http.client import HTTPConnection
+    from http.client import HTTPException
+except ImportError:     # Python 2
+    from httplib import HTTPConnection
+    from httplib import HTTPException
+
+from web3ref.util import is_hop_by_hop
+from web3ref.util import quote
+
+__all__ = ['Proxy', 'ConnectionPool']
+
+if bytes is str:
+    def _native(value):
+        return value
+
+    def _response_headers(response):
+        # getheaders() would merge repeated headers such as Set-Cookie
+        headers = []
+        for line in response.msg.headers:
+            if line[:1] in ' \t' and headers:
+                name, value = headers[-1]
+                headers[-1] = name, value + ' ' + line.strip()
+            else:
+                name, sep, value = line.partition(':')
+                headers.append((name.strip(), value.strip()))
+        return headers
+else:
+    def _native(value):
+        return value.decode('latin-1')
+
+    def _response_headers(response):
+        return [(name.encode('latin-1'), value.encode('latin-1'))
+                for name, value in response.msg.items()]
+
+# Safe characters in a request path that was already percent-encoded
+_path_safe = b"/%;:@&=+$,!*'()"
+
+# Methods that can be sent again when a reused connection fails (RFC 7231)
+_idempotent = frozenset(['GET', 'HEAD', 'OPTIONS', 'TRACE', 'PUT', 'DELETE'])
+
+# Environ keys of request headers that aren't 'HTTP_*'
+_cgi_headers = {'CONTENT_TYPE': 'Content-Type',
+                'CONTENT_LENGTH': 'Content-Length'}
+
+class ConnectionPool:
+    """Idle persistent connections to one upstream '(host, port)'"""
+
+    def __init__(self, host, port, size=8, timeout=30):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Return an idle connection, or a new one, and whether it's new"""
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), False
+        return HTTPConnection(self.host, self.port, timeout=self.timeout), True
+
+    def release(self, connection):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+class Proxy:
+    """Web3 application forwarding every request to 'upstream'
+
+    'upstream' is an 'http://host[:port][/prefix]' URL; the prefix is put
+    in front of the request's path.  Upstream connections time out after
+    'timeout' seconds, and failures to reach the upstream server are
+    answered with 502.  A request that fails on a reused connection is sent
+    again on a new one only if it has no body and an idempotent method, as
+    the upstream server may have acted on it already.
+    """
+
+    blksize = 65536
+    bad_gateway = b'502 Bad Gateway'
+    bad_request = b'400 Bad Request'
+
+    def __init__(self, upstream, pool_size=8, timeout=30, preserve_host=True):
+        if isinstance(upstream, bytes) and bytes is not str:
+            upstream = upstream.decode('ascii')
+        scheme, sep, rest = upstream.partition('://')
+        if scheme != 'http' or not sep:
+            raise ValueError('upstream must be an http:// URL: %r' % upstream)
+        netloc, sep, prefix = rest.partition('/')
+        host, sep, port = netloc.partition(':')
+        self.host = host
+        self.port = int(port or 80)
+        self.netloc = netloc.encode('ascii')
+        self.prefix = ('/' + prefix).rstrip('/').encode('ascii')
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.preserve_host = preserve_host
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def route(self, environ):
+        """Return the upstream 'host', 'port' and path prefix for a request"""
+        return self.host, self.port, self.prefix
+
+    def get_pool(self, host, port):
+        try:
+            return self.pools[host, port]
+        except KeyError:
+            with self.lock:
+                pool = self.pools.get((host, port))
+                if pool is None:
+                    pool = self.pools[host, port] = ConnectionPool(
+                        host, port, self.pool_size, self.timeout)
+                return pool
+
+    def close(self):
+        """Close all idle upstream connections"""
+        for pool in list(self.pools.values()):
+            pool.close()
+
+    def request_headers(self, environ):
+        """Return the '(name, value)' headers to send upstream"""
+        connection = environ.get('HTTP_CONNECTION', b'')
+        dropped = set([_native(token.strip().lower())
+                       for token in connection.split(b',')])
+        headers = []
+        for key, value in environ.items():
+            if key.startswith('HTTP_'):
+                if key in ('HTTP_HOST', 'HTTP_X_HOST'):
+                    continue
+                name = key[5:].replace('_', '-').title()
+            elif key in _cgi_headers:
+                if not value:
+                    continue
+                name = _cgi_headers[key]
+            else:
+                continue
+            if is_hop_by_hop(name) or name.lower() in dropped:
+                continue
+            headers.append((name, value))
+        host = environ.get('HTTP_X_HOST')
+        if host is None:
+            host = environ.get('HTTP_HOST')
+        if host is None or not self.preserve_host:
+            host = self.netloc
+        headers.append(('Host', host))
+        forwarded = environ.get('REMOTE_ADDR')
+        if forwarded:
+            if 'HTTP_X_FORWARDED_FOR' in environ:
+                forwarded = environ['HTTP_X_FORWARDED_FOR'] + b', ' + forwarded
+                headers = [(name, value) for name, value in headers
+                           if name != 'X-Forwarded-For']
+            headers.append(('X-Forwarded-For', forwarded))
+        return headers
+
+    def __call__(self, environ):
+        host, port, prefix = self.route(environ)
+        # RAW_PATH_INFO is the whole path the client asked for, whatever
+        # SCRIPT_NAME and PATH_INFO were made of it since
+        path = environ.get('RAW_PATH_INFO')
+        if path is None:
+            path = quote(environ.get('SCRIPT_NAME', b'')) + \
+                quote(environ.get('PATH_INFO', b''))
+        path = prefix + quote(path, _path_safe)
+        if environ.get('QUERY_STRING'):
+            path += b'?' + environ['QUERY_STRING']
+        method = _native(environ['REQUEST_METHOD'])
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return self.error(self.bad_request)
+        if length < 0:
+            return self.error(self.bad_request)
+        headers = self.request_headers(environ)
+        pool = self.get_pool(host, port)
+        while 1:
+            connection, new = pool.acquire()
+            try:
+                response = self.send(connection, method, _native(path or b'/'),
+                                     headers, environ['web3.input'], length)
+                break
+            except (socket.error, HTTPException):
+                connection.close()
+                # A pooled connection may have been closed by the upstream
+                # server meanwhile; retry on a new one if nothing was lost
+                # and running the request twice would do no harm
+                if new or length or method not in _idempotent:
+                    return self.error(self.bad_gateway)
+        status = ('%d %s' % (response.status, response.reason))
+        status = status.encode('latin-1')
+        names = response.getheader('connection', '').lower().split(',')
+        dropped = set([name.strip().encode('latin-1') for name in names])
+        headers = [(name, value) for name, value in _response_headers(response)
+                   if not is_hop_by_hop(name) and name.lower() not in dropped]
+        return status, headers, _ProxyBody(response, connection, pool,
+                                           self.blksize)
+
+    def error(self, status):
+        """Return a plain text response for an error 'status'"""
+        return (status, [(b'Content-Type', b'text/plain')],
+                [status[4:] + b'\n'])
+
+    def send(self, connection, method, path, headers, stream, length):
+        """Send the request, streaming its body, and return the response"""
+        connection.putrequest(method, path, skip_host=True,
+                              skip_accept_encoding=True)
+        for name, value in headers:
+            connection.putheader(name, value)
+        connection.endheaders()
+        while length > 0:
+            data = stream.read(min(self.blksize, length))
+            if not data:
+                break
+            connection.send(data)
+            length -= len(data)
+        return connection.getresponse()
+
+class _ProxyBody:
+    """Response body read from the upstream connection as it's iterated"""
+
+    def __init__(self, response, connection, pool, blksize):
+        self.response = response
+        self.connection = connection
+        self.pool = pool
+        self.blksize = blksize
+
+    def __iter__(self):
+        read = getattr(self.response, 'read1', self.response.read)
+        while 1:
+            data = read(self.blksize)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        """Return the connection to the pool if it can be reused"""
+        connection, self.connection = self.connection, None
+        if connection is None:
+            return
+        response = self.response
+        complete = response.isclosed() or response.length == 0
+        if complete and not response.will_close:
+            response.close()
+            self.pool.release(connection)
+        else:
+            connection.close()
@@ -0,0 +1,122 @@
+"""Rate limiting shared by all the worker processes of a server
+
+Wrap an application with RateLimiter to let each client make 'rate'
+requests per second on average, in bursts of up to 'burst'::
+
+    app = RateLimiter(app, rate=10, burst=50)
+
+Requests over the limit are answered with a prebuilt '429 Too Many
+Requests' response, before the application is called.  Clients are told
+apart by REMOTE_ADDR, or by another environ variable such as
+'HTTP_X_REAL_IP' when the server sits behind a proxy.
+
+With pre-forked workers ('WorkerMixIn.set_workers(processes=...)') a limit
+kept per process would be as many times too generous as there are
+processes, and depend on where the kernel happens to send each connection.
+The token buckets are therefore kept in SharedBuckets, a fixed-size hash
+table in anonymous shared memory: create the RateLimiter before the server
+forks, and every worker updates the same table.  Each client key hashes to
+a group of 'ways' slots, which is updated under one of 'stripes' locks
+shared between the processes; when a new client finds its group full, it
+takes over the slot of the client seen longest ago, which forgets that
+client's bucket.  The memory used is fixed: 24 bytes per slot.
+"""
+
+import math
+import mmap
+import multiprocessing
+import struct
+import time
+from hashlib import md5
+
+__all__ = ['RateLimiter', 'SharedBuckets']
+
+_clock = getattr(time, 'monotonic', time.time)  # the same in every process
+_digest = struct.Struct('=QQ')
+
+class SharedBuckets:
+    """Token buckets in shared memory, keyed by bytes
+
+    Each bucket holds up to 'burst' tokens and refills at 'rate' tokens per
+    second; 'take()' takes one.  The table has room for 'slots' buckets.
+    """
+
+    def __init__(self, rate, burst, slots=65536, ways=8, stripes=64):
+        if burst < 1:
+            raise ValueError('burst must be at least 1: %r' % burst)
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.ways = ways
+        self.groups = max(1, slots // ways)
+        self.slot = struct.Struct('=Qdd')   # key hash, tokens, last update
+        self.group = struct.Struct('=' + 'Qdd' * ways)
+        self.memory = mmap.mmap(-1, self.groups * self.group.size)
+        self.locks = [multiprocessing.Lock()
+                      for i in range(min(stripes, self.groups))]
+
+    def take(self, key, now=None):
+        """Take a token from the bucket for 'key'; false if there is none"""
+        fingerprint, index = _digest.unpack(md5(key).digest())
+        fingerprint |= 1        # 0 marks an empty slot
+        group = index % self.groups
+        offset = group * self.group.size
+        if now is None:
+            now = _clock()
+        with self.locks[group % len(self.locks)]:
+            values = self.group.unpack_from(self.memory, offset)
+            victim = oldest = None
+            for i in range(self.ways):
+                if values[3 * i] == fingerprint:
+                    last = values[3 * i + 2]
+                    tokens = values[3 * i + 1] + (now - last) * self.rate
+                    if tokens > self.burst:
+                        tokens = self.burst
+                    allowed = tokens >= 1
+                    if allowed:
+                        tokens -= 1
+                    self.slot.pack_into(self.memory,
+                                        offset + i * self.slot.size,
+                                        fingerprint, tokens, now)
+                    return allowed
+                if oldest is None or values[3 * i + 2] < oldest:
+                    victim, oldest = i, values[3 * i + 2]
+            # A new client, with a full bucket; empty slots are oldest
+            self.slot.pack_into(self.memory, offset + victim * self.slot.size,
+                                fingerprint, self.burst - 1, now)
+            return True
+
+    def close(self):
+        self.memory.close()
+
+class RateLimiter:
+    """Middleware turning away clients that exceed their rate with 429
+
+    'rate' is in requests per second, and 'burst' defaults to one second's
+    worth.  'key' is the environ variable identifying the client; requests
+    without it aren't limited.  Other arguments size the SharedBuckets.
+    """
+
+    def __init__(self, app, rate, burst=None, key='REMOTE_ADDR',
+                 slots=65536, ways=8, stripes=64):
+        if rate <= 0:
+            raise ValueError('rate must be positive: %r' % rate)
+        self.app = app
+        self.key = key
+        if burst is None:
+            burst = max(1, rate)
+        self.buckets = SharedBuckets(rate, burst, slots, ways, stripes)
+        retry_after = max(1, int(math.ceil(1.0 / rate)))  # for one token
+        self.body = b'Too Many Requests\n'
+        self.headers = (
+            (b'Content-Type', b'text/plain'),
+            (b'Content-Length', str(len(self.body)).encode('ascii')),
+            (b'Retry-After', str(retry_after).encode('ascii')),
+        )
+
+    def __call__(self, environ):
+        key = environ.get(self.key)
+        if key and not self.buckets.take(key):
+            # A list of its own, for middleware that adds headers
+            return (b'429 Too Many Requests', list(self.headers),
+                    [self.body])
+        return self.app(environ)
@@ -7,31 +7,97 @@ For example usage, see the ``if __name__=="__main__"`` block at the end of the
 module.  See also the BaseHTTPServer module docs for other API information.
 """
 
+import os
+import socket
 import sys
-import urllib
+import time
 
-from BaseHTTPServer import BaseHTTPRequestHandler
-from BaseHTTPServer import HTTPServer
-from web3ref.handlers import SimpleHandler
+try:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from socketserver import TCPServer
+except ImportError:     # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import TCPServer
+from web3ref.accesslog import AccessLog
+from web3ref.errorlog import ErrorReporter
+from web3ref.handlers import HandlerPool
+from web3ref.memtrack import AllocationTracker
+from web3ref.streaming import Sender
+from web3ref.streaming import StreamingHandler
 from web3ref.util import to_bytes
+from web3ref.util import unquote
+from web3ref.workers import WorkerMixIn
+from web3ref.workers import enable_reuse_port
+from web3ref.workers import socket_from_fd
 
 __version__ = "0.0"
-__all__ = ['Web3Server', 'Web3RequestHandler', 'demo_app', 'make_server']
+__all__ = [
+    'Web3Server', 'UnixWeb3Server', 'Web3RequestHandler', 'UpgradeError',
+    'UpgradedConnection', 'demo_app', 'make_server',
+]
+
+if bytes is str:
+    def _raw(value):
+        return value
+else:
+    def _raw(value):
+        """Return the bytes http.server decoded 'value' from"""
+        return value.encode('latin-1')
 
 server_version = "Web3Server/" + __version__
 sys_version = "Python/" + sys.version.split()[0]
 software_version = server_version + ' ' + sys_version
 
-class Web3Server(HTTPServer):
-    """BaseHTTPServer that implements the Web3 protocol"""
+class Web3Server(WorkerMixIn, HTTPServer):
+    """BaseHTTPServer that implements the Web3 protocol
+
+    Requests are served one at a time unless a thread pool or pre-forked
+    worker processes are configured with 'set_workers()'.  Timeouts, size
+    limits and load shedding are configured with 'set_limits()', access
+    logging with 'enable_access_log()', rate-limited error logging with
+    'enable_error_reporter()' and per-route allocation statistics with
+    'enable_allocation_tracker()'.
+    """
 
     application = None
+    sender = None       # see 'enable_streaming()'
+    access_log = None   # see 'enable_access_log()'
+    error_reporter = None   # see 'enable_error_reporter()'
+    allocation_tracker = None   # see 'enable_allocation_tracker()'
+
+    header_timeout = None       # seconds to receive request line and headers
+    body_timeout = None         # seconds of silence while reading or writing
+    max_request_line = 65536
+    max_header_size = 262144    # request line and headers together
+    retry_after = 1             # seconds, for clients turned away with 503
 
     def server_bind(self):
         """Override server_bind to store the server name."""
+        if self.reuse_port:
+            enable_reuse_port(self.socket)
         HTTPServer.server_bind(self)
         self.setup_environ()
 
+    def adopt_socket(self, sock, host=None, port=None):
+        """Serve on 'sock', an already bound and listening socket
+
+        Use this instead of binding (create the server with
+        'bind_and_activate=False').  For sockets that have no host and port
+        of their own, 'host' and 'port' supply SERVER_NAME and SERVER_PORT.
+        """
+        self.socket.close()
+        self.socket = sock
+        self.server_address = sock.getsockname()
+        if isinstance(self.server_address, tuple):
+            self.server_name = socket.getfqdn(self.server_address[0])
+            self.server_port = self.server_address[1]
+        else:
+            self.server_name = host or self.server_name
+            self.server_port = port or self.server_port
+        self.setup_environ()
+
     def setup_environ(self):
         # Set up base environment
         env = self.base_environ = {}
@@ -41,6 +107,7 @@ class Web3Server(HTTPServer):
         env['REMOTE_HOST'] = b''
         env['CONTENT_LENGTH'] = b''
         env['SCRIPT_NAME'] = b''
+        self.detached = set()   # see 'UpgradedConnection.detach()'
 
     def get_app(self):
         return self.application
@@ -48,10 +115,196 @@ class Web3Server(HTTPServer):
     def set_app(self,application):
         self.application = application
 
+    def enable_streaming(self, sender=None):
+        """Have a sender thread deliver responses; see 'web3ref.streaming'
+
+        Request threads are then released once the response is buffered,
+        instead of waiting for the client to receive all of it.
+        """
+        if sender is None:
+            sender = Sender()
+        self.sender = sender
+        self.streamed = set()   # connections the sender will close
+
+    def enable_access_log(self, access_log=None):
+        """Log every request to 'access_log', an 'accesslog.AccessLog'
+
+        By default, requests are logged to stderr in the Common Log Format.
+        """
+        if access_log is None:
+            access_log = AccessLog()
+        self.access_log = access_log
+
+    def enable_error_reporter(self, error_reporter=None):
+        """Have 'error_reporter', an 'errorlog.ErrorReporter', log errors
+
+        Application errors are then logged once per fingerprint and
+        window, from a background thread, instead of printing every
+        traceback to stderr.
+        """
+        if error_reporter is None:
+            error_reporter = ErrorReporter()
+        self.error_reporter = error_reporter
+
+    def enable_allocation_tracker(self, allocation_tracker=None):
+        """Measure the memory each request leaves allocated, per route
+
+        'allocation_tracker' is a 'memtrack.AllocationTracker'; by default,
+        one that only samples one request in a hundred.  Its 'app' method
+        serves the report, and it is dumped on shutdown if it has a 'path'.
+        """
+        if allocation_tracker is None:
+            allocation_tracker = AllocationTracker()
+        self.allocation_tracker = allocation_tracker
+
+    def stop_pool(self):
+        """Stop the thread pool, then write out the rest of the logs"""
+        WorkerMixIn.stop_pool(self)
+        if self.access_log is not None:
+            self.access_log.flush()
+        if self.error_reporter is not None:
+            self.error_reporter.flush()
+        if self.allocation_tracker is not None:
+            self.allocation_tracker.dump()
+
+    def set_limits(self, header_timeout=None, body_timeout=None,
+                   max_request_line=65536, max_header_size=262144,
+                   max_pending=None, retry_after=1):
+        """Bound the time and memory a client can take up
+
+        'header_timeout' is the time allowed for receiving the whole request
+        head, while 'body_timeout' limits each wait for the client after
+        that, as it sends the body or receives the response.  Request lines
+        longer than 'max_request_line' get a 414, and request heads larger
+        than 'max_header_size' a 431.  With a thread pool, 'max_pending'
+        caps the connections waiting for a thread; more are answered at
+        once with a 503 asking the client to come back in 'retry_after'
+        seconds, instead of piling up in the listen backlog.
+        """
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
+        self.max_request_line = max_request_line
+        self.max_header_size = max_header_size
+        self.max_pending = max_pending
+        self.retry_after = retry_after
+
+    def reject_request(self, request, client_address):
+        """Answer 503 without waiting for the request"""
+        response = (
+            b'HTTP/1.0 503 Service Unavailable\r\n'
+            b'Retry-After: ' + to_bytes(self.retry_after) + b'\r\n'
+            b'Content-Type: text/plain\r\n'
+            b'Content-Length: 20\r\n'
+            b'\r\n'
+            b'Server is too busy.\n'
+        )
+        try:
+            request.setblocking(False)
+            request.send(response)
+            request.shutdown(socket.SHUT_WR)
+            # Discard what the client has sent so far, so that closing
+            # doesn't reset the connection before it reads the response
+            while request.recv(65536):
+                pass
+        except socket.error:
+            pass
+        self.close_request(request)
+
+    def shutdown_request(self, request):
+        if self.sender is not None and request in self.streamed:
+            self.streamed.discard(request)
+            return
+        if request in self.detached:
+            self.detached.discard(request)
+            return
+        HTTPServer.shutdown_request(self, request)
+
+class UnixWeb3Server(Web3Server):
+    """Web3Server listening on a Unix domain socket
+
+    Such a socket has no host name or port, so SERVER_NAME and SERVER_PORT
+    come from the 'server_name' and 'server_port' attributes, which should
+    be set to the public name of the site before binding.
+    """
+
+    address_family = socket.AF_UNIX
+
+    server_name = 'localhost'
+    server_port = 80
+
+    def server_bind(self):
+        """Replace a stale socket file left behind by a previous run"""
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+        TCPServer.server_bind(self)
+        self.setup_environ()
+
+class UpgradeError(Exception):
+    """The connection can't be upgraded (any more)"""
+
+class UpgradedConnection:
+    """A connection taken over by the application with 'web3ref.upgrade'
+
+    'socket' is the client's socket, for the application to speak the new
+    protocol on.  By default, the server closes it once the application
+    returns; to keep using it after that (e.g. from an event loop of its
+    own), call 'detach()' first.
+    """
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.socket = sock
+
+    def detach(self):
+        """Keep the socket open after the request; closing it is now up to
+        the application"""
+        self.server.detached.add(self.socket)
+
+class RequestHeadTooLarge(Exception):
+    """The request line and headers exceed 'max_header_size'"""
+
+class HeadReader:
+    """Stand-in for 'rfile' while the request head is read
+
+    Enforces the server's 'header_timeout' as a deadline for the whole head,
+    and its 'max_header_size'.
+    """
+
+    def __init__(self, rfile, sock, timeout, limit):
+        self.rfile = rfile
+        self.sock = sock
+        self.deadline = None
+        if timeout is not None:
+            self.deadline = time.time() + timeout
+        self.left = limit
+
+    def readline(self, size=-1):
+        if self.deadline is not None:
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout('timed out')
+            self.sock.settimeout(remaining)
+        if size < 0 or size > self.left + 1:
+            size = self.left + 1
+        line = self.rfile.readline(size)
+        self.left -= len(line)
+        if self.left < 0:
+            raise RequestHeadTooLarge()
+        return line
+
 class Web3RequestHandler(BaseHTTPRequestHandler):
 
     server_version = "Web3Server/" + __version__
 
+    # Handlers are recycled per worker thread instead of created per request
+    handler_pool = HandlerPool()
+    streaming_pool = HandlerPool(StreamingHandler)
+
+    output = None           # the StreamOutput, when streaming
+    upgraded = False        # see 'upgrade()'
+
     def get_environ(self):
         env = self.server.base_environ.copy()
         env['SERVER_PROTOCOL'] = to_bytes(self.request_version)
@@ -61,14 +314,18 @@ class Web3RequestHandler(BaseHTTPRequestHandler):
         else:
             path, query = self.path, ''
 
-        env['PATH_INFO'] = to_bytes(urllib.unquote(path))
-        env['RAW_PATH_INFO'] = to_bytes(path)
-        env['QUERY_STRING'] = to_bytes(query)
+        path = _raw(path)
+        env['PATH_INFO'] = unquote(path)
+        env['RAW_PATH_INFO'] = path
+        env['QUERY_STRING'] = _raw(query)
 
-        host = self.address_string()
-        if host != self.client_address[0]:
-            env['REMOTE_HOST'] = to_bytes(host)
-        env['REMOTE_ADDR'] = to_bytes(self.client_address[0])
+        if isinstance(self.client_address, tuple):
+            host = self.address_string()
+            if host != self.client_address[0]:
+                env['REMOTE_HOST'] = to_bytes(host)
+            env['REMOTE_ADDR'] = to_bytes(self.client_address[0])
+        else:
+            env['REMOTE_ADDR'] = b''    # the peer of a Unix domain socket
 
         typeheader = self.headers.get('content-type')
 
@@ -81,6 +338,9 @@ class Web3RequestHandler(BaseHTTPRequestHandler):
         if length:
             env['CONTENT_LENGTH'] = to_bytes(length)
 
+        if self.headers.get('upgrade') and self.request_version == 'HTTP/1.1':
+            env['web3ref.upgrade'] = self.upgrade
+
         headers = self.headers.items()
 
         for k, v in headers:
@@ -97,18 +357,120 @@ class Web3RequestHandler(BaseHTTPRequestHandler):
     def get_stderr(self):
         return sys.stderr
 
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return BaseHTTPRequestHandler.address_string(self)
+        return 'unix:' + str(self.server.server_address)
+
+    def log_request(self, code='-', size='-'):
+        """Log an error response sent by BaseHTTPRequestHandler"""
+        access_log = self.server.access_log
+        if access_log is None:
+            BaseHTTPRequestHandler.log_request(self, code, size)
+            return
+        if not isinstance(code, str):
+            code = str(int(code))
+        self.log_response(code, size)
+
+    def log_response(self, status, bytes_sent):
+        """Called by the handler once the response is complete"""
+        access_log = self.server.access_log
+        if access_log is not None:
+            if isinstance(self.client_address, tuple):
+                remote_addr = self.client_address[0]
+            else:
+                remote_addr = ''
+            access_log.record(self.start_time, remote_addr, self.requestline,
+                              status[:3], bytes_sent,
+                              time.time() - self.start_time)
+
+    def upgrade(self, headers=()):
+        """The 'web3ref.upgrade' extension: switch protocols
+
+        Sends '101 Switching Protocols' with 'headers', a list of '(name,
+        value)' tuples such as '(b'Upgrade', b'websocket')', which unlike
+        those of a response may be hop-by-hop; then returns an
+        UpgradedConnection.  From then on, the connection belongs to the
+        application, and the response it returns is only logged.  Offered
+        for HTTP/1.1 requests with an 'Upgrade' header.
+        """
+        if self.upgraded:
+            raise UpgradeError('connection already upgraded')
+        if self.output is not None:
+            if self.output.buffered or self.output.closed:
+                raise UpgradeError('response already started')
+            self.output.release()
+            self.server.streamed.discard(self.request)
+        lines = [b'HTTP/1.1 101 Switching Protocols\r\n']
+        for name, value in headers:
+            lines.append(name + b': ' + value + b'\r\n')
+        lines.append(b'\r\n')
+        self.wfile.write(b''.join(lines))
+        self.wfile.flush()
+        self.upgraded = True
+        self.close_connection = True
+        return UpgradedConnection(self.server, self.request)
+
     def handle(self):
         """Handle a single HTTP request"""
-        self.raw_requestline = self.rfile.readline()
-        if not self.parse_request(): # An error code has been sent, just exit
+        self.start_time = time.time()
+        if not self.read_head():
             return
 
-        handler = SimpleHandler(
-            self.rfile, self.wfile, self.get_stderr(), self.get_environ()
+        sender = self.server.sender
+        if sender is None:
+            pool, stdout = self.handler_pool, self.wfile
+            self.output = None
+        else:
+            self.server.streamed.add(self.request)
+            pool, stdout = self.streaming_pool, sender.stream(self.request)
+            self.output = stdout
+        self.upgraded = False
+        handler = pool.acquire(
+            self.rfile, stdout, self.get_stderr(), self.get_environ(),
+            multithread=self.server.multithread,
+            multiprocess=self.server.multiprocess,
         )
         handler.request_handler = self      # backpointer for logging
+        handler.error_reporter = self.server.error_reporter
+        handler.allocation_tracker = self.server.allocation_tracker
         handler.run(self.server.get_app())
 
+    def read_head(self):
+        """Read and parse the request line and headers
+
+        Returns false, having sent any error response, if the request
+        can't be served.
+        """
+        server = self.server
+        rfile = self.rfile
+        self.rfile = HeadReader(rfile, self.connection, server.header_timeout,
+                                server.max_header_size)
+        try:
+            try:
+                self.raw_requestline = self.rfile.readline(
+                    server.max_request_line + 1)
+                if len(self.raw_requestline) > server.max_request_line:
+                    self.requestline = ''
+                    self.request_version = ''
+                    self.command = ''
+                    self.send_error(414)
+                    return False
+                if not self.parse_request():
+                    return False    # An error code has been sent
+            except socket.timeout:
+                self.log_error('Request timed out')
+                return False
+            except RequestHeadTooLarge:
+                self.send_error(431, 'Request Header Fields Too Large')
+                return False
+        finally:
+            self.rfile = rfile
+        if server.header_timeout is not None or \
+                server.body_timeout is not None:
+            self.connection.settimeout(server.body_timeout)
+        return True
+
 def demo_app(environ):
     result = b'Hello world!'
     headers = [
@@ -121,18 +483,87 @@ def make_server(
     host,
     port,
     app,
-    server_class=Web3Server,
-    handler_class=Web3RequestHandler
+    server_class=None,
+    handler_class=Web3RequestHandler,
+    threads=0,
+    processes=1,
+    path=None,
+    fd=None,
+    reuse_port=False,
+    max_requests=0,
+    max_rss=0,
+    streaming=False,
+    access_log=False,
     ):
-    """Create a new WSGI server listening on `host` and `port` for `app`"""
-    server = server_class((host, port), handler_class)
+    """Create a new WSGI server listening on `host` and `port` for `app`
+
+    `threads` and `processes` configure a thread pool and pre-forked worker
+    processes; see `web3ref.workers`.
+
+    To listen on a Unix domain socket instead, pass its `path`.  To serve on
+    an already bound and listening socket inherited from the parent process
+    (see `web3ref.workers.listen_fds`), pass its file descriptor as `fd`.
+    In both cases `host` and `port` are only used as SERVER_NAME and
+    SERVER_PORT where the socket itself has none.
+
+    With `reuse_port`, SO_REUSEPORT is set so that several servers can bind
+    the same address and have the kernel balance connections between them;
+    pre-forked workers then each listen on a socket of their own.
+
+    Pre-forked workers are replaced after serving `max_requests` requests,
+    or once their resident memory exceeds `max_rss` bytes.  For graceful
+    restarts by signal, see `web3ref.workers`.
+
+    With `streaming`, a sender thread delivers responses to the clients, so
+    that slow clients don't hold up request threads; see `web3ref.streaming`.
+
+    With `access_log`, every request is logged to stderr from a background
+    thread; pass a `web3ref.accesslog.AccessLog` to choose the stream and
+    format.
+    """
+    if fd is not None:
+        sock = socket_from_fd(fd)
+        if server_class is None:
+            if sock.family == socket.AF_UNIX:
+                server_class = UnixWeb3Server
+            else:
+                server_class = Web3Server
+        server = server_class(sock.getsockname(), handler_class, False)
+        server.adopt_socket(sock, host, port)
+    elif path is not None or reuse_port:
+        if server_class is None:
+            server_class = path is None and Web3Server or UnixWeb3Server
+        if path is None:
+            server = server_class((host, port), handler_class, False)
+        else:
+            server = server_class(path, handler_class, False)
+            server.server_name = host or server.server_name
+            server.server_port = port or server.server_port
+        server.reuse_port = reuse_port
+        try:
+            server.server_bind()
+            server.server_activate()
+        except:
+            server.server_close()
+            raise
+    else:
+        if server_class is None:
+            server_class = Web3Server
+        server = server_class((host, port), handler_class)
+    server.set_workers(threads, processes, max_requests, max_rss)
+    if streaming:
+        server.enable_streaming()
+    if access_log is True:
+        server.enable_access_log()
+    elif access_log:
+        server.enable_access_log(access_log)
     server.set_app(app)
     return server
 
 if __name__ == '__main__':
     httpd = make_server('', 8000, demo_app)
     sa = httpd.socket.getsockname()
-    print "Serving HTTP on", sa[0], "port", sa[1], "..."
+    print("Serving HTTP on %s port %s ..." % (sa[0], sa[1]))
     import webbrowser
     webbrowser.open('http://localhost:8000/xyz?abc')
     httpd.handle_request()  # serve one request, then exit
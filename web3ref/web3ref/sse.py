@@ -0,0 +1,186 @@
+"""Server-Sent Events: long-lived event streams with broadcast fan-out
+
+Usage::
+
+    from web3ref.sse import Channel
+    feed = Channel(heartbeat=15)
+
+    def app(environ):
+        return feed.response()
+
+    feed.publish(b'{"id": 42}', event=b'update', id=b'42')
+
+A Channel broadcasts each event to every open stream: the event is
+serialized once, and the same bytes are offered to all subscribers.  One
+timer thread per channel sends the heartbeat comments that keep idle
+connections (and the proxies in front of them) from timing out, and that
+find clients which have gone away.
+
+With the streaming server ('simple_server.make_server(..., streaming=True)')
+an open stream takes no thread at all: the handler hands the connection's
+'streaming.StreamOutput' to the stream and returns, and from then on the
+sender thread delivers whatever the channel offers.  Clients that fall more
+than the sender's 'high_water' bytes behind are disconnected rather than
+buffered for.  Other servers just iterate over the body, which blocks
+between events, so every open stream holds on to a thread there.
+"""
+
+import threading
+from collections import deque
+
+__all__ = ['Channel', 'EventStream', 'format_event']
+
+def format_event(data, event=None, id=None, retry=None):
+    """Serialize an event in the 'text/event-stream' format, as bytes
+
+    'data' may span several lines; 'retry' is the client's reconnection
+    delay in milliseconds.
+    """
+    lines = []
+    if event is not None:
+        lines.append(b'event: ' + event)
+    if id is not None:
+        lines.append(b'id: ' + id)
+    if retry is not None:
+        lines.append(b'retry: ' + str(int(retry)).encode('ascii'))
+    for line in data.replace(b'\r\n', b'\n').split(b'\n'):
+        lines.append(b'data: ' + line)
+    lines.append(b'\n')
+    return b'\n'.join(lines)
+
+_HEARTBEAT = b':\n\n'       # a comment, ignored by the client
+
+class Channel:
+    """A set of event streams that events are broadcast to
+
+    'heartbeat' is the interval between heartbeat comments, in seconds;
+    'retry' is sent to each new client as its reconnection delay.
+    """
+
+    status = b'200 OK'
+    headers = [
+        (b'Content-Type', b'text/event-stream'),
+        (b'Cache-Control', b'no-cache'),
+    ]
+
+    def __init__(self, heartbeat=15, retry=None, max_queued=1000):
+        self.heartbeat = heartbeat
+        self.retry = retry
+        self.max_queued = max_queued
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.timer = None
+
+    def response(self):
+        """Return a Web3 response for a new stream on this channel"""
+        return self.status, list(self.headers), EventStream(self)
+
+    def subscribe(self, subscriber):
+        """Add an object with 'offer(data)' and 'close()' methods
+
+        'offer()' must not block, and return false if the subscriber is
+        gone; it is then closed and dropped.  Returns false, having closed
+        the subscriber, if the channel is closed.
+        """
+        with self.lock:
+            if self.stopped.is_set():
+                subscriber.close()
+                return False
+            self.subscribers.add(subscriber)
+            if self.heartbeat and (self.timer is None or
+                                   not self.timer.is_alive()):
+                self.timer = threading.Thread(target=self.beat)
+                self.timer.daemon = True
+                self.timer.start()
+        return True
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, data, event=None, id=None):
+        """Send an event to every subscriber"""
+        self.send(format_event(data, event, id))
+
+    def send(self, payload):
+        """Offer 'payload', already serialized, to every subscriber"""
+        with self.lock:
+            subscribers = list(self.subscribers)
+        gone = [subscriber for subscriber in subscribers
+                if not subscriber.offer(payload)]
+        if gone:
+            with self.lock:
+                self.subscribers.difference_update(gone)
+            for subscriber in gone:
+                subscriber.close()
+
+    def beat(self):
+        """Main loop of the heartbeat thread"""
+        while not self.stopped.wait(self.heartbeat):
+            if self.subscribers:
+                self.send(_HEARTBEAT)
+
+    def close(self):
+        """End every stream, and the heartbeat thread"""
+        with self.lock:
+            self.stopped.set()
+            subscribers, self.subscribers = self.subscribers, set()
+        for subscriber in subscribers:
+            subscriber.close()
+
+class EventStream:
+    """Body of an event stream response
+
+    Streaming handlers 'attach()' their output to the channel directly;
+    otherwise, iterating yields the events as they are published, until the
+    channel is closed.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.cond = threading.Condition(threading.Lock())
+        self.queued = deque()
+        self.closed = False
+
+    def opening(self):
+        """Bytes sent first: the reconnection delay, or a comment"""
+        if self.channel.retry is not None:
+            return b'retry: ' + str(int(self.channel.retry)).encode('ascii') \
+                + b'\n\n'
+        return _HEARTBEAT
+
+    def attach(self, output):
+        """Have 'output', a 'streaming.StreamOutput', receive the events"""
+        if self.channel.subscribe(output) and \
+                not output.offer(self.opening()):
+            self.channel.unsubscribe(output)
+            output.close()
+
+    def __iter__(self):
+        self.channel.subscribe(self)
+        yield self.opening()
+        cond = self.cond
+        while 1:
+            with cond:
+                while not self.queued and not self.closed:
+                    cond.wait()
+                if not self.queued:
+                    return
+                data = b''.join(self.queued)
+                self.queued.clear()
+            yield data
+
+    def offer(self, data):
+        with self.cond:
+            if self.closed or len(self.queued) >= self.channel.max_queued:
+                return False
+            self.queued.append(data)
+            self.cond.notify()
+            return True
+
+    def close(self):
+        self.channel.unsubscribe(self)
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
@@ -0,0 +1,454 @@
+"""Web3 application serving static files from a directory
+
+Usage::
+
+    app = StaticFiles('/var/www/assets')
+
+Files are located by traversing PATH_INFO with 'util.shift_path_info', so
+'.' and empty segments are normalized away and '..' is refused.  The stat
+results and open file descriptors of recently served files are kept in a
+bounded LRU cache ('FileCache'), and file bodies are returned as
+'util.FileWrapper' instances that handlers can transmit with sendfile().
+
+Conditional requests ('If-None-Match', 'If-Modified-Since') are answered
+with 304, and 'Range' requests (including 'If-Range' and multiple ranges,
+sent as 'multipart/byteranges') with 206.
+"""
+
+import mimetypes
+import os
+import stat
+import sys
+import threading
+import time
+from binascii import hexlify
+from collections import OrderedDict
+
+from web3ref.conditional import is_not_modified
+from web3ref.handlers import format_date_time
+from web3ref.handlers import parse_date_time
+from web3ref.util import CRLF
+from web3ref.util import FileWrapper
+from web3ref.util import request_uri
+from web3ref.util import shift_path_info
+from web3ref.util import to_bytes
+
+__all__ = ['StaticFiles', 'FileCache', 'FileRange']
+
+_pread = getattr(os, 'pread', None)
+
+class _CachedFile:
+    """Stat result and (for regular files) open descriptor of one path"""
+
+    def __init__(self, path, st, fd, checked):
+        self.path = path
+        self.st = st
+        self.fd = fd
+        self.checked = checked
+        self.refs = 0
+        self.evicted = False
+        self.lock = threading.Lock()    # serializes seek+read without pread
+        if st is not None:
+            self.etag = to_bytes('"%x-%x"' % (int(st.st_mtime), st.st_size))
+            self.last_modified = format_date_time(st.st_mtime)
+
+    def same_file(self, st):
+        return st is not None and self.st is not None and (
+            (st.st_ino, st.st_dev, st.st_size, st.st_mtime) ==
+            (self.st.st_ino, self.st.st_dev, self.st.st_size,
+             self.st.st_mtime))
+
+class FileCache:
+    """Bounded LRU cache of stat results and open file descriptors
+
+    A cached entry is trusted for 'check_interval' seconds; after that the
+    path is stat()ed again and the entry replaced if the file's inode, size
+    or mtime changed.  Missing paths are cached too, so floods of requests
+    for nonexistent files don't each cost a system call.  Descriptors of
+    evicted entries are closed once no response is using them any more.
+    """
+
+    def __init__(self, max_entries=256, check_interval=1.0, timer=time.time):
+        self.max_entries = max_entries
+        self.check_interval = check_interval
+        self.timer = timer
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def acquire(self, path):
+        """Return the entry for 'path' with its reference count increased
+
+        The caller must pass the entry to 'release()' when it is finished
+        with the descriptor.
+        """
+        now = self.timer()
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None and now - entry.checked < self.check_interval:
+                self.entries[path] = entry
+                entry.refs += 1
+                return entry
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+
+        replaced = None
+        if entry is not None and (entry.same_file(st) or
+                                  entry.st is None and st is None):
+            entry.checked = now
+        else:
+            replaced = entry
+            entry = self._open(path, st, now)
+
+        with self.lock:
+            if replaced is not None:
+                self._discard(replaced)
+            current = self.entries.pop(path, None)
+            if current is not None and current is not entry:
+                self._discard(current)
+            self.entries[path] = entry
+            entry.refs += 1
+            while len(self.entries) > self.max_entries:
+                _, evicted = self.entries.popitem(last=False)
+                self._discard(evicted)
+        return entry
+
+    def release(self, entry):
+        with self.lock:
+            entry.refs -= 1
+            if entry.evicted and not entry.refs:
+                self._close(entry)
+
+    def clear(self):
+        with self.lock:
+            for entry in self.entries.values():
+                self._discard(entry)
+            self.entries.clear()
+
+    def _open(self, path, st, now):
+        fd = None
+        if st is not None and stat.S_ISREG(st.st_mode):
+            try:
+                fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+                st = os.fstat(fd)
+            except OSError:
+                st = None
+        return _CachedFile(path, st, fd, now)
+
+    def _discard(self, entry):
+        # called with self.lock held (or before the entry was published)
+        entry.evicted = True
+        if not entry.refs:
+            self._close(entry)
+
+    def _close(self, entry):
+        if entry.fd is not None:
+            os.close(entry.fd)
+            entry.fd = None
+
+class FileRange(FileWrapper):
+    """Iterable over 'length' bytes at 'offset' of a cached file
+
+    Reading uses os.pread() where available, so many responses can share
+    one descriptor; 'file_range()' lets handlers use sendfile() instead.
+    """
+
+    def __init__(self, cache, entry, offset, length, blksize=65536):
+        self.cache = cache
+        self.entry = entry
+        self.offset = offset
+        self.remaining = length
+        self.blksize = blksize
+
+    def __getitem__(self, key):
+        data = self.read()
+        if data:
+            return data
+        raise IndexError
+
+    def next(self):
+        data = self.read()
+        if data:
+            return data
+        raise StopIteration
+
+    __next__ = next     # Python 3
+
+    def read(self):
+        size = min(self.blksize, self.remaining)
+        if size <= 0:
+            return b''
+        entry = self.entry
+        if _pread is not None:
+            data = _pread(entry.fd, size, self.offset)
+        else:
+            with entry.lock:
+                os.lseek(entry.fd, self.offset, os.SEEK_SET)
+                data = os.read(entry.fd, size)
+        self.offset += len(data)
+        self.remaining -= len(data)
+        return data
+
+    def file_range(self):
+        return self.entry.fd, self.offset, self.remaining
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.release(self.entry)
+            self.cache = None
+
+def parse_ranges(value, size):
+    """Parse a 'Range' header value into a list of '(start, end)' pairs
+
+    'end' is exclusive.  Returns None if the header is syntactically
+    invalid (in which case it must be ignored) and an empty list if none of
+    the ranges can be satisfied for a resource of 'size' bytes.
+    """
+    unit, _, spec = value.partition(b'=')
+    if unit.strip().lower() != b'bytes':
+        return None
+    ranges = []
+    for part in spec.split(b','):
+        part = part.strip()
+        if not part:
+            continue
+        first, dash, last = part.partition(b'-')
+        if not dash:
+            return None
+        try:
+            if not first:
+                suffix = int(last)
+                if suffix <= 0:
+                    continue
+                start, end = max(size - suffix, 0), size
+            else:
+                start = int(first)
+                end = size
+                if last:
+                    end = int(last) + 1
+                    if end <= start:
+                        return None
+                    end = min(end, size)
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, end))
+    return ranges
+
+def _coalesce(ranges):
+    """Merge overlapping and adjacent ranges, in ascending order"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+class StaticFiles:
+    """Serve the files below 'root' for GET and HEAD requests
+
+    'index_files' are tried, in order, for requests that name a directory
+    with a trailing slash; directories requested without one are
+    redirected.  Requests with more than 'max_ranges' ranges are served the
+    whole file.
+    """
+
+    default_type = b'application/octet-stream'
+    max_ranges = 16
+
+    def __init__(self, root, index_files=('index.html',), cache=None,
+                 blksize=65536):
+        if not isinstance(root, bytes):
+            root = root.encode(sys.getfilesystemencoding())
+        self.root = os.path.abspath(root)
+        self.index_files = [
+            isinstance(name, bytes) and name or name.encode('ascii')
+            for name in index_files]
+        if cache is None:
+            cache = FileCache()
+        self.cache = cache
+        self.blksize = blksize
+        self.types = {}
+
+    def __call__(self, environ):
+        method = environ.get('REQUEST_METHOD')
+        if method not in (b'GET', b'HEAD'):
+            return self.error(b'405 Method Not Allowed',
+                              [(b'Allow', b'GET, HEAD')])
+
+        names = self.traverse(environ)
+        if names is None:
+            return self.error(b'404 Not Found')
+        path = os.path.join(self.root, *names)
+
+        entry = self.cache.acquire(path)
+        try:
+            if entry.st is not None and stat.S_ISDIR(entry.st.st_mode):
+                if environ.get('PATH_INFO', b'')[-1:] != b'/':
+                    location = request_uri(environ, 0) + b'/'
+                    return self.error(b'301 Moved Permanently',
+                                      [(b'Location', location)])
+                for index in self.index_files:
+                    self.cache.release(entry)
+                    entry = self.cache.acquire(os.path.join(path, index))
+                    if entry.fd is not None:
+                        break
+            if entry.fd is None:
+                return self.error(b'404 Not Found')
+            response = self.respond(environ, entry, method == b'HEAD')
+            entry = None    # now owned by the response body
+            return response
+        finally:
+            if entry is not None:
+                self.cache.release(entry)
+
+    def traverse(self, environ):
+        """Return the path segments named by PATH_INFO, or None if invalid"""
+        env = {'SCRIPT_NAME': b'', 'PATH_INFO': environ.get('PATH_INFO', b'')}
+        names = []
+        while 1:
+            name = shift_path_info(env)
+            if name is None:
+                return names
+            if name == b'..' or b'\0' in name or b'\\' in name:
+                return None
+            if name:
+                names.append(name)
+
+    def content_type(self, path):
+        try:
+            return self.types[path]
+        except KeyError:
+            pass
+        guessed, encoding = mimetypes.guess_type(path.decode('latin-1'))
+        if guessed is None or encoding is not None:
+            ctype = self.default_type
+        else:
+            ctype = guessed.encode('ascii')
+        if len(self.types) < 4096:
+            self.types[path] = ctype
+        return ctype
+
+    def respond(self, environ, entry, head):
+        size = entry.st.st_size
+        ctype = self.content_type(entry.path)
+        headers = [
+            (b'Last-Modified', entry.last_modified),
+            (b'ETag', entry.etag),
+            (b'Accept-Ranges', b'bytes'),
+        ]
+
+        if is_not_modified(environ, entry.etag, entry.st.st_mtime):
+            self.cache.release(entry)
+            return b'304 Not Modified', headers, []
+
+        ranges = None
+        if 'HTTP_RANGE' in environ and self.if_range(environ, entry):
+            ranges = parse_ranges(environ['HTTP_RANGE'], size)
+        if ranges is not None and len(ranges) > self.max_ranges:
+            ranges = None
+
+        if ranges is None:
+            status = b'200 OK'
+            headers.append((b'Content-Type', ctype))
+            headers.append((b'Content-Length', to_bytes(size)))
+            body = FileRange(self.cache, entry, 0, size, self.blksize)
+        elif not ranges:
+            self.cache.release(entry)
+            headers.append((b'Content-Range', b'bytes */' + to_bytes(size)))
+            return self.error(b'416 Requested Range Not Satisfiable', headers)
+        else:
+            status = b'206 Partial Content'
+            ranges = _coalesce(ranges)
+            if len(ranges) == 1:
+                start, end = ranges[0]
+                headers.append((b'Content-Type', ctype))
+                headers.append((b'Content-Range', self.content_range(
+                    start, end, size)))
+                headers.append((b'Content-Length', to_bytes(end - start)))
+                body = FileRange(self.cache, entry, start, end - start,
+                                 self.blksize)
+            else:
+                boundary = hexlify(os.urandom(12))
+                length, body = self.multipart(entry, ranges, ctype, boundary)
+                headers.append((b'Content-Type',
+                    b'multipart/byteranges; boundary=' + boundary))
+                headers.append((b'Content-Length', to_bytes(length)))
+
+        if head:
+            body.close()
+            body = []
+        return status, headers, body
+
+    def if_range(self, environ, entry):
+        """Return true if a 'Range' header should be honored"""
+        validator = environ.get('HTTP_IF_RANGE')
+        if validator is None:
+            return True
+        validator = validator.strip()
+        if validator[:1] == b'"':
+            return validator == entry.etag
+        return parse_date_time(validator) == int(entry.st.st_mtime)
+
+    def content_range(self, start, end, size):
+        return (b'bytes ' + to_bytes(start) + b'-' + to_bytes(end - 1) + b'/'
+                + to_bytes(size))
+
+    def multipart(self, entry, ranges, ctype, boundary):
+        """Return the length and body of a 'multipart/byteranges' response"""
+        size = entry.st.st_size
+        heads = []
+        length = 0
+        for start, end in ranges:
+            head = (CRLF + b'--' + boundary + CRLF +
+                    b'Content-Type: ' + ctype + CRLF +
+                    b'Content-Range: ' + self.content_range(start, end, size) +
+                    CRLF + CRLF)
+            heads.append(head)
+            length += len(head) + end - start
+        tail = CRLF + b'--' + boundary + b'--' + CRLF
+        length += len(tail)
+        body = _MultipartBody(self.cache, entry, ranges, heads, tail,
+                              self.blksize)
+        return length, body
+
+    def error(self, status, headers=()):
+        body = status[4:]
+        headers = list(headers) + [
+            (b'Content-Type', b'text/plain'),
+            (b'Content-Length', to_bytes(len(body))),
+        ]
+        return status, headers, [body]
+
+class _MultipartBody:
+    """Body of a multipart/byteranges response over one cached file"""
+
+    def __init__(self, cache, entry, ranges, heads, tail, blksize):
+        self.cache = cache
+        self.entry = entry
+        self.ranges = ranges
+        self.heads = heads
+        self.tail = tail
+        self.blksize = blksize
+
+    def __iter__(self):
+        for (start, end), head in zip(self.ranges, self.heads):
+            yield head
+            # the parts borrow our reference to the entry
+            part = FileRange(None, self.entry, start, end - start,
+                             self.blksize)
+            for data in part:
+                yield data
+        yield self.tail
+
+    def close(self):
+        if self.entry is not None:
+            self.cache.release(self.entry)
+            self.entry = None
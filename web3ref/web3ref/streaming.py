@@ -0,0 +1,378 @@
+"""Hand response output to a sender thread, for slow clients
+
+With a plain SimpleHandler the thread that runs the application also writes
+the response, blocking whenever the socket's send buffer is full, so a
+client on a slow link holds on to a worker thread for the whole transfer.
+Here a single 'Sender' thread drains buffered output to any number of
+sockets, and the application's thread is released as soon as the rest of
+its response is buffered::
+
+    sender = Sender(high_water=256*1024, low_water=64*1024)
+    handler = StreamingHandler()
+    handler.reset(rfile, sender.stream(sock), stderr, environ)
+    handler.run(app)        # returns once the response is buffered
+
+Output goes straight to the socket for as long as the socket takes it;
+only what doesn't fit is buffered.  While more than 'high_water' bytes are
+waiting, writes block until the sender has brought that down to
+'low_water', which bounds the memory held per connection and slows a
+generator body down to the client's pace.  File bodies (see
+'util.FileWrapper.file_range()') are passed to the sender whole and sent
+with os.sendfile(), so they never hold up the application's thread.
+
+The sender takes over the socket: it closes it once the response has been
+sent, or when the client has accepted nothing for 'send_timeout' seconds.
+'simple_server.make_server(..., streaming=True)' sets all of this up.
+"""
+
+import errno
+import os
+import select
+import socket
+import threading
+import time
+from collections import deque
+
+from web3ref.handlers import ReusableHandler
+
+__all__ = ['Sender', 'StreamOutput', 'StreamingHandler']
+
+_sendfile = getattr(os, 'sendfile', None)
+_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', None)
+_again = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# What a StreamOutput is waiting for, as returned by 'pump()'
+_SOCKET, _APPLICATION, _NOTHING = range(3)
+
+class StreamOutput:
+    """File-like output stream for one socket, drained by a Sender
+
+    Used as the handler's 'stdout'; 'close()' ends the response.
+    """
+
+    def __init__(self, sender, sock):
+        self.sender = sender
+        self.sock = sock
+        if sock.gettimeout() is None:
+            self.out = sock     # MSG_DONTWAIT keeps single sends from blocking
+        else:
+            # With a timeout, send() would first wait for the socket; a
+            # non-blocking duplicate doesn't (and the shared file is in
+            # non-blocking mode already, for the timeout's sake)
+            self.out = sock.dup()
+            self.out.setblocking(False)
+        self.fd = self.out.fileno()
+        self.cond = threading.Condition(threading.Lock())
+        self.chunks = deque()
+        self.buffered = 0
+        self.file = None        # [body, fd, offset, length], sent last
+        self.closed = False     # the application is done with us
+        self.detached = False   # owned by the body rather than the handler
+        self.error = None
+        self.nonblocking = False
+        self.last_progress = time.time()
+
+    def write(self, data):
+        cond = self.cond
+        with cond:
+            if self.error is not None:
+                raise self.error
+            if not self.chunks:
+                # Nothing queued, so nobody else is sending: try directly
+                try:
+                    sent = self.out.send(data, _DONTWAIT)
+                except socket.error as e:
+                    if e.args[0] not in _again:
+                        self.fail(e)
+                        raise
+                    sent = 0
+                if sent == len(data):
+                    return
+                data = data[sent:]
+            self.chunks.append(data)
+            self.buffered += len(data)
+            self.sender.wake(self)
+            if self.buffered > self.sender.high_water:
+                low_water = self.sender.low_water
+                while self.buffered > low_water and self.error is None:
+                    cond.wait()
+                if self.error is not None:
+                    raise self.error
+
+    def offer(self, data):
+        """Like 'write()', but never blocks
+
+        Returns false, having failed the output, if the client has gone or
+        is more than 'high_water' bytes behind; the caller should then
+        'close()' it.
+        """
+        with self.cond:
+            if self.error is not None or self.closed:
+                return False
+            if not self.chunks:
+                try:
+                    sent = self.out.send(data, _DONTWAIT)
+                except socket.error as e:
+                    if e.args[0] not in _again:
+                        self.fail(e)
+                        return False
+                    sent = 0
+                if sent == len(data):
+                    return True
+                data = data[sent:]
+            if self.buffered > self.sender.high_water:
+                self.fail(socket.timeout('client stopped reading'))
+                return False
+            self.chunks.append(data)
+            self.buffered += len(data)
+            self.sender.wake(self)
+            return True
+
+    def flush(self):
+        pass
+
+    def release(self):
+        """Give up the socket, which someone else now writes to directly
+
+        Only valid before anything was written.
+        """
+        with self.cond:
+            self.detached = self.closed = True
+        if self.out is not self.sock:
+            self.out.close()
+
+    def send_file(self, body, fd, offset, length):
+        """Send 'length' bytes of 'fd' after any other output, then close
+        'body'; the caller must not write anything more"""
+        with self.cond:
+            self.file = [body, fd, offset, length]
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+        self.sender.wake(self)
+
+    def fail(self, error):
+        """Drop all pending output; called with 'cond' held"""
+        self.error = error
+        self.chunks.clear()
+        self.buffered = 0
+        self.cond.notify_all()
+
+    def pump(self):
+        """Send what the socket will take now, and say what's next
+
+        Runs in the sender thread.
+        """
+        with self.cond:
+            try:
+                self.send_pending()
+            except (socket.error, OSError) as e:
+                if e.args[0] not in _again:
+                    self.fail(e)
+            if self.buffered <= self.sender.low_water:
+                self.cond.notify_all()
+            if self.error is None and (
+                self.chunks or self.file is not None and self.closed):
+                return _SOCKET
+            if self.closed:
+                return _NOTHING
+            return _APPLICATION
+
+    def send_pending(self):
+        sock = self.out
+        chunks = self.chunks
+        while chunks:
+            data = chunks[0]
+            sent = sock.send(data, _DONTWAIT)
+            self.buffered -= sent
+            self.last_progress = time.time()
+            if sent < len(data):
+                chunks[0] = data[sent:]
+                return
+            chunks.popleft()
+        if self.file is None or not self.closed:
+            return
+        if not self.nonblocking:
+            # The application is done with the socket, so it's all ours
+            sock.setblocking(False)
+            self.nonblocking = True
+        body, fd, offset, length = file = self.file
+        while length > 0:
+            sent = _sendfile(self.fd, fd, offset, length)
+            if not sent:
+                break                           # file shrank underneath us
+            offset += sent
+            length -= sent
+            file[2:] = offset, length
+            self.last_progress = time.time()
+        self.file = None
+        body.close()
+
+    def finish(self):
+        """Release the body and the socket; runs in the sender thread"""
+        with self.cond:
+            file, self.file = self.file, None
+        try:
+            if file is not None:
+                file[0].close()
+        finally:
+            if self.error is None:
+                try:
+                    self.sock.shutdown(socket.SHUT_WR)
+                except socket.error:
+                    pass
+            if self.out is not self.sock:
+                self.out.close()
+            self.sock.close()
+
+class Sender:
+    """Thread draining 'StreamOutput' buffers to their sockets
+
+    The thread is started on first use, and again in a forked child.
+    """
+
+    def __init__(self, high_water=256*1024, low_water=64*1024,
+                 send_timeout=300):
+        if _DONTWAIT is None:
+            raise NotImplementedError('streaming needs MSG_DONTWAIT')
+        self.high_water = high_water
+        self.low_water = low_water
+        self.send_timeout = send_timeout
+        self.lock = threading.Lock()
+        self.pid = None
+        self.woken = []
+
+    def stream(self, sock):
+        """Return a new StreamOutput taking over 'sock'"""
+        if self.pid != os.getpid():
+            self.start()
+        return StreamOutput(self, sock)
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.waker, wakee = socket.socketpair()
+            self.waker.setblocking(False)
+            self.woken = []
+            thread = threading.Thread(target=self.run, args=(wakee,))
+            thread.daemon = True
+            thread.start()
+            self.pid = os.getpid()
+
+    def wake(self, output):
+        """Have the sender thread look at 'output'"""
+        with self.lock:
+            self.woken.append(output)
+            if len(self.woken) == 1:
+                try:
+                    self.waker.send(b'x')
+                except socket.error:
+                    pass                # already full of wake-ups
+
+    def run(self, wakee):
+        """Main loop of the sender thread"""
+        outputs = {}                # fd -> StreamOutput with pending output
+        wake_fd = wakee.fileno()
+        while 1:
+            ready = self.wait(wake_fd, outputs, outputs and 1.0 or None)
+            if wake_fd in ready:
+                try:
+                    wakee.recv(4096)
+                except socket.error:
+                    pass
+                with self.lock:
+                    woken, self.woken = self.woken, []
+                for output in woken:
+                    outputs[output.fd] = output
+                    ready.add(output.fd)
+            for fd in ready:
+                output = outputs.get(fd)
+                if output is None:
+                    continue
+                waiting_for = output.pump()
+                if waiting_for != _SOCKET:
+                    # Not polled until the application wakes us again
+                    del outputs[fd]
+                    if waiting_for == _NOTHING:
+                        output.finish()
+            if outputs:
+                self.expire(outputs)
+
+    def wait(self, wake_fd, outputs, timeout):
+        """Return the set of ready descriptors"""
+        try:
+            if hasattr(select, 'poll'):
+                poll = select.poll()
+                poll.register(wake_fd, select.POLLIN)
+                for fd in outputs:
+                    poll.register(fd, select.POLLOUT)
+                if timeout is not None:
+                    timeout *= 1000
+                return set([fd for fd, event in poll.poll(timeout)])
+            r, w, x = select.select([wake_fd], list(outputs), [], timeout)
+            return set(r + w)
+        except (select.error, OSError) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return set()
+
+    def expire(self, outputs):
+        """Drop connections whose clients stopped reading"""
+        deadline = time.time() - self.send_timeout
+        for fd, output in list(outputs.items()):
+            if output.last_progress < deadline:
+                with output.cond:
+                    output.fail(socket.timeout('client stopped reading'))
+                del outputs[fd]
+                if output.closed:
+                    output.finish()
+
+class StreamingHandler(ReusableHandler):
+    """ReusableHandler writing to a 'StreamOutput'
+
+    Use with a HandlerPool, as for ReusableHandler.
+    """
+
+    __slots__ = ()
+
+    def sendfile(self):
+        """Pass the file to the sender thread instead of sending it here"""
+        if _sendfile is None:
+            return False
+        file_range = self.body.file_range()
+        if file_range is None:
+            return False
+        fd, offset, length = file_range
+        self.stdout.send_file(self.body, fd, offset, length)
+        self.bytes_sent += length
+        self.body = None            # now closed by the sender
+        return True
+
+    def send_body(self):
+        """Hand the output over to a body with an 'attach()' method
+
+        Such a body (e.g. 'sse.EventStream') keeps writing to the output
+        after the request is over, and closes it when it's done, so the
+        response can outlive the request's thread.
+        """
+        attach = getattr(self.body, 'attach', None)
+        if attach is None:
+            return ReusableHandler.send_body(self)
+        self.body = None            # now the body's to close
+        self.stdout.detached = True
+        try:
+            attach(self.stdout)
+        except:
+            self.stdout.detached = False
+            raise
+
+    def close(self):
+        """End the request; the sender finishes the response on its own"""
+        output = self.stdout
+        try:
+            ReusableHandler.close(self)
+        finally:
+            if output is not None and not output.detached:
+                output.close()
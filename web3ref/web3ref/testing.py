@@ -0,0 +1,235 @@
+"""In-process client for testing Web3 applications
+
+Usage::
+
+    from web3ref.testing import TestClient
+    client = TestClient(app)
+    response = client.get(b'/search?q=web3')
+    assert response.status_code == 200
+    assert response.header(b'Content-Type') == b'text/html'
+    response = client.post(b'/form', b'a=1',
+                           b'application/x-www-form-urlencoded')
+
+No sockets and no HTTP parsing are involved: the environ is built directly
+from the request, and the response is taken straight from the application.
+It is checked the way a server's 'finish_response()' would check it, and
+the body is collected and closed.  Asynchronous responses (see
+'web3.async') are polled until they are ready.
+
+'map()' runs a batch of requests, on a pool of threads if the client was
+created with 'threads'::
+
+    client = TestClient(app, threads=8)
+    responses = client.map([{'path': b'/a'}, {'path': b'/b'}])
+"""
+
+import threading
+import time
+
+from web3ref.handlers import check_response
+from web3ref.util import BytesIO
+from web3ref.util import StringIO
+from web3ref.util import guess_scheme
+from web3ref.util import unquote
+
+__all__ = ['TestClient', 'Response']
+
+if bytes is str:
+    def _bytes(value):
+        return value
+    _native = _bytes
+else:
+    def _bytes(value):
+        if isinstance(value, str):
+            return value.encode('latin-1')
+        return value
+    def _native(value):
+        if isinstance(value, bytes):
+            return value.decode('latin-1')
+        return value
+
+class Response:
+    """The response of an application to a TestClient request
+
+    'status' and 'body' are bytes, and 'headers' is the application's list
+    of '(name, value)' tuples.
+    """
+
+    def __init__(self, status, headers, body, environ):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.environ = environ
+
+    def __repr__(self):
+        return '<Response %r (%d bytes)>' % (self.status, len(self.body))
+
+    @property
+    def status_code(self):
+        return int(self.status[:3])
+
+    @property
+    def errors(self):
+        """What the application wrote to 'web3.errors'"""
+        return self.environ['web3.errors'].getvalue()
+
+    def header(self, name, default=None):
+        """Return the first value of header 'name', ignoring its case"""
+        name = name.lower()
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return default
+
+class TestClient:
+    """Calls a Web3 application directly, with an environ built in-process
+
+    'environ' supplies extra variables for every request.  Responses that
+    take longer than 'async_timeout' seconds to become ready fail with
+    AssertionError.
+    """
+
+    __test__ = False        # not a test case, whatever its name says
+
+    server_name = b'localhost'
+    server_port = b'80'
+    poll_interval = 0.001
+
+    def __init__(self, app, environ=None, threads=0, async_timeout=10):
+        self.app = app
+        self.threads = threads
+        self.async_timeout = async_timeout
+        base = self.base_environ = {
+            'SERVER_NAME': self.server_name,
+            'SERVER_PORT': self.server_port,
+            'SERVER_PROTOCOL': b'HTTP/1.1',
+            'HTTP_HOST': self.server_name,
+            'SCRIPT_NAME': b'',
+            'REMOTE_ADDR': b'127.0.0.1',
+            'web3.version': (1, 0),
+            'web3.multithread': threads > 1,
+            'web3.multiprocess': False,
+            'web3.run_once': False,
+            'web3.async': True,
+        }
+        if environ:
+            base.update(environ)
+        base.setdefault('web3.url_scheme', guess_scheme(base))
+
+    def make_environ(self, method=b'GET', path=b'/', body=b'',
+                     content_type=None, headers=(), environ=None):
+        """Return the environ for a request
+
+        'path' may include a query string; 'headers' is a list of
+        '(name, value)' tuples, or a dict, with bytes values.
+        """
+        env = self.base_environ.copy()
+        path, sep, query = _bytes(path).partition(b'?')
+        env['REQUEST_METHOD'] = _bytes(method)
+        env['PATH_INFO'] = unquote(path)
+        env['RAW_PATH_INFO'] = env['web3.path_info'] = path
+        env['QUERY_STRING'] = query
+        if isinstance(headers, dict):
+            headers = headers.items()
+        for name, value in headers:
+            key = 'HTTP_' + _native(name).replace('-', '_').upper()
+            if key in env and key != 'HTTP_HOST':
+                env[key] += b',' + value
+            else:
+                env[key] = value
+        if 'HTTP_CONTENT_TYPE' in env:
+            content_type = env.pop('HTTP_CONTENT_TYPE')
+        env.pop('HTTP_CONTENT_LENGTH', None)
+        if content_type is not None:
+            env['CONTENT_TYPE'] = content_type
+        if body:
+            env['CONTENT_LENGTH'] = str(len(body)).encode('ascii')
+        env['web3.input'] = BytesIO(body)
+        env['web3.errors'] = StringIO()
+        if environ:
+            env.update(environ)
+        return env
+
+    def request(self, method=b'GET', path=b'/', body=b'', content_type=None,
+                headers=(), environ=None):
+        """Run a request through the application and return its Response
+
+        Exceptions raised by the application propagate to the caller.
+        """
+        env = self.make_environ(method, path, body, content_type, headers,
+                                environ)
+        result = self.app(env)
+        if hasattr(result, '__call__'):
+            result = self.wait(result)
+        status, headers, body = result
+        try:
+            check_response(status, headers)
+            if isinstance(body, bytes):
+                raise AssertionError('Body must be an iterable of bytes, '
+                                     'not bytes')
+            data = b''.join(body)
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+        return Response(status, headers, data, env)
+
+    def wait(self, poll):
+        """Poll an asynchronous response until it is ready"""
+        deadline = time.time() + self.async_timeout
+        while 1:
+            result = poll()
+            if result is not None:
+                return result
+            if time.time() > deadline:
+                raise AssertionError('Asynchronous response not ready after '
+                                     '%s seconds' % self.async_timeout)
+            time.sleep(self.poll_interval)
+
+    def get(self, path=b'/', **kw):
+        return self.request(b'GET', path, **kw)
+
+    def head(self, path=b'/', **kw):
+        return self.request(b'HEAD', path, **kw)
+
+    def post(self, path=b'/', body=b'', content_type=None, **kw):
+        return self.request(b'POST', path, body, content_type, **kw)
+
+    def put(self, path=b'/', body=b'', content_type=None, **kw):
+        return self.request(b'PUT', path, body, content_type, **kw)
+
+    def delete(self, path=b'/', **kw):
+        return self.request(b'DELETE', path, **kw)
+
+    def map(self, requests):
+        """Run each dict of 'request()' arguments, and return the Responses
+
+        With 'threads', the requests are spread over that many threads; the
+        responses are returned in the order of 'requests' either way, and
+        the first exception raised by the application is re-raised.
+        """
+        requests = list(requests)
+        if self.threads <= 1 or len(requests) <= 1:
+            return [self.request(**kw) for kw in requests]
+        responses = [None] * len(requests)
+        errors = []
+        lock = threading.Lock()
+        indexes = iter(range(len(requests)))
+        def work():
+            while not errors:
+                with lock:
+                    i = next(indexes, None)
+                if i is None:
+                    return
+                try:
+                    responses[i] = self.request(**requests[i])
+                except Exception as e:
+                    errors.append(e)
+        threads = [threading.Thread(target=work)
+                   for i in range(min(self.threads, len(requests)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return responses
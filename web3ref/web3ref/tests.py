@@ -3,13 +3,20 @@ from unittest import TestCase
 from web3ref.util import setup_testing_defaults
 from web3ref.handlers import BaseHandler, BaseCGIHandler
 from web3ref import util
+from web3ref.util import to_bytes
 from web3ref.validate import validator
 from web3ref.simple_server import Web3Server, Web3RequestHandler
 from web3ref.simple_server import make_server
 
-from StringIO import StringIO
-from SocketServer import BaseServer
-import re, sys
+try:
+    from StringIO import StringIO
+    BytesIO = StringIO
+    from SocketServer import BaseServer
+except ImportError:     # Python 3
+    from io import BytesIO
+    from io import StringIO
+    from socketserver import BaseServer
+import os, re, sys
 
 class MockServer(Web3Server):
     """Non-socket HTTP server"""
@@ -40,9 +47,9 @@ def hello_app(environ,start_response):
     ])
     return ["Hello, world!"]
 
-def run_amock(app=hello_app, data="GET / HTTP/1.0\n\n"):
+def run_amock(app=hello_app, data=b"GET / HTTP/1.0\n\n"):
     server = make_server("", 80, app, MockServer, MockHandler)
-    inp, out, err, olderr = StringIO(data), StringIO(), StringIO(), sys.stderr
+    inp, out, err, olderr = BytesIO(data), BytesIO(), StringIO(), sys.stderr
     sys.stderr = err
 
     try:
@@ -80,9 +87,9 @@ def compare_generic_iter(make_it,match):
         it = make_it()
         if not iter(it) is it: raise AssertionError
         for item in match:
-            if not it.next()==item: raise AssertionError
+            if not next(it)==item: raise AssertionError
         try:
-            it.next()
+            next(it)
         except StopIteration:
             pass
         else:
@@ -115,7 +122,7 @@ class IntegrationTests(TestCase):
             start_response("200 OK", ('Content-Type','text/plain'))
             return ["Hello, world!"]
         out, err = run_amock(validator(bad_app))
-        self.failUnless(out.endswith(
+        self.assertTrue(out.endswith(
             "A server error occurred.  Please contact the administrator."
         ))
         self.assertEqual(
@@ -138,15 +145,15 @@ class UtilityTests(TestCase):
         # Check defaulting when empty
         env = {}
         util.setup_testing_defaults(env)
-        if isinstance(value,StringIO):
-            self.failUnless(isinstance(env[key],StringIO))
+        if isinstance(value,(StringIO,BytesIO)):
+            self.assertTrue(isinstance(env[key],type(value)))
         else:
             self.assertEqual(env[key],value)
 
         # Check existing value
         env = {key:alt}
         util.setup_testing_defaults(env)
-        self.failUnless(env[key] is alt)
+        self.assertTrue(env[key] is alt)
 
     def checkCrossDefault(self,key,value,**kw):
         util.setup_testing_defaults(kw)
@@ -163,102 +170,138 @@ class UtilityTests(TestCase):
     def checkFW(self,text,size,match):
 
         def make_it(text=text,size=size):
-            return util.FileWrapper(StringIO(text),size)
+            return util.FileWrapper(BytesIO(text),size)
 
         compare_generic_iter(make_it,match)
 
         it = make_it()
-        self.failIf(it.filelike.closed)
+        self.assertFalse(it.filelike.closed)
 
         for item in it:
             pass
 
-        self.failIf(it.filelike.closed)
+        self.assertFalse(it.filelike.closed)
 
         it.close()
-        self.failUnless(it.filelike.closed)
+        self.assertTrue(it.filelike.closed)
 
 
     def testSimpleShifts(self):
-        self.checkShift('','/', '', '/', '')
-        self.checkShift('','/x', 'x', '/x', '')
-        self.checkShift('/','', None, '/', '')
-        self.checkShift('/a','/x/y', 'x', '/a/x', '/y')
-        self.checkShift('/a','/x/',  'x', '/a/x', '/')
+        self.checkShift(b'',b'/', b'', b'/', b'')
+        self.checkShift(b'',b'/x', b'x', b'/x', b'')
+        self.checkShift(b'/',b'', None, b'/', b'')
+        self.checkShift(b'/a',b'/x/y', b'x', b'/a/x', b'/y')
+        self.checkShift(b'/a',b'/x/',  b'x', b'/a/x', b'/')
 
     def testNormalizedShifts(self):
-        self.checkShift('/a/b', '/../y', '..', '/a', '/y')
-        self.checkShift('', '/../y', '..', '', '/y')
-        self.checkShift('/a/b', '//y', 'y', '/a/b/y', '')
-        self.checkShift('/a/b', '//y/', 'y', '/a/b/y', '/')
-        self.checkShift('/a/b', '/./y', 'y', '/a/b/y', '')
-        self.checkShift('/a/b', '/./y/', 'y', '/a/b/y', '/')
-        self.checkShift('/a/b', '///./..//y/.//', '..', '/a', '/y/')
-        self.checkShift('/a/b', '///', '', '/a/b/', '')
-        self.checkShift('/a/b', '/.//', '', '/a/b/', '')
-        self.checkShift('/a/b', '/x//', 'x', '/a/b/x', '/')
-        self.checkShift('/a/b', '/.', None, '/a/b', '')
+        self.checkShift(b'/a/b', b'/../y', b'..', b'/a', b'/y')
+        self.checkShift(b'', b'/../y', b'..', b'', b'/y')
+        self.checkShift(b'/a/b', b'//y', b'y', b'/a/b/y', b'')
+        self.checkShift(b'/a/b', b'//y/', b'y', b'/a/b/y', b'/')
+        self.checkShift(b'/a/b', b'/./y', b'y', b'/a/b/y', b'')
+        self.checkShift(b'/a/b', b'/./y/', b'y', b'/a/b/y', b'/')
+        self.checkShift(b'/a/b', b'///./..//y/.//', b'..', b'/a', b'/y/')
+        self.checkShift(b'/a/b', b'///', b'', b'/a/b/', b'')
+        self.checkShift(b'/a/b', b'/.//', b'', b'/a/b/', b'')
+        self.checkShift(b'/a/b', b'/x//', b'x', b'/a/b/x', b'/')
+        self.checkShift(b'/a/b', b'/.', None, b'/a/b', b'')
 
     def testDefaults(self):
         for key, value in [
-            ('SERVER_NAME','127.0.0.1'),
-            ('SERVER_PORT', '80'),
-            ('SERVER_PROTOCOL','HTTP/1.0'),
-            ('HTTP_HOST','127.0.0.1'),
-            ('REQUEST_METHOD','GET'),
-            ('SCRIPT_NAME',''),
-            ('PATH_INFO','/'),
+            ('SERVER_NAME', b'127.0.0.1'),
+            ('SERVER_PORT', b'80'),
+            ('SERVER_PROTOCOL', b'HTTP/1.0'),
+            ('HTTP_HOST', b'127.0.0.1'),
+            ('REQUEST_METHOD', b'GET'),
+            ('SCRIPT_NAME', b''),
+            ('PATH_INFO', b'/'),
             ('web3.version', (1,0)),
             ('web3.run_once', 0),
             ('web3.multithread', 0),
             ('web3.multiprocess', 0),
-            ('web3.input', StringIO("")),
+            ('web3.input', BytesIO(b"")),
             ('web3.errors', StringIO()),
-            ('web3.url_scheme','http'),
+            ('web3.url_scheme', b'http'),
         ]:
             self.checkDefault(key,value)
 
     def testCrossDefaults(self):
-        self.checkCrossDefault('HTTP_HOST',"foo.bar",SERVER_NAME="foo.bar")
-        self.checkCrossDefault('web3.url_scheme',"https",HTTPS="on")
-        self.checkCrossDefault('web3.url_scheme',"https",HTTPS="1")
-        self.checkCrossDefault('web3.url_scheme',"https",HTTPS="yes")
-        self.checkCrossDefault('web3.url_scheme',"http",HTTPS="foo")
-        self.checkCrossDefault('SERVER_PORT',"80",HTTPS="foo")
-        self.checkCrossDefault('SERVER_PORT',"443",HTTPS="on")
+        self.checkCrossDefault('HTTP_HOST',b"foo.bar",SERVER_NAME=b"foo.bar")
+        self.checkCrossDefault('web3.url_scheme',b"https",HTTPS=b"on")
+        self.checkCrossDefault('web3.url_scheme',b"https",HTTPS=b"1")
+        self.checkCrossDefault('web3.url_scheme',b"https",HTTPS=b"yes")
+        self.checkCrossDefault('web3.url_scheme',b"http",HTTPS=b"foo")
+        self.checkCrossDefault('SERVER_PORT',b"80",HTTPS=b"foo")
+        self.checkCrossDefault('SERVER_PORT',b"443",HTTPS=b"on")
 
     def testGuessScheme(self):
-        self.assertEqual(util.guess_scheme({}), "http")
-        self.assertEqual(util.guess_scheme({'HTTPS':"foo"}), "http")
-        self.assertEqual(util.guess_scheme({'HTTPS':"on"}), "https")
-        self.assertEqual(util.guess_scheme({'HTTPS':"yes"}), "https")
-        self.assertEqual(util.guess_scheme({'HTTPS':"1"}), "https")
+        self.assertEqual(util.guess_scheme({}), b"http")
+        self.assertEqual(util.guess_scheme({'HTTPS':b"foo"}), b"http")
+        self.assertEqual(util.guess_scheme({'HTTPS':b"on"}), b"https")
+        self.assertEqual(util.guess_scheme({'HTTPS':b"yes"}), b"https")
+        self.assertEqual(util.guess_scheme({'HTTPS':b"1"}), b"https")
 
     def testAppURIs(self):
-        self.checkAppURI("http://127.0.0.1/")
-        self.checkAppURI("http://127.0.0.1/spam", SCRIPT_NAME="/spam")
-        self.checkAppURI("http://spam.example.com:2071/",
-            HTTP_HOST="spam.example.com:2071", SERVER_PORT="2071")
-        self.checkAppURI("http://spam.example.com/",
-            SERVER_NAME="spam.example.com")
-        self.checkAppURI("http://127.0.0.1/",
-            HTTP_HOST="127.0.0.1", SERVER_NAME="spam.example.com")
-        self.checkAppURI("https://127.0.0.1/", HTTPS="on")
-        self.checkAppURI("http://127.0.0.1:8000/", SERVER_PORT="8000",
+        self.checkAppURI(b"http://127.0.0.1/")
+        self.checkAppURI(b"http://127.0.0.1/spam", SCRIPT_NAME=b"/spam")
+        self.checkAppURI(b"http://spam.example.com:2071/",
+            HTTP_HOST=b"spam.example.com:2071", SERVER_PORT=b"2071")
+        self.checkAppURI(b"http://spam.example.com/",
+            SERVER_NAME=b"spam.example.com")
+        self.checkAppURI(b"http://127.0.0.1/",
+            HTTP_HOST=b"127.0.0.1", SERVER_NAME=b"spam.example.com")
+        self.checkAppURI(b"https://127.0.0.1/", HTTPS=b"on")
+        self.checkAppURI(b"http://127.0.0.1:8000/", SERVER_PORT=b"8000",
             HTTP_HOST=None)
 
     def testReqURIs(self):
-        self.checkReqURI("http://127.0.0.1/")
-        self.checkReqURI("http://127.0.0.1/spam", SCRIPT_NAME="/spam")
-        self.checkReqURI("http://127.0.0.1/spammity/spam",
-            SCRIPT_NAME="/spammity", PATH_INFO="/spam")
-        self.checkReqURI("http://127.0.0.1/spammity/spam?say=ni",
-            SCRIPT_NAME="/spammity", PATH_INFO="/spam",QUERY_STRING="say=ni")
-        self.checkReqURI("http://127.0.0.1/spammity/spam", 0,
-            SCRIPT_NAME="/spammity", PATH_INFO="/spam",QUERY_STRING="say=ni")
+        self.checkReqURI(b"http://127.0.0.1/")
+        self.checkReqURI(b"http://127.0.0.1/spam", SCRIPT_NAME=b"/spam")
+        self.checkReqURI(b"http://127.0.0.1/spammity/spam",
+            SCRIPT_NAME=b"/spammity", PATH_INFO=b"/spam")
+        self.checkReqURI(b"http://127.0.0.1/spammity/spam?say=ni",
+            SCRIPT_NAME=b"/spammity", PATH_INFO=b"/spam",QUERY_STRING=b"say=ni")
+        self.checkReqURI(b"http://127.0.0.1/spammity/spam", 0,
+            SCRIPT_NAME=b"/spammity", PATH_INFO=b"/spam",QUERY_STRING=b"say=ni")
 
     def testFileWrapper(self):
-        self.checkFW("xyz"*50, 120, ["xyz"*40,"xyz"*10])
+        self.checkFW(b"xyz"*50, 120, [b"xyz"*40,b"xyz"*10])
+
+    def testLimitedInput(self):
+        inp = util.LimitedInput(BytesIO(b'line1\nline2\nextra'), 12)
+        self.assertEqual(inp.readline(), b'line1\n')
+        self.assertEqual(inp.readline(3), b'lin')
+        self.assertEqual(inp.read(), b'e2\n')
+        self.assertEqual(inp.read(), b'')
+        inp = util.LimitedInput(BytesIO(b'a\nb\nc'), 4)
+        self.assertEqual(list(inp), [b'a\n', b'b\n'])
+
+    def testQuoting(self):
+        path = b'/a/b-c_d.e~f'
+        self.assertTrue(util.unquote(path) is path)
+        self.assertTrue(util.quote(path) is path)
+        self.assertEqual(util.unquote(b'/%7e%7E%zz%4/%2F%'), b'/~~%zz%4//%')
+        self.assertEqual(util.quote(b'/a b/\xe2\x82\xac?'),
+                         b'/a%20b/%E2%82%AC%3F')
+        self.assertEqual(util.quote(b'a/b', safe=b''), b'a%2Fb')
+        for c in range(256):
+            byte = bytes(bytearray([c]))
+            self.assertEqual(util.unquote(util.quote(byte)), byte)
+
+    def testParseQuery(self):
+        env = {'QUERY_STRING': b'a=1&b=%7e+x%zz&a=%E2%82%ac&&c'}
+        query = util.parse_query(env)
+        self.assertEqual(query.items(), [(b'a', b'1'), (b'b', b'~ x%zz'),
+                                         (b'a', b'\xe2\x82\xac'), (b'c', b'')])
+        self.assertEqual(query[b'a'], b'1')
+        self.assertEqual(query.getall(b'a'), [b'1', b'\xe2\x82\xac'])
+        self.assertEqual(query.get(b'x', b'-'), b'-')
+        self.assertTrue(util.parse_query(env) is query)
+        # Repeated query strings come from the cache, in other environs too
+        self.assertTrue(util.parse_query(dict(env)) is query)
+        env['QUERY_STRING'] = b'a=2'
+        self.assertEqual(util.parse_query(env)[b'a'], b'2')
+        self.assertEqual(len(util.parse_query({})), 0)
 
     def testHopByHop(self):
         for hop in (
@@ -266,14 +309,14 @@ class UtilityTests(TestCase):
             "TE Trailers Transfer-Encoding Upgrade"
         ).split():
             for alt in hop, hop.title(), hop.upper(), hop.lower():
-                self.failUnless(util.is_hop_by_hop(alt))
+                self.assertTrue(util.is_hop_by_hop(alt))
 
         # Not comprehensive, just a few random header names
         for hop in (
             "Accept Cache-Control Date Pragma Trailer Via Warning"
         ).split():
             for alt in hop, hop.title(), hop.upper(), hop.lower():
-                self.failIf(util.is_hop_by_hop(alt))
+                self.assertFalse(util.is_hop_by_hop(alt))
 
 class ErrorHandler(BaseCGIHandler):
     """Simple handler subclass for testing BaseHandler"""
@@ -281,7 +324,7 @@ class ErrorHandler(BaseCGIHandler):
     def __init__(self,**kw):
         setup_testing_defaults(kw)
         BaseCGIHandler.__init__(
-            self, StringIO(''), StringIO(), StringIO(), kw,
+            self, BytesIO(b''), BytesIO(), StringIO(), kw,
             multithread=True, multiprocess=True
         )
 
@@ -307,10 +350,10 @@ class HandlerTests(TestCase):
         env = handler.environ
         from os import environ
         for k,v in environ.items():
-            if not empty.has_key(k):
+            if k not in empty:
                 self.assertEqual(env[k],v)
         for k,v in empty.items():
-            self.failUnless(env.has_key(k))
+            self.assertTrue(k in env)
 
     def testEnviron(self):
         h = TestHandler(X="Y")
@@ -323,13 +366,13 @@ class HandlerTests(TestCase):
         h = BaseCGIHandler(None,None,None,{})
         h.setup_environ()
         for key in 'web3.url_scheme', 'web3.input', 'web3.errors':
-            self.assert_(h.environ.has_key(key))
+            self.assertTrue(key in h.environ)
 
     def testScheme(self):
-        h=TestHandler(HTTPS="on"); h.setup_environ()
-        self.assertEqual(h.environ['web3.url_scheme'],'https')
+        h=TestHandler(HTTPS=b"on"); h.setup_environ()
+        self.assertEqual(h.environ['web3.url_scheme'],b'https')
         h=TestHandler(); h.setup_environ()
-        self.assertEqual(h.environ['web3.url_scheme'],'http')
+        self.assertEqual(h.environ['web3.url_scheme'],b'http')
 
 
     def testAbstractMethods(self):
@@ -392,7 +435,7 @@ class HandlerTests(TestCase):
             "Content-Length: %d\r\n"
             "\r\n%s" % (h.error_status,len(h.error_body),h.error_body))
 
-        self.failUnless(h.stderr.getvalue().find("AssertionError")<>-1)
+        self.assertTrue(h.stderr.getvalue().find("AssertionError")!=-1)
 
     def testErrorAfterOutput(self):
         MSG = "Some output has been sent"
@@ -405,7 +448,7 @@ class HandlerTests(TestCase):
         self.assertEqual(h.stdout.getvalue(),
             "Status: 200 OK\r\n"
             "\r\n"+MSG)
-        self.failUnless(h.stderr.getvalue().find("AssertionError")<>-1)
+        self.assertTrue(h.stderr.getvalue().find("AssertionError")!=-1)
 
     def testHeaderFormats(self):
 
@@ -443,8 +486,1780 @@ class HandlerTests(TestCase):
                     if proto=="HTTP/0.9":
                         self.assertEqual(h.stdout.getvalue(),"")
                     else:
-                        self.failUnless(
+                        self.assertTrue(
                             re.match(stdpat%(version,sw), h.stdout.getvalue()),
                             (stdpat%(version,sw), h.stdout.getvalue())
                         )
 
+
+class ConditionalTests(TestCase):
+
+    def make_app(self, headers, calls):
+        class Body(object):
+            closed = False
+            def __iter__(self):
+                calls.append('iter')
+                return iter([b'hello'])
+            def close(self):
+                self.closed = True
+        def app(environ):
+            calls.append('app')
+            self.body = Body()
+            return b'200 OK', list(headers), self.body
+        return app
+
+    def request(self, app, **kw):
+        setup_testing_defaults(kw)
+        return app(kw)
+
+    def testParseDateTime(self):
+        from web3ref.handlers import format_date_time, parse_date_time
+        for ts in 0, 784111777, 1286000000:
+            self.assertEqual(parse_date_time(format_date_time(ts)), ts)
+        self.assertEqual(
+            parse_date_time(b'Sunday, 06-Nov-94 08:49:37 GMT'), 784111777)
+        self.assertEqual(parse_date_time(b'garbage'), None)
+
+    def testETagShortCircuitsBody(self):
+        from web3ref.conditional import conditional
+        calls = []
+        app = conditional(self.make_app([(b'ETag', b'"abc"')], calls))
+        status, headers, body = self.request(
+            app, HTTP_IF_NONE_MATCH=b'"xyz", W/"abc"')
+        self.assertEqual(status, b'304 Not Modified')
+        self.assertEqual(headers, [(b'ETag', b'"abc"')])
+        self.assertEqual(list(body), [])
+        self.assertEqual(calls, ['app'])
+        self.assertTrue(self.body.closed)
+
+        status, headers, body = self.request(app, HTTP_IF_NONE_MATCH=b'"x"')
+        self.assertEqual(status, b'200 OK')
+        self.assertFalse(self.body.closed)
+
+    def testIfModifiedSince(self):
+        from web3ref.conditional import conditional
+        calls = []
+        app = conditional(self.make_app(
+            [(b'Last-Modified', b'Sun, 06 Nov 1994 08:49:37 GMT')], calls))
+        status, headers, body = self.request(
+            app, HTTP_IF_MODIFIED_SINCE=b'Sun, 06 Nov 1994 08:49:37 GMT')
+        self.assertEqual(status, b'304 Not Modified')
+        status, headers, body = self.request(
+            app, HTTP_IF_MODIFIED_SINCE=b'Sat, 05 Nov 1994 08:49:37 GMT')
+        self.assertEqual(status, b'200 OK')
+        status, headers, body = self.request(app, REQUEST_METHOD=b'POST',
+            HTTP_IF_MODIFIED_SINCE=b'Sun, 06 Nov 1994 08:49:37 GMT')
+        self.assertEqual(status, b'200 OK')
+
+    def testValidatorsSkipApplication(self):
+        from web3ref.conditional import conditional
+        calls = []
+        app = conditional(self.make_app([], calls),
+                          lambda environ: (b'"v1"', 784111777))
+        status, headers, body = self.request(app, HTTP_IF_NONE_MATCH=b'"v1"')
+        self.assertEqual(status, b'304 Not Modified')
+        self.assertEqual(calls, [])
+        status, headers, body = self.request(app)
+        self.assertEqual(status, b'200 OK')
+        self.assertEqual(headers, [
+            (b'ETag', b'"v1"'),
+            (b'Last-Modified', b'Sun, 06 Nov 1994 08:49:37 GMT'),
+        ])
+
+    def testSharedHeaders(self):
+        from web3ref.conditional import conditional
+        shared = [(b'Content-Type', b'text/plain')]
+        def app(environ):
+            return b'200 OK', shared, [b'hello']
+        versions = [b'"v1"', b'"v2"']
+        app = conditional(app, lambda environ: (versions.pop(0), None))
+        for etag in b'"v1"', b'"v2"':
+            status, headers, body = self.request(app,
+                                                 HTTP_IF_NONE_MATCH=b'"v0"')
+            self.assertEqual(status, b'200 OK')
+            self.assertEqual(headers, [(b'Content-Type', b'text/plain'),
+                                       (b'ETag', etag)])
+        self.assertEqual(shared, [(b'Content-Type', b'text/plain')])
+        app = conditional(lambda environ: (b'200 OK', (), [b'hello']),
+                          compute_etag=True)
+        status, headers, body = self.request(app)
+        self.assertEqual([name for name, value in headers], [b'ETag'])
+
+    def testComputedETag(self):
+        from web3ref.conditional import conditional
+        calls = []
+        app = conditional(self.make_app([], calls), compute_etag=True)
+        status, headers, body = self.request(app)
+        self.assertEqual(list(body), [b'hello'])
+        self.assertTrue(self.body.closed)
+        etag = dict(headers)[b'ETag']
+        status, headers, body = self.request(app, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status, b'304 Not Modified')
+
+    def testAsyncResponse(self):
+        from web3ref.conditional import conditional
+        def app(environ):
+            return lambda: (b'200 OK', [(b'ETag', b'"a"')], [b'x'])
+        poll = self.request(conditional(app), HTTP_IF_NONE_MATCH=b'"a"')
+        self.assertEqual(poll()[0], b'304 Not Modified')
+
+class CacheTests(TestCase):
+
+    def make_app(self, headers=(), status=b'200 OK'):
+        self.calls = 0
+        def app(environ):
+            self.calls += 1
+            body = b'call ' + to_bytes(self.calls)
+            return status, list(headers), [body]
+        return app
+
+    def request(self, app, **kw):
+        setup_testing_defaults(kw)
+        status, headers, body = app(kw)
+        return status, headers, b''.join(body)
+
+    def testCachesByKey(self):
+        from web3ref.cache import CacheMiddleware
+        app = CacheMiddleware(self.make_app(), vary=['Accept-Language'])
+        self.assertEqual(self.request(app)[2], b'call 1')
+        self.assertEqual(self.request(app)[2], b'call 1')
+        self.assertEqual(self.request(app, QUERY_STRING=b'a=1')[2], b'call 2')
+        self.assertEqual(
+            self.request(app, HTTP_ACCEPT_LANGUAGE=b'de')[2], b'call 3')
+        self.assertEqual(
+            self.request(app, REQUEST_METHOD=b'POST')[2], b'call 4')
+        self.assertEqual(
+            self.request(app, REQUEST_METHOD=b'POST')[2], b'call 5')
+        self.assertEqual(self.calls, 5)
+
+    def testUncacheable(self):
+        from web3ref.cache import CacheMiddleware
+        for headers in (
+            [(b'Cache-Control', b'private, max-age=10')],
+            [(b'Cache-Control', b'max-age=0')],
+            [(b'Set-Cookie', b'a=b')],
+            [(b'Vary', b'Cookie')],
+        ):
+            app = CacheMiddleware(self.make_app(headers))
+            self.request(app)
+            self.request(app)
+            self.assertEqual(self.calls, 2)
+        app = CacheMiddleware(self.make_app(status=b'500 Error'))
+        self.request(app)
+        self.request(app)
+        self.assertEqual(self.calls, 2)
+
+    def testTTLAndEviction(self):
+        from web3ref.cache import ResponseCache
+        now = [0]
+        cache = ResponseCache(max_size=40, timer=lambda: now[0])
+        cache.set('a', (b'200 OK', [], b'x' * 10), 5)
+        cache.set('b', (b'200 OK', [], b'x' * 10), 5)
+        self.assertTrue(cache.get('a') is not None)
+        cache.set('c', (b'200 OK', [], b'x' * 10), 5)
+        self.assertEqual(cache.get('b'), None)   # least recently used
+        self.assertTrue(cache.get('a') is not None)
+        now[0] = 5
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 1)
+
+    def testSingleFlight(self):
+        import threading
+        from web3ref.cache import CacheMiddleware
+        release = threading.Event()
+        calls = []
+        def slow_app(environ):
+            calls.append(1)
+            release.wait()
+            return b'200 OK', [], [b'slow']
+        app = CacheMiddleware(slow_app)
+        results = []
+        def worker():
+            results.append(self.request(app, **{'web3.multithread': True}))
+        threads = [threading.Thread(target=worker) for i in range(5)]
+        for t in threads:
+            t.start()
+        while not calls:
+            release.wait(0.01)
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([r[2] for r in results], [b'slow'] * 5)
+
+class StaticTests(TestCase):
+
+    def setUp(self):
+        import tempfile
+        from web3ref.static import StaticFiles
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'sub'))
+        self.write('hello.txt', b'0123456789' * 10)
+        self.write('sub/index.html', b'<html></html>')
+        self.app = StaticFiles(self.root)
+
+    def tearDown(self):
+        import shutil
+        self.app.cache.clear()
+        shutil.rmtree(self.root)
+
+    def write(self, name, data):
+        f = open(os.path.join(self.root, name), 'wb')
+        f.write(data)
+        f.close()
+
+    def request(self, path, **kw):
+        kw['PATH_INFO'] = path
+        setup_testing_defaults(kw)
+        status, headers, body = self.app(kw)
+        try:
+            data = b''.join(body)
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+        return status, dict(headers), data
+
+    def testServeFile(self):
+        status, headers, data = self.request(b'/hello.txt')
+        self.assertEqual(status, b'200 OK')
+        self.assertEqual(headers[b'Content-Type'], b'text/plain')
+        self.assertEqual(headers[b'Content-Length'], b'100')
+        self.assertEqual(data, b'0123456789' * 10)
+        status, headers, data = self.request(b'/./sub//index.html')
+        self.assertEqual(data, b'<html></html>')
+        status, headers, data = self.request(b'/sub/')
+        self.assertEqual(data, b'<html></html>')
+        status, headers, data = self.request(b'/sub')
+        self.assertEqual(status, b'301 Moved Permanently')
+        self.assertEqual(headers[b'Location'], b'http://127.0.0.1/sub/')
+        self.assertEqual(self.request(b'/../etc/passwd')[0], b'404 Not Found')
+        self.assertEqual(self.request(b'/missing')[0], b'404 Not Found')
+        status, headers, data = self.request(b'/hello.txt',
+                                             REQUEST_METHOD=b'HEAD')
+        self.assertEqual((status, data), (b'200 OK', b''))
+        self.assertEqual(self.request(b'/hello.txt', REQUEST_METHOD=b'POST')[0],
+                         b'405 Method Not Allowed')
+
+    def testConditional(self):
+        status, headers, data = self.request(b'/hello.txt')
+        status, headers, data = self.request(b'/hello.txt',
+            HTTP_IF_NONE_MATCH=headers[b'ETag'])
+        self.assertEqual((status, data), (b'304 Not Modified', b''))
+
+    def testRanges(self):
+        status, headers, data = self.request(b'/hello.txt',
+                                             HTTP_RANGE=b'bytes=10-19')
+        self.assertEqual(status, b'206 Partial Content')
+        self.assertEqual(headers[b'Content-Range'], b'bytes 10-19/100')
+        self.assertEqual(data, b'0123456789')
+        status, headers, data = self.request(b'/hello.txt',
+                                             HTTP_RANGE=b'bytes=-5')
+        self.assertEqual(data, b'56789')
+        status, headers, data = self.request(b'/hello.txt',
+                                             HTTP_RANGE=b'bytes=200-')
+        self.assertEqual(status, b'416 Requested Range Not Satisfiable')
+        self.assertEqual(headers[b'Content-Range'], b'bytes */100')
+        status, headers, data = self.request(b'/hello.txt',
+            HTTP_RANGE=b'bytes=10-19', HTTP_IF_RANGE=b'"stale"')
+        self.assertEqual(status, b'200 OK')
+
+        status, headers, data = self.request(b'/hello.txt',
+                                             HTTP_RANGE=b'bytes=0-1,95-')
+        self.assertEqual(status, b'206 Partial Content')
+        ctype = headers[b'Content-Type']
+        self.assertTrue(ctype.startswith(b'multipart/byteranges; boundary='))
+        boundary = ctype.split(b'=', 1)[1]
+        self.assertEqual(len(data), int(headers[b'Content-Length']))
+        self.assertEqual(data,
+            b'\r\n--' + boundary + b'\r\nContent-Type: text/plain\r\n'
+            b'Content-Range: bytes 0-1/100\r\n\r\n01'
+            b'\r\n--' + boundary + b'\r\nContent-Type: text/plain\r\n'
+            b'Content-Range: bytes 95-99/100\r\n\r\n56789'
+            b'\r\n--' + boundary + b'--\r\n')
+
+    def testCacheInvalidation(self):
+        from web3ref.static import FileCache
+        now = [0]
+        cache = self.app.cache = FileCache(max_entries=1,
+                                           timer=lambda: now[0])
+        path = os.path.join(self.root, 'hello.txt').encode('ascii')
+        entry = cache.acquire(path)
+        fd = entry.fd
+        cache.release(entry)
+        self.assertTrue(cache.acquire(path) is entry)
+        cache.release(entry)
+
+        self.write('hello.txt', b'changed')
+        os.utime(path, (1, 1))
+        now[0] = 2
+        newentry = cache.acquire(path)
+        self.assertFalse(newentry is entry)
+        self.assertEqual(entry.fd, None)          # old descriptor closed
+        self.assertEqual(self.request(b'/hello.txt')[2], b'changed')
+        cache.release(newentry)
+
+        other = cache.acquire(os.path.join(self.root, 'sub', 'index.html'))
+        self.assertEqual(len(cache), 1)
+        cache.release(other)
+
+    def testSendfileTimeout(self):
+        import socket, time
+        from web3ref.handlers import SimpleHandler
+        from web3ref.util import BytesIO, StringIO
+        if not hasattr(os, 'sendfile'):
+            self.skipTest('no os.sendfile()')
+        self.write('big.bin', b'x' * (16 * 1024 * 1024))
+        server, client = socket.socketpair()
+        self.addCleanup(client.close)
+        self.addCleanup(server.close)
+        server.settimeout(0.2)
+        class RequestHandler:
+            connection = server
+        stdout = server.makefile('wb')
+        env = {'PATH_INFO': b'/big.bin'}
+        setup_testing_defaults(env)
+        stderr = StringIO()
+        handler = SimpleHandler(BytesIO(), stdout, stderr, env)
+        handler.request_handler = RequestHandler()
+        start = time.time()
+        handler.run(self.app)       # the client never reads
+        self.assertTrue(time.time() - start < 5)
+        self.assertTrue('timed out' in stderr.getvalue())
+
+class HeaderCacheTests(TestCase):
+
+    def testLines(self):
+        from web3ref import handlers
+        header = (b'Content-Type', b'text/html; charset=utf-8')
+        line = handlers.header_line(header)
+        self.assertEqual(line, b'Content-Type: text/html; charset=utf-8\r\n')
+        self.assertTrue(handlers.header_line(header) is line)
+        self.assertTrue(
+            handlers.header_line((b'Content-Type', b'text/html; charset=utf-8'))
+            is line)
+        length = (b'Content-Length', b'12345')
+        self.assertEqual(handlers.header_line(length),
+                         b'Content-Length: 12345\r\n')
+        self.assertFalse(length in handlers._header_lines)
+
+        # A full cache is cleared rather than keeping early unique values
+        for i in range(handlers._line_cache_max):
+            handlers.header_line((b'X-Request-Id', str(i).encode('ascii')))
+        self.assertFalse(header in handlers._header_lines)
+        handlers.header_line(header)
+        self.assertTrue(header in handlers._header_lines)
+
+        status = handlers.status_line(b'1.1', b'200 OK')
+        self.assertEqual(status, b'HTTP/1.1 200 OK\r\n')
+        self.assertTrue(handlers.status_line(b'1.1', b'200 OK') is status)
+        self.assertEqual(handlers.date_line(784111777.5),
+                         b'Date: Sun, 06 Nov 1994 08:49:37 GMT\r\n')
+
+    def testResponse(self):
+        def app(environ):
+            return (b'404 Not Found',
+                    [(b'Content-Type', b'text/plain'), (b'X-A', b'b')],
+                    [b'nope'])
+        h = TestHandler(SERVER_PROTOCOL=b'HTTP/1.1')
+        h.origin_server = True
+        h.server_software = b'FooBar/1.0'
+        h.run(app)
+        self.assertTrue(re.match(
+            br'HTTP/1.0 404 Not Found\r\n'
+            br'Date: \w{3}, \d\d \w{3} \d{4} \d\d:\d\d:\d\d GMT\r\n'
+            br'Server: FooBar/1.0\r\n'
+            br'Content-Type: text/plain\r\nX-A: b\r\n\r\nnope$',
+            h.stdout.getvalue()), h.stdout.getvalue())
+
+class ReusableHandlerTests(TestCase):
+
+    def app(self, environ):
+        return b'200 OK', [], [environ['PATH_INFO']]
+
+    def testReuse(self):
+        from web3ref.handlers import HandlerPool, ReusableHandler
+        pool = HandlerPool()
+        outputs = []
+        for path in b'/a', b'/b':
+            env = {'PATH_INFO': path}
+            setup_testing_defaults(env)
+            out = BytesIO()
+            handler = pool.acquire(BytesIO(b''), out, StringIO(), env)
+            handler.run(self.app)
+            outputs.append((handler, out.getvalue()))
+        (h1, out1), (h2, out2) = outputs
+        self.assertTrue(h1 is h2)
+        self.assertTrue(isinstance(h1, ReusableHandler))
+        self.assertFalse(hasattr(h1, '__dict__'))
+        self.assertTrue(out1.endswith(b'\r\n\r\n/a'))
+        self.assertTrue(out2.endswith(b'\r\n\r\n/b'))
+        self.assertEqual((h1.stdout, h1.environ, h1.status), (None,) * 3)
+
+    def testServerUsesPool(self):
+        out, err = run_amock(self.app, b"GET /x HTTP/1.0\r\n\r\n")
+        self.assertTrue(out.startswith(b"HTTP/1.0 200 OK\r\n"), out)
+        self.assertTrue(out.endswith(b"\r\n\r\n/x"), out)
+
+class FastCGITests(TestCase):
+
+    def setUp(self):
+        import tempfile, threading
+        from web3ref import fastcgi
+        self.fastcgi = fastcgi
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'fcgi.sock')
+        def app(environ):
+            data = environ['web3.input'].read()
+            body = (environ['PATH_INFO'] + b' ' + environ['QUERY_STRING'] +
+                    b' ' + data)
+            return b'200 OK', [(b'Content-Type', b'text/plain')], [body]
+        self.server = fastcgi.make_server(self.path, app)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        import shutil
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.dir)
+
+    def connect(self):
+        import socket
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        return sock
+
+    def begin(self, request_id, params, stdin=b'', keep_conn=True):
+        f = self.fastcgi
+        records = f.encode_records(f.FCGI_BEGIN_REQUEST, request_id,
+            f._begin_body.pack(f.FCGI_RESPONDER, keep_conn and 1 or 0))
+        records += f.encode_records(f.FCGI_PARAMS, request_id,
+                                    f.encode_pairs(params))
+        records += f.encode_records(f.FCGI_PARAMS, request_id, b'')
+        if stdin:
+            records += f.encode_records(f.FCGI_STDIN, request_id, stdin)
+        return records
+
+    def read_responses(self, sock, count):
+        f = self.fastcgi
+        rfile = sock.makefile('rb')
+        stdout = {}
+        ended = {}
+        while len(ended) < count:
+            header = rfile.read(8)
+            version, rtype, request_id, length, padding = \
+                f._header.unpack(header)
+            content = rfile.read(length)
+            rfile.read(padding)
+            if rtype == f.FCGI_STDOUT:
+                stdout[request_id] = stdout.get(request_id, b'') + content
+            elif rtype == f.FCGI_END_REQUEST:
+                ended[request_id] = f._end_body.unpack(content)
+        rfile.close()
+        return stdout, ended
+
+    def testPairs(self):
+        f = self.fastcgi
+        pairs = [(b'A', b'1'), (b'LONG', b'x' * 300)]
+        self.assertEqual(f.decode_pairs(f.encode_pairs(pairs)),
+                         {'A': b'1', 'LONG': b'x' * 300})
+
+    def testMultiplexedRequests(self):
+        f = self.fastcgi
+        sock = self.connect()
+        params = [(b'REQUEST_METHOD', b'POST'), (b'SERVER_PROTOCOL',
+                  b'HTTP/1.1'), (b'QUERY_STRING', b'q=1')]
+        data = self.begin(1, params + [(b'PATH_INFO', b'/one')], b'body1')
+        data += self.begin(2, params + [(b'PATH_INFO', b'/two')], b'body2')
+        data += f.encode_records(f.FCGI_STDIN, 2, b'')
+        data += f.encode_records(f.FCGI_STDIN, 1, b'')
+        sock.sendall(b''.join(data))
+        stdout, ended = self.read_responses(sock, 2)
+        sock.close()
+        self.assertEqual(stdout[1],
+            b'Status: 200 OK\r\nContent-Type: text/plain\r\n\r\n/one q=1 body1')
+        self.assertEqual(stdout[2],
+            b'Status: 200 OK\r\nContent-Type: text/plain\r\n\r\n/two q=1 body2')
+        self.assertEqual(ended, {1: (0, 0), 2: (0, 0)})
+
+    def testMaxRequests(self):
+        f = self.fastcgi
+        self.server.max_reqs = b'2'
+        sock = self.connect()
+        params = [(b'REQUEST_METHOD', b'GET'), (b'PATH_INFO', b'/')]
+        data = []
+        for request_id in 1, 2, 3:
+            data += self.begin(request_id, params)
+        sock.sendall(b''.join(data))
+        stdout, ended = self.read_responses(sock, 1)
+        self.assertEqual(ended, {3: (0, f.FCGI_OVERLOADED)})
+        data = []
+        for request_id in 1, 2:
+            data += f.encode_records(f.FCGI_STDIN, request_id, b'')
+        sock.sendall(b''.join(data))
+        stdout, ended = self.read_responses(sock, 2)
+        self.assertEqual(ended, {1: (0, 0), 2: (0, 0)})
+        # Once those ended, there is room again
+        sock.sendall(b''.join(self.begin(4, params) +
+                              f.encode_records(f.FCGI_STDIN, 4, b'')))
+        stdout, ended = self.read_responses(sock, 1)
+        self.assertEqual(ended, {4: (0, 0)})
+        sock.close()
+
+    def testDuplicateRequestId(self):
+        import errno, socket
+        sock = self.connect()
+        sock.settimeout(5)
+        params = [(b'REQUEST_METHOD', b'GET'), (b'PATH_INFO', b'/')]
+        sock.sendall(b''.join(self.begin(1, params) + self.begin(1, params)))
+        try:
+            self.assertEqual(sock.recv(8), b'')     # hung up on
+        except socket.error as e:
+            self.assertEqual(e.errno, errno.ECONNRESET)
+        sock.close()
+
+    def testGetValuesAndRoles(self):
+        f = self.fastcgi
+        sock = self.connect()
+        sock.sendall(b''.join(f.encode_records(f.FCGI_GET_VALUES, 0,
+            f.encode_pairs([(b'FCGI_MPXS_CONNS', b'')]))))
+        header = sock.recv(8)
+        version, rtype, request_id, length, padding = f._header.unpack(header)
+        self.assertEqual(rtype, f.FCGI_GET_VALUES_RESULT)
+        content = sock.recv(length + padding)[:length]
+        self.assertEqual(f.decode_pairs(content), {'FCGI_MPXS_CONNS': b'1'})
+
+        sock.sendall(b''.join(f.encode_records(f.FCGI_BEGIN_REQUEST, 3,
+            f._begin_body.pack(2, 1))))     # the Authorizer role
+        stdout, ended = self.read_responses(sock, 1)
+        self.assertEqual(ended, {3: (0, f.FCGI_UNKNOWN_ROLE)})
+        sock.close()
+
+def echo_app(environ):
+    body = (environ['REQUEST_METHOD'] + b' ' + environ['PATH_INFO'] + b' ' +
+            environ['web3.input'].read() + b' ' +
+            to_bytes(environ['web3.multithread']) + b' ' +
+            to_bytes(os.getpid()))
+    return b'200 OK', [(b'Content-Type', b'text/plain')], [body]
+
+class ServerTestCase(TestCase):
+    """Runs a real server in a thread; see 'serve()' and 'exchange()'"""
+
+    server = None
+
+    def serve(self, server):
+        import threading
+        self.server = server
+        self.thread = threading.Thread(target=server.serve_forever,
+                                       args=(0.05,))
+        self.thread.start()
+
+    def tearDown(self):
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def exchange(self, data, family=None):
+        import socket
+        if family is None:
+            sock = socket.create_connection(self.server.server_address)
+        else:
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.connect(self.server.server_address)
+        sock.sendall(data)
+        chunks = []
+        while 1:
+            chunk = sock.recv(8192)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        sock.close()
+        return b''.join(chunks)
+
+class GatewayTests(ServerTestCase):
+
+    def testSCGI(self):
+        import socket, tempfile, shutil
+        from web3ref.gateways import make_scgi_server
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.serve(make_scgi_server(os.path.join(tmp, 's'), echo_app,
+                                    threads=2))
+        headers = (b'CONTENT_LENGTH\x005\x00SCGI\x001\x00'
+                   b'REQUEST_METHOD\x00POST\x00PATH_INFO\x00/x\x00')
+        out = self.exchange(to_bytes(len(headers)) + b':' + headers + b','
+                            b'hello', socket.AF_UNIX)
+        self.assertEqual(out,
+            b'Status: 200 OK\r\nContent-Type: text/plain\r\n\r\n'
+            b'POST /x hello True ' + to_bytes(os.getpid()))
+
+    def testUWSGIPreFork(self):
+        import struct
+        from web3ref.gateways import make_uwsgi_server
+        self.serve(make_uwsgi_server(('127.0.0.1', 0), echo_app, threads=0,
+                                     processes=2))
+        pairs = b''
+        for name, value in ((b'REQUEST_METHOD', b'GET'),
+                            (b'PATH_INFO', b'/u'),
+                            (b'SERVER_PROTOCOL', b'HTTP/1.1')):
+            pairs += (struct.pack('<H', len(name)) + name +
+                      struct.pack('<H', len(value)) + value)
+        packet = struct.pack('<BHB', 0, len(pairs), 0) + pairs
+        out = self.exchange(packet)
+        self.assertTrue(out.startswith(b'HTTP/1.0 200 OK\r\n'), out)
+        body = out.split(b'\r\n\r\n', 1)[1]
+        method, path, data, multithread, pid = body.split(b' ')
+        self.assertEqual((method, path, multithread), (b'GET', b'/u', b'False'))
+        self.assertNotEqual(int(pid), os.getpid())
+
+    def testBadContentLength(self):
+        import socket, tempfile, shutil
+        from web3ref.gateways import make_scgi_server
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        server = make_scgi_server(os.path.join(tmp, 's'), echo_app, threads=0)
+        errors = []
+        server.handle_error = lambda request, address: errors.append(
+            sys.exc_info()[1])
+        self.serve(server)
+        headers = b'CONTENT_LENGTH\x00five\x00SCGI\x001\x00'
+        out = self.exchange(to_bytes(len(headers)) + b':' + headers + b',',
+                            socket.AF_UNIX)
+        self.assertEqual(out, b'')
+        self.assertEqual(errors, [])
+
+def path_app(environ):
+    return b'200 OK', [(b'Content-Type', b'text/plain')], [
+        environ['PATH_INFO'] + b' ' + environ['REMOTE_ADDR']]
+
+class ListenTests(ServerTestCase):
+
+    request = b'GET /l HTTP/1.0\r\n\r\n'
+
+    def check(self, out, remote_addr=b'127.0.0.1'):
+        self.assertTrue(out.startswith(b'HTTP/1.0 200 OK\r\n'), out)
+        self.assertTrue(out.endswith(b'\r\n\r\n/l ' + remote_addr), out)
+
+    def testUnixSocket(self):
+        import socket, tempfile, shutil
+        from web3ref.simple_server import UnixWeb3Server
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'http.sock')
+        open(path, 'w').close()             # a stale socket file
+        server = make_server('example.com', 8080, path_app, path=path)
+        self.assertTrue(isinstance(server, UnixWeb3Server))
+        self.assertEqual(server.base_environ['SERVER_NAME'], b'example.com')
+        self.assertEqual(server.base_environ['SERVER_PORT'], b'8080')
+        self.serve(server)
+        self.check(self.exchange(self.request, socket.AF_UNIX), b'')
+
+    def testInheritedSocket(self):
+        import socket
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        fd = os.dup(listener.fileno())
+        address = listener.getsockname()
+        listener.close()
+        server = make_server('', 0, path_app, fd=fd)
+        self.assertEqual(server.server_address, address)
+        self.assertEqual(server.base_environ['SERVER_PORT'],
+                         to_bytes(address[1]))
+        self.serve(server)
+        self.check(self.exchange(self.request))
+
+    def testReusePort(self):
+        from web3ref.workers import SO_REUSEPORT
+        if SO_REUSEPORT is None:
+            return
+        self.serve(make_server('127.0.0.1', 0, path_app, reuse_port=True))
+        other = make_server('127.0.0.1', self.server.server_address[1],
+                            path_app, reuse_port=True)
+        other.server_close()
+        self.check(self.exchange(self.request))
+
+    def testListenFds(self):
+        from web3ref.workers import listen_fds
+        saved = dict(os.environ)
+        try:
+            os.environ['LISTEN_PID'] = str(os.getpid())
+            os.environ['LISTEN_FDS'] = '2'
+            self.assertEqual(listen_fds(), [3, 4])
+            self.assertFalse('LISTEN_FDS' in os.environ)
+            os.environ['LISTEN_PID'] = str(os.getpid() + 1)
+            os.environ['LISTEN_FDS'] = '2'
+            self.assertEqual(listen_fds(), [])
+        finally:
+            os.environ.clear()
+            os.environ.update(saved)
+
+def pid_app(environ):
+    return b'200 OK', [(b'Content-Type', b'text/plain')], [
+        to_bytes(os.getpid()) + b' ' + to_bytes(environ['web3.multiprocess'])]
+
+class RecyclingTests(ServerTestCase):
+
+    def get_pid(self):
+        out = self.exchange(b'GET / HTTP/1.0\r\n\r\n')
+        self.assertTrue(out.startswith(b'HTTP/1.0 200 OK\r\n'), out)
+        pid, multiprocess = out.split(b'\r\n\r\n', 1)[1].split()
+        self.assertEqual(multiprocess, b'True')
+        return int(pid)
+
+    def testMaxRequests(self):
+        self.serve(make_server('127.0.0.1', 0, pid_app, processes=2,
+                               max_requests=1))
+        pids = [self.get_pid() for i in range(4)]
+        self.assertEqual(len(set(pids)), 4)
+        self.assertFalse(os.getpid() in pids)
+
+    def testGracefulRestart(self):
+        import signal, time
+        server = make_server('127.0.0.1', 0, pid_app, processes=2)
+        self.serve(server)
+        old = set([self.get_pid() for i in range(4)])
+        while not server.children:
+            time.sleep(0.01)
+        server.queue_signal(signal.SIGHUP, None)
+        def running(pid):
+            try:
+                os.kill(pid, 0)     # until the supervisor reaps it
+            except OSError:
+                return False
+            return True
+        deadline = time.time() + 10
+        while ([pid for pid in old if running(pid)] or server.retiring) and \
+              time.time() < deadline:
+            self.get_pid()          # no request fails meanwhile
+        self.assertFalse(server.retiring)
+        self.assertFalse(set([self.get_pid() for i in range(4)]) & old)
+
+    def testFailedReexec(self):
+        import signal, time
+        server = make_server('127.0.0.1', 0, pid_app, processes=2)
+        events = []
+        server.log_event = events.append
+        self.serve(server)
+        self.get_pid()
+        executable = sys.executable
+        sys.executable = '/nonexistent/python'
+        try:
+            server.queue_signal(signal.SIGUSR2, None)
+            deadline = time.time() + 10
+            while not events and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            sys.executable = executable
+        self.assertEqual(len(events), 1)
+        self.assertTrue('status 127' in events[0], events)
+        self.assertTrue(server.supervising)
+        self.get_pid()
+
+    def testWorkerFailureLogged(self):
+        import tempfile, time
+        log = tempfile.TemporaryFile(mode='w+')
+        self.addCleanup(log.close)
+        server = make_server('127.0.0.1', 0, pid_app, processes=2)
+        def worker_started(number):
+            if number == 0:
+                raise RuntimeError('cannot start worker')
+        server.worker_started = worker_started
+        def log_event(message):
+            log.write(message + '\n')
+            log.flush()
+        server.log_event = log_event
+        self.serve(server)
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            log.seek(0)
+            text = log.read()
+            if 'exited with status 1' in text:
+                break
+            time.sleep(0.01)
+        self.assertTrue('worker 0 failed:' in text, text)
+        self.assertTrue('RuntimeError: cannot start worker' in text, text)
+        self.assertTrue('worker 0 (pid ' in text, text)
+        server.worker_started = lambda number: None
+
+    def testMemoryUsage(self):
+        from web3ref.workers import memory_usage
+        self.assertTrue(memory_usage() > 1024 * 1024)
+
+class StreamingTests(ServerTestCase):
+
+    def serve_body(self, body, **kw):
+        from web3ref.streaming import Sender
+        import threading
+        self.done = threading.Event()
+        def app(environ):
+            return b'200 OK', [(b'Content-Type', b'text/plain')], body
+        server = make_server('127.0.0.1', 0, app, threads=2)
+        server.enable_streaming(Sender(**kw))
+        self.serve(server)
+
+    def connect(self):
+        import socket
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.connect(self.server.server_address)
+        sock.sendall(b'GET / HTTP/1.0\r\n\r\n')
+        self.addCleanup(sock.close)
+        return sock
+
+    def read_all(self, sock):
+        chunks = []
+        while 1:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b''.join(chunks).split(b'\r\n\r\n', 1)[1]
+
+    def generate(self, count, size):
+        self.produced = 0
+        try:
+            for i in range(count):
+                self.produced += size
+                yield to_bytes(i % 10) * size
+        finally:
+            self.done.set()
+
+    def testReleasedOnceBuffered(self):
+        self.serve_body(self.generate(64, 16384), high_water=4*1024*1024)
+        sock = self.connect()
+        self.done.wait(5)
+        self.assertTrue(self.done.isSet())     # before the client reads
+        data = self.read_all(sock)
+        self.assertEqual(len(data), 64 * 16384)
+        self.assertEqual(data[-16384:], b'3' * 16384)
+
+    def testBackpressure(self):
+        import time
+        size, count = 65536, 512               # 32MB
+        self.serve_body(self.generate(count, size), high_water=65536,
+                        low_water=16384)
+        sock = self.connect()
+        time.sleep(0.5)
+        self.assertFalse(self.done.isSet())
+        self.assertTrue(self.produced < size * count / 2, self.produced)
+        data = self.read_all(sock)
+        self.assertEqual(len(data), size * count)
+        self.assertTrue(self.done.isSet())
+
+    def testSocketTimeout(self):
+        self.serve_body(self.generate(64, 16384), high_water=65536)
+        self.server.set_limits(body_timeout=5)
+        data = self.read_all(self.connect())
+        self.assertEqual(len(data), 64 * 16384)
+
+    def testFileBody(self):
+        import tempfile
+        from web3ref.util import FileWrapper
+        f = tempfile.TemporaryFile()
+        f.write(b'x' * 100000 + b'y')
+        f.seek(0)
+        self.serve_body(FileWrapper(f))
+        data = self.read_all(self.connect())
+        self.assertEqual(data, b'x' * 100000 + b'y')
+        self.assertTrue(f.closed)
+
+class QuietRequestHandler(Web3RequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+class LimitTests(ServerTestCase):
+
+    def serve_limited(self, app=path_app, threads=0, **limits):
+        server = make_server('127.0.0.1', 0, app, threads=threads,
+                             handler_class=QuietRequestHandler)
+        server.set_limits(**limits)
+        self.serve(server)
+
+    def testHeaderTimeout(self):
+        import socket, time
+        self.serve_limited(header_timeout=0.3)
+        sock = socket.create_connection(self.server.server_address)
+        self.addCleanup(sock.close)
+        sock.sendall(b'GET /l HTTP/1.0\r\n')
+        start = time.time()
+        try:
+            for i in range(20):             # dribbling headers doesn't help
+                sock.sendall(b'X-Slow: yes\r\n')
+                time.sleep(0.1)
+        except socket.error:
+            pass
+        sock.settimeout(5)
+        self.assertEqual(sock.recv(100), b'')
+        self.assertTrue(time.time() - start < 1.5)
+
+    def testRequestLineTooLong(self):
+        self.serve_limited(max_request_line=100)
+        out = self.exchange(b'GET /' + b'x' * 200 + b' HTTP/1.0\r\n\r\n')
+        self.assertTrue(out.startswith(b'HTTP/1.0 414 '), out)
+        out = self.exchange(b'GET /l HTTP/1.0\r\n\r\n')
+        self.assertTrue(out.startswith(b'HTTP/1.0 200 '), out)
+
+    def testHeadTooLarge(self):
+        self.serve_limited(max_header_size=1000)
+        out = self.exchange(b'GET /l HTTP/1.0\r\n' +
+                            b'X-Big: yes\r\n' * 100 + b'\r\n')
+        self.assertTrue(out.startswith(b'HTTP/1.0 431 '), out)
+
+    def testLoadShedding(self):
+        import socket, threading
+        entered = threading.Event()
+        release = threading.Event()
+        def slow_app(environ):
+            entered.set()
+            release.wait(5)
+            return path_app(environ)
+        self.serve_limited(slow_app, threads=1, max_pending=0, retry_after=7)
+        busy = socket.create_connection(self.server.server_address)
+        self.addCleanup(busy.close)
+        busy.sendall(b'GET /l HTTP/1.0\r\n\r\n')
+        entered.wait(5)
+        try:
+            out = self.exchange(b'GET /l HTTP/1.0\r\n\r\n')
+        finally:
+            release.set()
+        self.assertTrue(out.startswith(b'HTTP/1.0 503 '), out)
+        self.assertTrue(b'\r\nRetry-After: 7\r\n' in out, out)
+
+class FormTests(TestCase):
+
+    def environ(self, body, content_type):
+        from io import BytesIO
+        env = {}
+        setup_testing_defaults(env)
+        env['REQUEST_METHOD'] = b'POST'
+        env['CONTENT_TYPE'] = content_type
+        env['CONTENT_LENGTH'] = to_bytes(len(body))
+        env['web3.input'] = BytesIO(body)
+        return env
+
+    def multipart(self, parts, boundary=b'xYzZY'):
+        lines = [b'preamble']
+        for headers, content in parts:
+            lines.append(b'--' + boundary)
+            lines.extend(headers)
+            lines.append(b'')
+            lines.append(content)
+        lines.append(b'--' + boundary + b'--')
+        lines.append(b'epilogue')
+        return self.environ(b'\r\n'.join(lines),
+                            b'multipart/form-data; boundary="' + boundary +
+                            b'"')
+
+    def testUrlencoded(self):
+        from web3ref.forms import parse_form
+        env = self.environ(b'a=1&b=x+y%20z%2&a=%E2%82%AC&&c',
+                           b'application/x-www-form-urlencoded')
+        fields, files = parse_form(env, blksize=3)
+        self.assertEqual(fields, [(b'a', b'1'), (b'b', b'x y z%2'),
+                                  (b'a', b'\xe2\x82\xac'), (b'c', b'')])
+        self.assertEqual(files, [])
+        self.assertTrue(parse_form(env) is env['web3ref.form'])
+
+    def testMultipart(self):
+        from web3ref.forms import parse_form
+        upload = os.urandom(3000) + b'\r\n--xYzZ' + b'\r\n' * 10
+        env = self.multipart([
+            ([b'Content-Disposition: form-data; name="title"'], b'Hi\r\n'),
+            ([b'Content-Disposition: form-data; name="file"; '
+              b'filename="a; b.bin"', b'Content-Type: image/png'], upload),
+            ([b'Content-Disposition: form-data; name="empty"'], b''),
+        ])
+        for blksize in 1, 7, 65536:
+            env.pop('web3ref.form', None)
+            env['web3.input'].seek(0)
+            fields, files = parse_form(env, spool_size=1024, blksize=blksize)
+            self.assertEqual(fields, [(b'title', b'Hi\r\n'), (b'empty', b'')])
+            [(name, part)] = files
+            self.assertEqual((name, part.filename, part.content_type),
+                             (b'file', b'a; b.bin', b'image/png'))
+            self.assertEqual(part.size, len(upload))
+            self.assertEqual(part.read(), upload)
+            self.assertTrue(part.file._rolled)     # spooled to disk
+            part.close()
+
+    def testLimits(self):
+        from web3ref.forms import parse_form, FormError
+        env = self.multipart([
+            ([b'Content-Disposition: form-data; name="big"'], b'x' * 100)])
+        self.assertRaises(FormError, parse_form, env, max_field_size=50)
+        env = self.multipart([
+            ([b'Content-Disposition: form-data; name="a"'], b'1')] * 3)
+        self.assertRaises(FormError, parse_form, env, max_parts=2)
+        env = self.environ(b'a=1', b'application/x-www-form-urlencoded')
+        self.assertRaises(FormError, parse_form, env, max_size=2)
+        body = self.multipart([]).get('web3.input').getvalue()
+        env = self.environ(body[:-20], b'multipart/form-data; boundary=xYzZY')
+        self.assertRaises(FormError, parse_form, env)     # truncated
+
+    def testOtherContent(self):
+        from web3ref.forms import parse_form
+        env = self.environ(b'{}', b'application/json')
+        self.assertEqual(parse_form(env), ([], []))
+        self.assertEqual(env['web3.input'].read(), b'{}')
+
+class AccessLogTests(ServerTestCase):
+
+    def testServerLogsRequests(self):
+        from web3ref.accesslog import AccessLog, TIMED_FORMAT
+        stream = StringIO()
+        log = AccessLog(stream, TIMED_FORMAT, interval=60)
+        self.serve(make_server('127.0.0.1', 0, path_app, threads=2,
+                               handler_class=QuietRequestHandler,
+                               access_log=log))
+        self.exchange(b'GET /spam?x=1 HTTP/1.0\r\n\r\n')
+        self.exchange(b'GET /' + b'x' * 70000 + b' HTTP/1.0\r\n\r\n')
+        self.tearDown()             # flushes the log
+        self.server = None
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(re.match(
+            r'127\.0\.0\.1 - - \[\d\d/\w{3}/\d{4}:\d\d:\d\d:\d\d \+0000\] '
+            r'"GET /spam\?x=1 HTTP/1\.0" 200 15 \d+\.\d{3}$', lines[0]),
+            lines[0])
+        self.assertTrue(re.match(r'127\.0\.0\.1 - - \[.*\] "" 414 - ',
+                                 lines[1]), lines[1])
+
+    def testRingBuffer(self):
+        from web3ref.accesslog import AccessLog
+        stream = StringIO()
+        log = AccessLog(stream, '%(request_line)s %(status)s\n', size=4,
+                        interval=60)
+        log.pid = os.getpid()       # no writer thread; flushed by hand
+        for i in range(6):
+            log.record(0, '', 'r%d' % i, b'200', 0, 0.0)
+        self.assertEqual(log.dropped, 2)
+        log.flush()
+        log.record(0, '', 'r6', b'404', 0, 0.0)
+        log.flush()
+        self.assertEqual(stream.getvalue(),
+                         'r0 200\nr1 200\nr2 200\nr3 200\n'
+                         'access log: 2 records dropped\nr6 404\n')
+
+    def testEndOfBurstWritten(self):
+        import time
+        from web3ref.accesslog import AccessLog
+        stream = StringIO()
+        log = AccessLog(stream, '%(request_line)s\n', interval=0.1)
+        def wait_for(lines):
+            deadline = time.time() + 5
+            while stream.getvalue().count('\n') < lines and \
+                  time.time() < deadline:
+                time.sleep(0.01)
+        log.record(time.time(), '', 'r0', b'200', 0, 0.0)
+        wait_for(1)
+        # Within the interval: left for the writer to find
+        log.record(time.time(), '', 'r1', b'200', 0, 0.0)
+        log.record(time.time(), '', 'r2', b'200', 0, 0.0)
+        wait_for(3)
+        self.assertEqual(stream.getvalue(), 'r0\nr1\nr2\n')
+
+def failing_app(environ):
+    return 1 // len(environ['PATH_INFO'].strip(b'/'))
+
+class ErrorReporterTests(ServerTestCase):
+
+    def raise_in(self, reporter, path):
+        try:
+            failing_app({'PATH_INFO': path})
+        except ZeroDivisionError:
+            reporter.report(sys.exc_info())
+
+    def testRepeatsAreCounted(self):
+        from web3ref.errorlog import ErrorReporter
+        stream = StringIO()
+        reporter = ErrorReporter(stream, window=60)
+        for i in range(5):
+            self.raise_in(reporter, b'/')
+        try:
+            failing_app({})
+        except KeyError:
+            reporter.report(sys.exc_info())
+        reporter.flush()
+        out = stream.getvalue()
+        self.assertEqual(out.count('Traceback'), 2)
+        self.assertEqual(out.count('ZeroDivisionError'), 2)
+        self.assertTrue(out.endswith(
+            '[ZeroDivisionError: 4 repeats since last reported]\n'), out)
+        for entry in reporter.seen.values():
+            entry[0] = 0            # end the window
+        self.raise_in(reporter, b'/')
+        reporter.flush()
+        self.assertEqual(stream.getvalue().count('Traceback'), 3)
+
+    def testServerReportsErrors(self):
+        from web3ref.errorlog import ErrorReporter
+        stream = StringIO()
+        server = make_server('127.0.0.1', 0, failing_app, threads=2)
+        server.enable_error_reporter(ErrorReporter(stream))
+        self.serve(server)
+        for i in range(3):
+            out = self.exchange(b'GET / HTTP/1.0\r\n\r\n')
+            self.assertTrue(out.startswith(b'HTTP/1.0 500 '), out)
+        self.tearDown()             # flushes the reporter
+        self.server = None
+        out = stream.getvalue()
+        self.assertEqual(out.count('Traceback'), 1)
+        self.assertTrue(out.endswith(
+            '[ZeroDivisionError: 2 repeats since last reported]\n'), out)
+
+class TestClientTests(TestCase):
+
+    def testRequest(self):
+        from web3ref.testing import TestClient
+        from web3ref.forms import parse_form
+        closed = []
+        class Body(list):
+            def close(self):
+                closed.append(True)
+        def app(environ):
+            fields, files = parse_form(environ)
+            body = Body([environ['REQUEST_METHOD'], b' ',
+                         environ['PATH_INFO'], b' ', environ['QUERY_STRING'],
+                         b' ', environ.get('HTTP_X_TOKEN', b'-')])
+            body.extend(value for name, value in fields)
+            return b'200 OK', [(b'Content-Type', b'text/plain')], body
+        client = TestClient(app)
+        response = client.get(b'/a%20b?x=1', headers=[('X-Token', b't')])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.header(b'content-type'), b'text/plain')
+        self.assertEqual(response.body, b'GET /a b x=1 t')
+        self.assertEqual(closed, [True])
+        response = client.post(b'/f', b'v=42',
+                               b'application/x-www-form-urlencoded')
+        self.assertEqual(response.body, b'POST /f  -42')
+
+    def testAsyncAndInvalid(self):
+        from web3ref.testing import TestClient
+        polls = []
+        def app(environ):
+            def poll():
+                polls.append(1)
+                if len(polls) == 3:
+                    return b'204 No Content', [], []
+            return poll
+        client = TestClient(app)
+        client.poll_interval = 0
+        self.assertEqual(client.get().status, b'204 No Content')
+        self.assertEqual(len(polls), 3)
+        client = TestClient(lambda environ: (b'200OK', [], []))
+        self.assertRaises(AssertionError, client.get)
+
+    def testMapWithThreads(self):
+        import threading
+        from web3ref.testing import TestClient
+        threads = set()
+        def app(environ):
+            threads.add(threading.current_thread())
+            return b'200 OK', [], [environ['PATH_INFO']]
+        client = TestClient(app, threads=4)
+        paths = [('/%d' % i).encode('ascii') for i in range(50)]
+        responses = client.map([{'path': path} for path in paths])
+        self.assertEqual([r.body for r in responses], paths)
+        self.assertTrue(responses[0].environ['web3.multithread'])
+        self.assertFalse(threading.current_thread() in threads)
+
+class OffloadTests(TestCase):
+
+    def testOffloadedResponse(self):
+        import threading
+        from web3ref.handlers import OffloadedApp
+        from web3ref.testing import TestClient
+        closed = []
+        class Body:
+            def __iter__(self):
+                yield threading.current_thread().name.encode('ascii')
+                yield b'!'
+            def close(self):
+                closed.append(True)
+        def app(environ):
+            self.assertTrue(environ['web3.multithread'])
+            return b'200 OK', [], Body()
+        offloaded = OffloadedApp(app, threads=2)
+        response = TestClient(offloaded).get()
+        main = threading.current_thread().name.encode('ascii')
+        self.assertTrue(response.body.endswith(b'!'))
+        self.assertNotEqual(response.body, main + b'!')
+        self.assertEqual(closed, [True])
+        # Without web3.async, the application is called directly
+        environ = {'web3.async': False, 'web3.multithread': True}
+        self.assertEqual(offloaded(environ)[0], b'200 OK')
+
+    def testQueueLimitAndErrors(self):
+        import threading
+        from web3ref.handlers import OffloadedApp
+        release = threading.Event()
+        def app(environ):
+            release.wait()
+            if environ['PATH_INFO'] == b'/fail':
+                raise ValueError('fail')
+            return b'200 OK', [], [b'a', b'b']
+        offloaded = OffloadedApp(app, threads=1, max_queue=1)
+        first = offloaded({'web3.async': True, 'PATH_INFO': b'/'})
+        while offloaded.queued:     # until the thread has taken it
+            release.wait(0.001)
+        second = offloaded({'web3.async': True, 'PATH_INFO': b'/fail'})
+        busy = offloaded({'web3.async': True, 'PATH_INFO': b'/'})
+        self.assertEqual(busy[0], b'503 Service Unavailable')
+        self.assertEqual(first(), None)
+        release.set()
+        while 1:
+            result = first()
+            if result is not None:
+                break
+        status, headers, body = result
+        self.assertEqual(b''.join(body), b'ab')
+        while 1:
+            try:
+                if second() is not None:
+                    self.fail('no error raised')
+            except ValueError:
+                break
+
+class ProxyTests(TestCase):
+
+    def setUp(self):
+        import threading
+        try:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+            from socketserver import ThreadingMixIn
+        except ImportError:     # Python 2
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+            from SocketServer import ThreadingMixIn
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+        peers = self.peers = []
+        class Upstream(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def do_GET(self):
+                peers.append(self.client_address)
+                length = int(self.headers.get('content-length') or 0)
+                lines = [self.command + ' ' + self.path]
+                for name in 'host', 'x-forwarded-for', 'te', 'x-token':
+                    lines.append('%s=%s' % (name, self.headers.get(name)))
+                body = ('\n'.join(lines) + '\n').encode('latin-1')
+                body += self.rfile.read(length)
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Keep-Alive', 'timeout=5')
+                self.send_header('Set-Cookie', 'a=1')
+                self.send_header('Set-Cookie', 'b=2')
+                self.end_headers()
+                self.wfile.write(body)
+            do_POST = do_GET
+            def log_message(self, *args):
+                pass
+        self.upstream = Server(('127.0.0.1', 0), Upstream)
+        self.thread = threading.Thread(target=self.upstream.serve_forever,
+                                       args=(0.05,))
+        self.thread.start()
+
+    def tearDown(self):
+        self.app.close()
+        self.upstream.shutdown()
+        self.thread.join()
+        self.upstream.server_close()
+
+    def proxy(self, **kw):
+        from web3ref.proxy import Proxy
+        from web3ref.testing import TestClient
+        url = 'http://127.0.0.1:%d/up' % self.upstream.server_address[1]
+        self.app = Proxy(url, **kw)
+        return TestClient(self.app)
+
+    def testMountedUnderPrefix(self):
+        from web3ref.util import shift_path_info
+        client = self.proxy()
+        def mounted(environ):
+            shift_path_info(environ)
+            return self.app(environ)
+        client.app = mounted
+        response = client.get(b'/api/x%2Fy')
+        self.assertEqual(response.body.splitlines()[0], b'GET /up/api/x%2Fy')
+        # Without RAW_PATH_INFO, as from a gateway
+        response = client.get(b'/x', environ={'SCRIPT_NAME': b'/api',
+                                               'RAW_PATH_INFO': None})
+        self.assertEqual(response.body.splitlines()[0], b'GET /up/api/x')
+
+    def testForwarding(self):
+        client = self.proxy()
+        response = client.get(b'/a%2Fb?x=1', headers=[
+            ('X-Token', b't'), ('TE', b'trailers'), ('Connection', b'TE'),
+            ('X-Forwarded-For', b'10.0.0.1')])
+        self.assertEqual(response.status, b'200 OK')
+        self.assertEqual(response.body.splitlines(), [
+            b'GET /up/a%2Fb?x=1', b'host=localhost',
+            b'x-forwarded-for=10.0.0.1, 127.0.0.1', b'te=None', b'x-token=t'])
+        names = [name.lower() for name, value in response.headers]
+        self.assertFalse(b'keep-alive' in names)
+        self.assertEqual(names.count(b'set-cookie'), 2)
+        response = client.post(b'/', b'x' * 200000, b'text/plain',
+                               headers=[('X-Host', b'example.org')])
+        lines = response.body.split(b'\n', 5)
+        self.assertEqual(lines[1], b'host=example.org')
+        self.assertEqual(lines[5], b'x' * 200000)
+
+    def testConnectionReuse(self):
+        client = self.proxy(pool_size=2)
+        for i in range(3):
+            client.get()
+        self.assertEqual(len(self.peers), 3)
+        self.assertEqual(len(set(self.peers)), 1)
+        self.app.close()
+        client.get()
+        self.assertEqual(len(set(self.peers)), 2)
+
+    def testBadGateway(self):
+        client = self.proxy()
+        self.app.port = 1           # nothing listens there
+        self.assertEqual(client.get().status, b'502 Bad Gateway')
+
+    def testRetryIdempotentOnly(self):
+        import socket
+        client = self.proxy()
+        client.get()                # leaves a connection in the pool
+        sent = []
+        send = self.app.send
+        def fail_first(connection, method, *args):
+            sent.append(method)
+            if len(sent) == 1:
+                raise socket.error('connection reset by peer')
+            return send(connection, method, *args)
+        self.app.send = fail_first
+        self.assertEqual(client.get().status, b'200 OK')
+        self.assertEqual(sent, ['GET', 'GET'])
+        del sent[:]
+        # The upstream server may have seen it: not sent twice
+        self.assertEqual(client.request(b'POST').status, b'502 Bad Gateway')
+        self.assertEqual(sent, ['POST'])
+
+    def testBadContentLength(self):
+        client = self.proxy()
+        for length in b'ten', b'-1':
+            response = client.request(b'POST', environ={
+                'CONTENT_LENGTH': length})
+            self.assertEqual(response.status, b'400 Bad Request')
+        self.assertEqual(self.peers, [])
+
+class SSETests(ServerTestCase):
+
+    def testFormatEvent(self):
+        from web3ref.sse import format_event
+        self.assertEqual(format_event(b'a\nb', event=b'e', id=b'7'),
+                         b'event: e\nid: 7\ndata: a\ndata: b\n\n')
+        self.assertEqual(format_event(b'', retry=500),
+                         b'retry: 500\ndata: \n\n')
+
+    def testIteratedStream(self):
+        import threading
+        from web3ref.sse import Channel
+        from web3ref.testing import TestClient
+        channel = Channel(heartbeat=0, retry=1000)
+        def publish():
+            while not channel.subscribers:
+                channel.stopped.wait(0.001)
+            channel.publish(b'one')
+            channel.publish(b'two', event=b'x')
+            channel.close()
+        thread = threading.Thread(target=publish)
+        thread.start()
+        response = TestClient(lambda environ: channel.response()).get()
+        thread.join()
+        self.assertEqual(response.header(b'Content-Type'),
+                         b'text/event-stream')
+        self.assertEqual(response.body, b'retry: 1000\n\n'
+                         b'data: one\n\nevent: x\ndata: two\n\n')
+
+    def testStreamsHoldNoThreads(self):
+        import socket
+        from web3ref.sse import Channel
+        channel = Channel(heartbeat=0.05)
+        self.addCleanup(channel.close)
+        self.serve(make_server('127.0.0.1', 0, lambda e: channel.response(),
+                               threads=1, streaming=True,
+                               handler_class=QuietRequestHandler))
+        clients = []
+        for i in range(3):
+            sock = socket.create_connection(self.server.server_address)
+            sock.sendall(b'GET /feed HTTP/1.0\r\n\r\n')
+            sock.settimeout(5)
+            data = b''
+            while not data.endswith(b':\n\n'):
+                data += sock.recv(4096)
+            self.assertTrue(data.startswith(b'HTTP/1.0 200 OK\r\n'))
+            clients.append(sock)
+        # One request thread served all three streams
+        self.assertEqual(len(channel.subscribers), 3)
+        clients.pop().close()
+        channel.publish(b'hello')
+        for sock in clients:
+            data = b''
+            while not data.endswith(b'data: hello\n\n'):
+                data += sock.recv(4096)
+        # The closed client is found by a heartbeat, then dropped
+        for i in range(100):
+            if len(channel.subscribers) == 2:
+                break
+            channel.stopped.wait(0.05)
+        self.assertEqual(len(channel.subscribers), 2)
+        channel.close()
+        for sock in clients:
+            while sock.recv(4096):
+                pass
+            sock.close()
+
+def websocket_echo_app(environ):
+    from web3ref.websocket import accept
+    ws = accept(environ)
+    if ws is None:
+        return b'400 Bad Request', [(b'Content-Type', b'text/plain')], [b'']
+    for opcode, message in ws:
+        ws.send(message, opcode)
+    return b'101 Switching Protocols', [], []
+
+class WebSocketTests(ServerTestCase):
+
+    def testMask(self):
+        from web3ref.websocket import mask
+        key = b'\x01\x02\x03\x04'
+        data = bytearray(range(256)) * 3
+        masked = mask(data, key)
+        self.assertEqual(masked, bytes(bytearray(
+            b ^ bytearray(key)[i % 4] for i, b in enumerate(data))))
+        self.assertEqual(mask(memoryview(bytearray(masked)), key),
+                         bytes(data))
+        self.assertEqual(mask(b'\x00\x00\x00', key), b'\x01\x02\x03')
+        self.assertEqual(mask(b'', key), b'')
+
+    def testFrames(self):
+        from web3ref.websocket import (FrameParser, ProtocolError,
+                                       encode_frame, OP_TEXT, OP_PING)
+        parser = FrameParser()
+        data = (encode_frame(OP_TEXT, b'hello', False, b'abcd') +
+                encode_frame(0, b'x' * 300, True, b'wxyz') +
+                encode_frame(OP_PING, b'', True, b'\0\0\0\0'))
+        frames = []
+        for i in range(0, len(data), 7):     # arriving in pieces
+            parser.feed(data[i:i + 7])
+            frames.extend(parser.frames())
+        self.assertEqual(frames, [(False, OP_TEXT, b'hello'),
+                                  (True, 0, b'x' * 300),
+                                  (True, OP_PING, b'')])
+        self.assertEqual(len(parser.buffer), 0)
+        self.assertEqual(encode_frame(OP_TEXT, b'hi'), b'\x81\x02hi')
+        parser.feed(encode_frame(OP_TEXT, b'unmasked'))
+        self.assertRaises(ProtocolError, parser.frames)
+        parser = FrameParser(max_size=10)
+        parser.feed(encode_frame(OP_TEXT, b'x' * 11, mask_key=b'abcd'))
+        try:
+            parser.frames()
+        except ProtocolError as e:
+            self.assertEqual(e.code, 1009)
+        else:
+            self.fail('oversized frame accepted')
+
+    def handshake(self, sock):
+        from web3ref.websocket import accept_key
+        key = b'dGhlIHNhbXBsZSBub25jZQ=='
+        sock.sendall(b'GET /chat HTTP/1.1\r\nHost: localhost\r\n'
+                     b'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+                     b'Sec-WebSocket-Key: ' + key + b'\r\n'
+                     b'Sec-WebSocket-Version: 13\r\n\r\n')
+        data = b''
+        while b'\r\n\r\n' not in data:
+            data += sock.recv(4096)
+        self.assertEqual(accept_key(key), b's3pPLMBiTxaQ9kYGzzhZRbK+xOo=')
+        self.assertTrue(data.startswith(
+            b'HTTP/1.1 101 Switching Protocols\r\n'))
+        self.assertTrue(b'Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo='
+                        in data)
+        return data.split(b'\r\n\r\n', 1)[1]
+
+    def echo(self, streaming):
+        import socket
+        from web3ref.websocket import (FrameParser, encode_frame, OP_TEXT,
+                                       OP_BINARY, OP_PING, OP_PONG, OP_CLOSE)
+        self.serve(make_server('127.0.0.1', 0, websocket_echo_app, threads=1,
+                               streaming=streaming,
+                               handler_class=QuietRequestHandler))
+        sock = socket.create_connection(self.server.server_address)
+        sock.settimeout(5)
+        parser = FrameParser(masked=False)
+        parser.feed(self.handshake(sock))
+        sock.sendall(encode_frame(OP_TEXT, b'hel', False, b'k3y!') +
+                     encode_frame(OP_PING, b'p', True, b'k3y!') +
+                     encode_frame(0, b'lo', True, b'k3y!') +
+                     encode_frame(OP_BINARY, b'\0' * 70000, True, b'k3y!') +
+                     encode_frame(OP_CLOSE, b'\x03\xe8', True, b'k3y!'))
+        frames = []
+        while 1:
+            data = sock.recv(65536)
+            if not data:
+                break
+            parser.feed(data)
+            frames.extend(parser.frames())
+        sock.close()
+        self.assertEqual(frames, [(True, OP_PONG, b'p'),
+                                  (True, OP_TEXT, b'hello'),
+                                  (True, OP_BINARY, b'\0' * 70000),
+                                  (True, OP_CLOSE, b'\x03\xe8')])
+
+    def testEcho(self):
+        self.echo(False)
+
+    def testStreamingEcho(self):
+        self.echo(True)
+
+    def testNotUpgraded(self):
+        self.serve(make_server('127.0.0.1', 0, websocket_echo_app,
+                               handler_class=QuietRequestHandler))
+        data = self.exchange(b'GET / HTTP/1.0\r\nUpgrade: websocket\r\n\r\n')
+        self.assertTrue(data.startswith(b'HTTP/1.0 400 Bad Request\r\n'))
+
+def allocating_app(environ):
+    allocating_app.kept.append(b'x' * 100000)
+    return b'200 OK', [(b'Content-Type', b'text/plain')], [b'ok']
+allocating_app.kept = []
+
+class AllocationTrackerTests(ServerTestCase):
+
+    def setUp(self):
+        try:
+            import tracemalloc
+        except ImportError:
+            self.skipTest('tracemalloc is not available')
+        self.addCleanup(tracemalloc.stop)
+        self.addCleanup(allocating_app.kept.__delitem__, slice(None))
+
+    def testRoutes(self):
+        from web3ref.memtrack import AllocationTracker
+        tracker = AllocationTracker(depth=1, sample=2, max_routes=2)
+        self.assertEqual(tracker.route({'PATH_INFO': b'/api/users/7'}),
+                         b'/api')
+        self.assertEqual(tracker.route({'PATH_INFO': b'/'}), b'/')
+        tracker.depth = 2
+        self.assertEqual(tracker.route({'PATH_INFO': b'/api/users/7'}),
+                         b'/api/users')
+        tracker.depth = 1
+        for path in (b'/a/1', b'/a/2', b'/b', b'/c', b'/d'):
+            mark = tracker.begin()
+            allocating_app({})
+            tracker.end(mark, tracker.route({'PATH_INFO': path}))
+        self.assertEqual(sorted(tracker.routes), [b'(other)', b'/a', b'/b'])
+        stats = tracker.routes[b'/a']
+        self.assertEqual(stats.requests, 2)
+        self.assertEqual(stats.sampled, 1)
+        self.assertTrue(stats.size >= 200000)
+        self.assertTrue(stats.blocks >= 2)
+        report = tracker.report()
+        self.assertTrue(report.startswith('/a: 2 requests'))
+        self.assertTrue('tests.py:' in report)
+
+    def testServer(self):
+        import tempfile, shutil
+        from web3ref.memtrack import AllocationTracker
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        tracker = AllocationTracker(sample=1, path=os.path.join(tmp, 'dump'))
+        server = make_server('127.0.0.1', 0, allocating_app,
+                             handler_class=QuietRequestHandler)
+        server.enable_allocation_tracker(tracker)
+        self.serve(server)
+        for i in range(3):
+            self.exchange(b'GET /leaky/%d HTTP/1.0\r\n\r\n' % i)
+        server.stop_pool()
+        with open(tracker.path) as f:
+            self.assertTrue(f.read().startswith('/leaky: 3 requests'))
+        status, headers, body = tracker.app({})
+        self.assertTrue(body[0].startswith(b'/leaky: 3 requests'))
+
+    def testRouteTakenBeforeApplication(self):
+        from web3ref.memtrack import AllocationTracker
+        from web3ref.util import shift_path_info
+        tracker = AllocationTracker(sample=0)
+        class Handler(TestHandler):
+            allocation_tracker = tracker
+        def dispatching_app(environ):
+            shift_path_info(environ)
+            return allocating_app(environ)
+        Handler(PATH_INFO=b'/leaky/deeper').run(dispatching_app)
+        self.assertEqual(list(tracker.routes), [b'/leaky'])
+
+class CaptureTests(TestCase):
+
+    def setUp(self):
+        import tempfile, shutil
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.path = os.path.join(tmp, 'traffic.cap')
+
+    def testRecordAndReplay(self):
+        from web3ref.capture import Recorder, read_records, replay
+        from web3ref.testing import TestClient
+        recorder = Recorder(echo_app, self.path, sample=2)
+        client = TestClient(recorder)
+        for i in range(4):
+            response = client.post(b'/echo/%d' % i, b'body %d' % i,
+                                   headers={b'X-Seq': b'%d' % i})
+            self.assertTrue(response.body.startswith(
+                b'POST /echo/%d body %d ' % (i, i)))
+        recorder.close()
+        records = list(read_records(self.path))
+        self.assertEqual(len(records), 2)
+        timestamp, environ, body = records[0]
+        self.assertEqual(body, b'body 1')
+        self.assertEqual(environ['PATH_INFO'], b'/echo/1')
+        self.assertEqual(environ['HTTP_X_SEQ'], b'1')
+        self.assertEqual(environ['CONTENT_LENGTH'], b'6')
+        self.assertFalse([key for key in environ if key.startswith('web3')])
+        seen = []
+        def app(environ):
+            seen.append(environ['PATH_INFO'] + b' ' +
+                        environ['web3.input'].read())
+            return b'200 OK', [(b'Content-Type', b'text/plain')], [b'ok']
+        results = replay(records, app, speed=1000)
+        self.assertEqual(seen, [b'/echo/1 body 1', b'/echo/3 body 3'])
+        self.assertEqual([result[:2] for result in results],
+                         [(b'200 OK', 2), (b'200 OK', 2)])
+        results = replay(records * 10, failing_app, threads=4)
+        self.assertEqual(len(results), 20)
+        self.assertEqual(results[0][0][:3], b'500')
+
+    def testProcessEnvironmentLeftOut(self):
+        from web3ref.capture import Recorder, read_records
+        from web3ref.handlers import SimpleHandler
+        from web3ref.util import BytesIO, StringIO
+        recorder = Recorder(echo_app, self.path)
+        class Handler(SimpleHandler):
+            os_environ = {'SECRET_TOKEN': b'hunter2', 'HOME': b'/root'}
+        env = {'REQUEST_METHOD': b'GET', 'PATH_INFO': b'/', 'HTTP_HOST':
+               b'example.com', 'SERVER_NAME': b'example.com',
+               'SERVER_PORT': b'80', 'SERVER_PROTOCOL': b'HTTP/1.0'}
+        Handler(BytesIO(), BytesIO(), StringIO(), env).run(recorder)
+        recorder.close()
+        [(timestamp, environ, body)] = read_records(self.path)
+        self.assertEqual(environ, env)
+
+    def testLimits(self):
+        from web3ref.capture import Recorder, read_records, MAGIC
+        from web3ref.testing import TestClient
+        recorder = Recorder(echo_app, self.path, max_body=5)
+        client = TestClient(recorder)
+        client.post(b'/big', b'too large')
+        client.get(b'/small')
+        recorder.close()
+        self.assertEqual(recorder.dropped, 1)
+        self.assertEqual([environ['PATH_INFO'] for t, environ, body
+                          in read_records(self.path)], [b'/small'])
+        # Appending to an existing capture, and a record cut short
+        recorder = Recorder(echo_app, self.path)
+        TestClient(recorder).get(b'/again')
+        recorder.close()
+        with open(self.path, 'ab') as f:
+            f.write(b'\0' * 10)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(len(MAGIC)), MAGIC)
+        self.assertEqual([environ['PATH_INFO'] for t, environ, body
+                          in read_records(self.path)],
+                         [b'/small', b'/again'])
+
+    def testEndOfBurstWritten(self):
+        import time
+        from web3ref.capture import Recorder, read_records
+        from web3ref.testing import TestClient
+        recorder = Recorder(echo_app, self.path, interval=0.1)
+        self.addCleanup(recorder.close)
+        client = TestClient(recorder)
+        def wait_for(count):
+            deadline = time.time() + 5
+            while time.time() < deadline:
+                if os.path.exists(self.path) and \
+                   len(list(read_records(self.path))) >= count:
+                    break
+                time.sleep(0.01)
+        client.get(b'/0')
+        wait_for(1)
+        # Within the interval: left for the writer to find
+        client.get(b'/1')
+        client.get(b'/2')
+        wait_for(3)
+        self.assertEqual([environ['PATH_INFO'] for t, environ, body
+                          in read_records(self.path)], [b'/0', b'/1', b'/2'])
+
+class RateLimitTests(TestCase):
+
+    def testBuckets(self):
+        from web3ref.ratelimit import SharedBuckets
+        buckets = SharedBuckets(rate=2, burst=3, slots=16, ways=4)
+        self.addCleanup(buckets.close)
+        now = 1000.0
+        self.assertEqual([buckets.take(b'a', now) for i in range(4)],
+                         [True, True, True, False])
+        self.assertTrue(buckets.take(b'b', now))
+        self.assertFalse(buckets.take(b'a', now + 0.25))
+        self.assertTrue(buckets.take(b'a', now + 0.5))
+        self.assertFalse(buckets.take(b'a', now + 0.5))
+        # Refilling stops at 'burst'
+        self.assertEqual([buckets.take(b'a', now + 100) for i in range(4)],
+                         [True, True, True, False])
+        # A full table forgets the clients seen longest ago
+        buckets = SharedBuckets(rate=0.001, burst=1, slots=4, ways=4)
+        self.addCleanup(buckets.close)
+        self.assertTrue(buckets.take(b'a', now))
+        self.assertFalse(buckets.take(b'a', now))
+        for i in range(4):
+            self.assertTrue(buckets.take(b'client %d' % i, now + 1 + i))
+        self.assertTrue(buckets.take(b'a', now + 5))
+
+    def testSharedAcrossProcesses(self):
+        from web3ref.ratelimit import SharedBuckets
+        if not hasattr(os, 'fork'):
+            self.skipTest('no fork()')
+        buckets = SharedBuckets(rate=0.001, burst=5)
+        self.addCleanup(buckets.close)
+        pids = []
+        for i in range(2):
+            pid = os.fork()
+            if not pid:
+                try:
+                    buckets.take(b'10.0.0.1')
+                    buckets.take(b'10.0.0.1')
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        self.assertTrue(buckets.take(b'10.0.0.1'))
+        self.assertFalse(buckets.take(b'10.0.0.1'))
+
+    def testMiddleware(self):
+        from web3ref.ratelimit import RateLimiter
+        from web3ref.testing import TestClient
+        limiter = RateLimiter(echo_app, rate=0.5, burst=2,
+                              key='HTTP_X_REAL_IP')
+        self.addCleanup(limiter.buckets.close)
+        client = TestClient(limiter)
+        one = {'headers': [(b'X-Real-IP', b'10.0.0.1')]}
+        two = {'headers': [(b'X-Real-IP', b'10.0.0.2')]}
+        one_environ = {'HTTP_X_REAL_IP': b'10.0.0.1'}
+        self.assertEqual([client.get(**one).status_code for i in range(3)],
+                         [200, 200, 429])
+        response = client.get(**one)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.header(b'Retry-After'), b'2')
+        self.assertEqual(response.body, b'Too Many Requests\n')
+        self.assertEqual(client.get(**two).status_code, 200)
+        self.assertEqual(client.get().status_code, 200)  # no key, no limit
+        first = limiter(one_environ)
+        first[1].append((b'X-Added', b'1'))
+        self.assertEqual(len(limiter(one_environ)[1]), 3)
+        self.assertRaises(ValueError, RateLimiter, echo_app, rate=0)
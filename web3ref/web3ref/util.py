@@ -1,14 +1,170 @@
 """Miscellaneous Web3-related Utilities"""
 
+import os
 import posixpath
+import threading
+from collections import OrderedDict
+
+try:
+    from StringIO import StringIO
+    BytesIO = StringIO          # str is bytes on Python 2
+except ImportError:
+    from io import BytesIO
+    from io import StringIO
 
 __all__ = [
-    'guess_scheme', 'application_uri', 'request_uri',
-    'shift_path_info', 'setup_testing_defaults', 'CRLF'
+    'FileWrapper', 'LimitedInput', 'MultiDict', 'guess_scheme',
+    'application_uri', 'request_uri', 'shift_path_info',
+    'setup_testing_defaults', 'apply_filter', 'quote', 'unquote',
+    'unquote_plus', 'parse_qsl', 'parse_query', 'CRLF'
 ]
 
 CRLF = b'\r\n'
 
+class FileWrapper:
+    """Wrapper to convert file-like objects to iterables
+
+    Handlers that support it (see 'BaseHandler.sendfile') transmit a
+    FileWrapper body straight from the file descriptor returned by
+    'file_range()' instead of iterating over it.
+    """
+
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+        if hasattr(filelike,'close'):
+            self.close = filelike.close
+
+    def __getitem__(self,key):
+        data = self.filelike.read(self.blksize)
+        if data:
+            return data
+        raise IndexError
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        data = self.filelike.read(self.blksize)
+        if data:
+            return data
+        raise StopIteration
+
+    __next__ = next     # Python 3
+
+    def file_range(self):
+        """Return '(fd, offset, length)' of the remaining data, or None
+
+        None means the data can only be had by iterating, e.g. because the
+        wrapped object isn't backed by an operating system file.
+        """
+        try:
+            fd = self.filelike.fileno()
+            offset = self.filelike.tell()
+        except (AttributeError, IOError, OSError, ValueError):
+            return None
+        return fd, offset, os.fstat(fd).st_size - offset
+
+class LimitedInput:
+    """Wrapper making an input stream length-delimited, for 'web3.input'
+
+    At most 'length' bytes (normally CONTENT_LENGTH) are ever requested from
+    the wrapped stream, so that reading the body to its end can't block on,
+    or consume, data sent after the request.
+    """
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size <= 0:
+            return b''
+        data = self.stream.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size <= 0:
+            return b''
+        data = self.stream.readline(size)
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        lines = []
+        total = 0
+        while hint is None or hint <= 0 or total < hint:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+            total += len(line)
+        return lines
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if line:
+            return line
+        raise StopIteration
+
+    __next__ = next     # Python 3
+
+class MultiDict:
+    """Read-only mapping of names to one or more values
+
+    'd[name]' and 'd.get(name)' give the first value sent for 'name', and
+    'd.getall(name)' all of them; 'd.items()' lists every '(name, value)'
+    pair in the original order.
+    """
+
+    def __init__(self, pairs=()):
+        self.pairs = tuple(pairs)
+        lists = {}
+        for name, value in self.pairs:
+            if name in lists:
+                lists[name].append(value)
+            else:
+                lists[name] = [value]
+        self.lists = lists
+
+    def __repr__(self):
+        return 'MultiDict(%r)' % (list(self.pairs),)
+
+    def __getitem__(self, name):
+        return self.lists[name][0]
+
+    def get(self, name, default=None):
+        values = self.lists.get(name)
+        if values is None:
+            return default
+        return values[0]
+
+    def getall(self, name):
+        return list(self.lists.get(name, ()))
+
+    def __contains__(self, name):
+        return name in self.lists
+
+    def __iter__(self):
+        return iter(self.lists)
+
+    def __len__(self):
+        return len(self.lists)
+
+    def keys(self):
+        return list(self.lists)
+
+    def items(self):
+        return list(self.pairs)
+
 def guess_scheme(environ):
     """Return a guess for whether 'web3.url_scheme' should be 'http' or 'https'
     """
@@ -20,7 +176,6 @@ def guess_scheme(environ):
 def application_uri(environ):
     """Return the application's base URI (no PATH_INFO or QUERY_STRING)"""
     url = environ['web3.url_scheme']+b'://'
-    from urllib import quote
 
     if environ.get('HTTP_HOST'):
         url += environ['HTTP_HOST']
@@ -29,10 +184,10 @@ def application_uri(environ):
 
         if environ['web3.url_scheme'] == b'https':
             if environ['SERVER_PORT'] != b'443':
-                url += ':' + environ['SERVER_PORT']
+                url += b':' + environ['SERVER_PORT']
         else:
             if environ['SERVER_PORT'] != b'80':
-                url += ':' + environ['SERVER_PORT']
+                url += b':' + environ['SERVER_PORT']
 
     url += quote(environ.get('SCRIPT_NAME') or b'/')
     return url
@@ -40,7 +195,6 @@ def application_uri(environ):
 def request_uri(environ, include_query=1):
     """Return the full request URI, optionally including the query string"""
     url = application_uri(environ)
-    from urllib import quote
     path_info = quote(environ.get('PATH_INFO', b''))
     if not environ.get('SCRIPT_NAME'):
         url += path_info[1:]
@@ -119,8 +273,7 @@ def setup_testing_defaults(environ):
     environ.setdefault('web3.multithread', 0)
     environ.setdefault('web3.multiprocess', 0)
 
-    from StringIO import StringIO
-    environ.setdefault('web3.input', StringIO(""))
+    environ.setdefault('web3.input', BytesIO(b""))
     environ.setdefault('web3.errors', StringIO())
     environ.setdefault('web3.url_scheme',guess_scheme(environ))
 
@@ -129,15 +282,136 @@ def setup_testing_defaults(environ):
     elif environ['web3.url_scheme']==b'https':
         environ.setdefault('SERVER_PORT', b'443')
 
+def apply_filter(app, environ, filter_func):
+    """Pass the response of 'app' to 'filter_func' once it is ready
+
+    'filter_func' is called with the 'status', 'headers' and 'body' of the
+    response and must return a new response tuple.  Synchronous responses
+    are filtered immediately; for asynchronous ones (see 'web3.async') a new
+    polling callable is returned which filters the response when it arrives.
+    """
+    app_response = app(environ)
+
+    if not hasattr(app_response, '__call__'):
+        return filter_func(*app_response)
+
+    def polling_function():
+        rv = app_response()
+        if rv is not None:
+            return filter_func(*rv)
+    return polling_function
+
 _hoppish = {
     'connection':1, 'keep-alive':1, 'proxy-authenticate':1,
     'proxy-authorization':1, 'te':1, 'trailers':1, 'transfer-encoding':1,
     'upgrade':1
     }
+# Web3 header names are bytes
+_hoppish.update([(name.encode('ascii'), 1) for name in list(_hoppish)])
 
 def is_hop_by_hop(header_name):
     """Return true if 'header_name' is an HTTP/1.1 "Hop-by-Hop" header"""
     return header_name.lower() in _hoppish
 
+# '%xx' escape (without the '%') -> decoded byte, for every case variant
+_hexdig = '0123456789ABCDEFabcdef'
+_hextobyte = dict([
+    ((a + b).encode('ascii'), bytes(bytearray([int(a + b, 16)])))
+    for a in _hexdig for b in _hexdig
+])
+
+def unquote(value):
+    """Decode the percent escapes in 'value', bytes to bytes
+
+    Invalid escapes are left alone.  Without any escapes, 'value' itself is
+    returned, uncopied.
+    """
+    if b'%' not in value:
+        return value
+    pieces = value.split(b'%')
+    result = [pieces[0]]
+    append = result.append
+    for piece in pieces[1:]:
+        try:
+            append(_hextobyte[piece[:2]])
+            append(piece[2:])
+        except KeyError:
+            append(b'%')
+            append(piece)
+    return b''.join(result)
+
+_always_safe = (b'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+                b'abcdefghijklmnopqrstuvwxyz'
+                b'0123456789_.-~')
+_quote_tables = {}      # safe characters -> 256-entry byte -> output table
+
+def quote(value, safe=b'/'):
+    """Percent-encode 'value' for use in a URL, bytes to bytes
+
+    Letters, digits, '_.-~' and the characters in 'safe' are kept as they
+    are.  If there is nothing to encode, 'value' itself is returned.
+    """
+    safe += _always_safe
+    if not value.strip(safe):
+        return value
+    table = _quote_tables.get(safe)
+    if table is None:
+        keep = bytearray(safe)
+        table = _quote_tables[safe] = [
+            c in keep and bytes(bytearray([c])) or
+            ('%%%02X' % c).encode('ascii')
+            for c in range(256)
+        ]
+    return b''.join([table[c] for c in bytearray(value)])
+
+def unquote_plus(value):
+    """Decode a form-encoded query string component, bytes to bytes"""
+    if b'+' in value:
+        value = value.replace(b'+', b' ')
+    return unquote(value)
+
+def parse_qsl(query):
+    """Split a query string into a list of decoded '(name, value)' pairs
+
+    Empty fields are skipped; a field without '=' has an empty value.
+    """
+    pairs = []
+    for field in query.split(b'&'):
+        if field:
+            name, sep, value = field.partition(b'=')
+            pairs.append((unquote_plus(name), unquote_plus(value)))
+    return pairs
+
+_parsed_queries = OrderedDict()     # query string -> MultiDict, LRU order
+_parsed_queries_lock = threading.Lock()
+_parsed_queries_max = 256
+_cacheable_query = 1024             # longer ones are rarely repeated
+
+def parse_query(environ):
+    """Return QUERY_STRING parsed into a MultiDict
+
+    The result is kept in the environ under 'web3ref.query', so middleware
+    and the application share one parse (as long as QUERY_STRING isn't
+    changed), and recently seen query strings are remembered across
+    requests.  The MultiDict is shared, and must not be modified.
+    """
+    query = environ.get('QUERY_STRING', b'')
+    memo = environ.get('web3ref.query')
+    if memo is not None and memo[0] == query:
+        return memo[1]
+    with _parsed_queries_lock:
+        parsed = _parsed_queries.pop(query, None)
+        if parsed is not None:
+            _parsed_queries[query] = parsed     # most recently used goes last
+    if parsed is None:
+        parsed = MultiDict(parse_qsl(query))
+        if len(query) <= _cacheable_query:
+            with _parsed_queries_lock:
+                _parsed_queries[query] = parsed
+                if len(_parsed_queries) > _parsed_queries_max:
+                    _parsed_queries.popitem(last=False)
+    environ['web3ref.query'] = (query, parsed)
+    return parsed
+
 def to_bytes(data):
     return str(data).encode('ascii')
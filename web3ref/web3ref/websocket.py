@@ -0,0 +1,301 @@
+"""WebSocket (RFC 6455) connections over the 'web3ref.upgrade' extension
+
+Usage::
+
+    from web3ref.websocket import accept
+
+    def echo_app(environ):
+        ws = accept(environ)
+        if ws is None:
+            return (b'400 Bad Request', [(b'Content-Type', b'text/plain')],
+                    [b'WebSocket requests only\\n'])
+        for opcode, message in ws:
+            ws.send(message, opcode)
+        return b'101 Switching Protocols', [], []
+
+'accept()' completes the opening handshake through the server's
+'web3ref.upgrade' callable (see 'simple_server.Web3RequestHandler.upgrade')
+and returns a WebSocket, which reads and writes frames on the socket from
+the application's thread.  To serve the connection from an event loop
+instead, 'detach()' it and feed what arrives on the socket to a
+FrameParser, which decodes frames incrementally; 'encode_frame()' builds
+them.
+
+Masking, which every client frame needs undone, XORs the whole payload at
+once as a single large integer rather than looping over its bytes, and
+accepts bytes, bytearray or memoryview, so payloads are unmasked straight
+out of the receive buffer.
+"""
+
+import struct
+import threading
+from base64 import b64encode
+from binascii import hexlify
+from binascii import unhexlify
+from hashlib import sha1
+
+__all__ = [
+    'ProtocolError', 'FrameParser', 'WebSocket', 'accept', 'accept_key',
+    'encode_frame', 'mask', 'OP_CONTINUATION', 'OP_TEXT', 'OP_BINARY',
+    'OP_CLOSE', 'OP_PING', 'OP_PONG',
+]
+
+GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+_short = struct.Struct('!BB')
+_medium = struct.Struct('!BBH')
+_long = struct.Struct('!BBQ')
+
+class ProtocolError(ValueError):
+    """The peer broke the protocol; 'code' is the close status to send"""
+
+    def __init__(self, message, code=1002):
+        ValueError.__init__(self, message)
+        self.code = code
+
+def accept_key(key):
+    """Return the Sec-WebSocket-Accept value for a Sec-WebSocket-Key"""
+    return b64encode(sha1(key + GUID).digest())
+
+if hasattr(int, 'from_bytes'):
+    def mask(data, key):
+        """XOR 'data' with the repeated 4-byte 'key', returning bytes"""
+        length = len(data)
+        if not length:
+            return b''
+        key = key * (length // 4) + key[:length % 4]
+        return (int.from_bytes(data, 'little') ^
+                int.from_bytes(key, 'little')).to_bytes(length, 'little')
+else:
+    def mask(data, key):        # Python 2
+        """XOR 'data' with the repeated 4-byte 'key', returning bytes"""
+        length = len(data)
+        if not length:
+            return b''
+        key = key * (length // 4) + key[:length % 4]
+        value = int(hexlify(data), 16) ^ int(hexlify(key), 16)
+        return unhexlify('%0*x' % (length * 2, value))
+
+def encode_frame(opcode, payload, fin=True, mask_key=None):
+    """Return a frame carrying 'payload'; clients must give a 'mask_key'"""
+    first = fin and 0x80 | opcode or opcode
+    masked = mask_key is not None and 0x80 or 0
+    length = len(payload)
+    if length < 126:
+        header = _short.pack(first, masked | length)
+    elif length < 65536:
+        header = _medium.pack(first, masked | 126, length)
+    else:
+        header = _long.pack(first, masked | 127, length)
+    if mask_key is not None:
+        return header + mask_key + mask(payload, mask_key)
+    return header + bytes(payload)
+
+class FrameParser:
+    """Incremental frame decoder
+
+    'feed()' it data as it arrives, then take the complete frames from
+    'frames()', as '(fin, opcode, payload)' tuples.  Frames from clients
+    must be masked; pass 'masked=False' to parse frames from a server.
+    """
+
+    def __init__(self, max_size=16*1024*1024, masked=True):
+        self.max_size = max_size
+        self.masked = masked
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+
+    def frames(self):
+        """Return the list of complete frames received so far"""
+        buf = self.buffer
+        available = len(buf)
+        frames = []
+        pos = 0
+        view = memoryview(buf)
+        try:
+            while available - pos >= 2:
+                first, second = _short.unpack_from(buf, pos)
+                if first & 0x70:
+                    raise ProtocolError('reserved bits set')
+                fin = bool(first & 0x80)
+                opcode = first & 0x0F
+                length = second & 0x7F
+                start = pos + 2
+                if length == 126:
+                    if available - start < 2:
+                        break
+                    length = struct.unpack_from('!H', buf, start)[0]
+                    start += 2
+                elif length == 127:
+                    if available - start < 8:
+                        break
+                    length = struct.unpack_from('!Q', buf, start)[0]
+                    start += 8
+                if opcode & 0x8 and (length > 125 or not fin):
+                    raise ProtocolError('invalid control frame')
+                if length > self.max_size:
+                    raise ProtocolError('frame too large', 1009)
+                if bool(second & 0x80) != self.masked:
+                    raise ProtocolError('frame masking is wrong')
+                if second & 0x80:
+                    if available - start < 4:
+                        break
+                    key = bytes(buf[start:start + 4])
+                    start += 4
+                else:
+                    key = None
+                end = start + length
+                if end > available:
+                    break
+                if key is None:
+                    payload = bytes(buf[start:end])
+                else:
+                    payload = mask(view[start:end], key)
+                frames.append((fin, opcode, payload))
+                pos = end
+        finally:
+            del view            # the buffer can't be resized while viewed
+        if pos:
+            del buf[:pos]
+        return frames
+
+class WebSocket:
+    """A WebSocket connection, used from the application's thread
+
+    Iterating yields '(opcode, message)' for each complete text or binary
+    message ('message' is bytes; text is UTF-8) until the connection is
+    closed.  Pings are answered automatically.  'send()' may be called
+    from any thread.
+    """
+
+    blksize = 65536
+
+    def __init__(self, sock, connection=None, max_size=16*1024*1024):
+        self.socket = sock
+        self.connection = connection
+        self.max_size = max_size
+        self.parser = FrameParser(max_size)
+        self.frames = []
+        self.send_lock = threading.Lock()
+        self.close_sent = False
+        self.closed = False
+        self.close_code = None
+
+    def __iter__(self):
+        while 1:
+            message = self.receive()
+            if message is None:
+                return
+            yield message
+
+    def next_frame(self):
+        while not self.frames:
+            data = self.socket.recv(self.blksize)
+            if not data:
+                return None
+            self.parser.feed(data)
+            self.frames = self.parser.frames()
+        return self.frames.pop(0)
+
+    def receive(self):
+        """Return the next '(opcode, message)', or None once closed"""
+        fragments = []
+        message_opcode = None
+        size = 0
+        while not self.closed:
+            try:
+                frame = self.next_frame()
+            except ProtocolError as e:
+                self.close(e.code)
+                self.closed = True
+                return None
+            if frame is None:
+                self.closed = True
+                return None
+            fin, opcode, payload = frame
+            if opcode == OP_PING:
+                self.send(payload, OP_PONG)
+                continue
+            if opcode == OP_PONG:
+                continue
+            if opcode == OP_CLOSE:
+                if len(payload) >= 2:
+                    self.close_code = struct.unpack('!H', payload[:2])[0]
+                self.close(self.close_code or 1000)
+                self.closed = True
+                return None
+            if (opcode == OP_CONTINUATION) != (message_opcode is not None):
+                self.close(1002)
+                self.closed = True
+                return None
+            if message_opcode is None:
+                message_opcode = opcode
+            size += len(payload)
+            if size > self.max_size:
+                self.close(1009)
+                self.closed = True
+                return None
+            fragments.append(payload)
+            if fin:
+                return message_opcode, b''.join(fragments)
+        return None
+
+    def send(self, data, opcode=OP_BINARY):
+        """Send a message; text must be encoded to UTF-8 and sent as OP_TEXT"""
+        frame = encode_frame(opcode, data)
+        with self.send_lock:
+            if self.close_sent:
+                raise ProtocolError('connection is closing')
+            if opcode == OP_CLOSE:
+                self.close_sent = True
+            self.socket.sendall(frame)
+
+    def ping(self, data=b''):
+        self.send(data, OP_PING)
+
+    def close(self, code=1000, reason=b''):
+        """Start (or complete) the closing handshake"""
+        if self.close_sent:
+            return
+        try:
+            self.send(struct.pack('!H', code) + reason, OP_CLOSE)
+        except (ProtocolError, IOError, OSError):
+            pass
+
+    def detach(self):
+        """Keep the socket open after the application returns"""
+        self.connection.detach()
+        return self.socket
+
+def accept(environ, protocol=None, max_size=16*1024*1024):
+    """Accept a WebSocket opening handshake, returning a WebSocket
+
+    Returns None if the request isn't a valid WebSocket handshake, or the
+    server doesn't offer 'web3ref.upgrade'; the application should then
+    answer with an error.  'protocol' is the subprotocol to announce.
+    """
+    upgrade = environ.get('web3ref.upgrade')
+    key = environ.get('HTTP_SEC_WEBSOCKET_KEY', b'').strip()
+    if (upgrade is None or not key or
+        environ.get('REQUEST_METHOD') != b'GET' or
+        environ.get('HTTP_UPGRADE', b'').lower() != b'websocket' or
+        environ.get('HTTP_SEC_WEBSOCKET_VERSION', b'').strip() != b'13'):
+        return None
+    headers = [
+        (b'Upgrade', b'websocket'),
+        (b'Connection', b'Upgrade'),
+        (b'Sec-WebSocket-Accept', accept_key(key)),
+    ]
+    if protocol is not None:
+        headers.append((b'Sec-WebSocket-Protocol', protocol))
+    connection = upgrade(headers)
+    return WebSocket(connection.socket, connection, max_size)
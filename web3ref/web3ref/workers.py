@@ -0,0 +1,480 @@
+"""Thread-pool and pre-fork concurrency for the web3ref servers
+
+'WorkerMixIn' is mixed into a SocketServer server class, before the server
+class itself::
+
+    class Server(WorkerMixIn, TCPServer):
+        pass
+
+    server = Server(address, RequestHandler)
+    server.set_workers(threads=8, processes=4)
+    server.serve_forever()
+
+With 'threads', accepted connections are queued to a fixed pool of worker
+threads (the accept loop blocks once 'queue_size' connections are waiting,
+leaving further clients in the kernel's listen backlog).  If 'max_pending'
+is set instead, connections beyond 'threads' running plus 'max_pending'
+waiting are turned away at once with 'reject_request()'.  With more than
+one process, the server forks that many workers after binding, each of
+which accepts from the shared listening socket; the original process only
+supervises them and replaces any that die.
+
+The 'multithread' and 'multiprocess' attributes reflect the configuration,
+for handlers to pass on as 'web3.multithread' and 'web3.multiprocess'.
+
+If the server's 'reuse_port' attribute is true, each worker process binds
+a listening socket of its own with SO_REUSEPORT instead of sharing the one
+it inherited, so that the kernel balances new connections between them.
+
+Workers stop gracefully: on SIGTERM a worker stops accepting, finishes the
+requests it has in hand and exits.  The supervising process reacts to
+
+    SIGHUP      start a fresh set of workers, then retire the old ones
+    SIGUSR2     re-execute the program (see 'reexec()'); shut down once
+                the new program has started its workers and sends SIGTERM
+    SIGTERM     shut down gracefully (SIGINT does the same)
+
+and 'max_requests' and 'max_rss' make workers retire themselves after
+serving that many requests or once their resident memory grows past that
+many bytes, so that a leaking application stays bounded.  A retiring
+worker is replaced as soon as it exits, and as the listening socket stays
+open in the supervisor and the other workers, no connection is refused
+meanwhile.
+
+Also contains helpers for listening sockets: 'listen_fds()' for sockets
+inherited from the parent process (systemd socket activation style),
+'socket_from_fd()' and 'enable_reuse_port()'.
+"""
+
+import errno
+import os
+import random
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+from traceback import format_exc
+try:
+    from queue import Queue
+    from socketserver import TCPServer
+except ImportError:     # Python 2
+    from Queue import Queue
+    from SocketServer import TCPServer
+
+__all__ = [
+    'WorkerMixIn', 'listen_fds', 'socket_from_fd', 'enable_reuse_port',
+    'memory_usage',
+]
+
+SD_LISTEN_FDS_START = 3
+
+# Python 2 lacks the constant, though Linux has the option since 3.9
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT',
+                       sys.platform.startswith('linux') and 15 or None)
+
+def listen_fds(unset_environment=True):
+    """Return the listening socket descriptors passed by a supervisor
+
+    This follows the systemd socket activation protocol: descriptors 3 and
+    up, counted by $LISTEN_FDS, if $LISTEN_PID is our process id.  Unless
+    'unset_environment' is false, the variables are removed so that child
+    processes don't mistake them for their own.
+    """
+    if os.environ.get('LISTEN_PID') != str(os.getpid()):
+        return []
+    count = int(os.environ.get('LISTEN_FDS') or 0)
+    if unset_environment:
+        for name in 'LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES':
+            os.environ.pop(name, None)
+    return list(range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + count))
+
+def socket_from_fd(fd):
+    """Return a socket object for the stream socket descriptor 'fd'"""
+    try:
+        # Python 3.7+ detects the family itself and adopts the descriptor
+        return socket.socket(fileno=fd)
+    except TypeError:
+        pass
+    sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+    name = sock.getsockname()
+    if isinstance(name, tuple) and len(name) == 2:
+        return sock
+    family = isinstance(name, tuple) and socket.AF_INET6 or socket.AF_UNIX
+    sock.close()
+    return socket.fromfd(fd, family, socket.SOCK_STREAM)
+
+def enable_reuse_port(sock):
+    """Set SO_REUSEPORT on 'sock'; call before binding it"""
+    if SO_REUSEPORT is None:
+        raise socket.error('SO_REUSEPORT is not supported on this platform')
+    sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+
+def memory_usage():
+    """Return the resident set size of this process in bytes, or None"""
+    try:
+        f = open('/proc/self/statm', 'rb')
+    except IOError:
+        pass
+    else:
+        try:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGESIZE')
+        finally:
+            f.close()
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Only the peak is available here; in kilobytes, except on Mac OS X
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss
+    return rss * 1024
+
+def exit_status(status):
+    """Return a wait() status as an exit status, or minus the signal"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+class WorkerMixIn:
+    """Mix-in class adding a thread pool and pre-forked worker processes"""
+
+    threads = 0         # size of the thread pool; 0 to serve inline
+    processes = 1       # number of processes to pre-fork; 1 for no forking
+    queue_size = 0      # connections waiting for a thread; 0: 4 * threads
+    max_pending = None  # if set, shed connections beyond this many waiting
+
+    multithread = False
+    multiprocess = False
+
+    reuse_port = False  # give each worker process its own socket
+
+    max_requests = 0    # requests a worker serves before retiring; 0: no limit
+    max_requests_jitter = 0     # random extra, so workers don't retire at once
+    max_rss = 0         # resident bytes at which a worker retires; 0: no limit
+    graceful_timeout = 30   # seconds a retiring worker has before SIGKILL
+
+    pool = None
+    children = None     # pid -> worker number, in the supervising process
+    reexec_pid = None   # the program started by 'reexec()', while it starts
+    retiring = None     # pid -> deadline, for workers told to finish up
+    supervising = False
+    pending_signals = ()
+
+    requests_served = 0
+    in_flight = 0       # connections queued or being served by the pool
+    accepting = False   # in a worker, cleared to make it finish and exit
+
+    def set_workers(self, threads=0, processes=1, max_requests=0, max_rss=0):
+        """Configure concurrency; call before 'serve_forever()'"""
+        self.threads = threads
+        self.processes = processes
+        self.max_requests = max_requests
+        self.max_rss = max_rss
+        self.multithread = threads > 0
+        self.multiprocess = processes > 1
+
+    # Thread pool
+
+    def process_request(self, request, client_address):
+        """Hand the connection to a pool thread, or serve it right here"""
+        if not self.threads:
+            self.finish_request(request, client_address)
+            self.shutdown_request(request)
+            return
+        if self.pool is None:
+            self.start_pool()
+        if self.max_pending is not None:
+            with self.in_flight_lock:
+                shed = self.in_flight >= self.threads + self.max_pending
+                if not shed:
+                    self.in_flight += 1
+            if shed:
+                self.reject_request(request, client_address)
+                return
+        self.queue.put((request, client_address))
+
+    def reject_request(self, request, client_address):
+        """Turn away a connection the pool has no room for
+
+        By default the connection is simply closed; protocol servers can
+        send an error response first.
+        """
+        self.shutdown_request(request)
+
+    def start_pool(self):
+        # Started lazily, so that each forked worker gets its own threads
+        if self.max_pending is None:
+            self.queue = Queue(self.queue_size or 4 * self.threads)
+        else:
+            self.queue = Queue()        # bounded by 'in_flight' instead
+        self.in_flight_lock = threading.Lock()
+        self.pool = []
+        for i in range(self.threads):
+            thread = threading.Thread(target=self.process_requests)
+            thread.daemon = True
+            thread.start()
+            self.pool.append(thread)
+
+    def process_requests(self):
+        """Main loop of a pool thread"""
+        while 1:
+            item = self.queue.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            if self.max_pending is not None:
+                with self.in_flight_lock:
+                    self.in_flight -= 1
+
+    def stop_pool(self):
+        if self.pool is not None:
+            for thread in self.pool:
+                self.queue.put(None)
+            for thread in self.pool:
+                thread.join()
+            self.pool = None
+
+    def server_close(self):
+        self.stop_pool()
+        TCPServer.server_close(self)
+
+    def finish_request(self, request, client_address):
+        TCPServer.finish_request(self, request, client_address)
+        self.requests_served += 1
+
+    # Pre-forked processes
+
+    def serve_forever(self, poll_interval=0.5):
+        if self.processes > 1 and self.children is None:
+            self.supervise(poll_interval)
+        else:
+            TCPServer.serve_forever(self, poll_interval)
+
+    def supervise(self, poll_interval):
+        """Fork the worker processes and keep them running until shutdown"""
+        self.children = {}
+        self.retiring = {}
+        self.pending_signals = []
+        self.supervising = True
+        handlers = self.install_signals(
+            (signal.SIGHUP, signal.SIGUSR2, signal.SIGTERM, signal.SIGINT))
+        for number in range(self.processes):
+            self.spawn_worker(number)
+        if self.reuse_port:
+            # Workers listen on their own sockets; ours would only collect
+            # connections that nobody accepts.
+            self.socket.close()
+        old_master = os.environ.pop('WEB3REF_OLD_MASTER', None)
+        if old_master:
+            # We were started by 'reexec()'; now that our workers are up,
+            # the previous generation can go.
+            try:
+                os.kill(int(old_master), signal.SIGTERM)
+            except (OSError, ValueError):
+                pass
+        try:
+            while self.supervising:
+                while self.pending_signals:
+                    self.handle_signal(self.pending_signals.pop(0))
+                self.reap_workers()
+                time.sleep(poll_interval)
+        finally:
+            for signum, handler in handlers:
+                signal.signal(signum, handler)
+            self.stop_workers()
+
+    def install_signals(self, signums):
+        """Queue 'signums' for the supervisor loop; return the old handlers
+
+        Signal handlers can only be set in the main thread; elsewhere (as
+        in tests) the supervisor runs without them.
+        """
+        handlers = []
+        for signum in signums:
+            try:
+                old = signal.signal(signum, self.queue_signal)
+            except ValueError:
+                break
+            handlers.append((signum, old))
+        return handlers
+
+    def queue_signal(self, signum, frame):
+        self.pending_signals.append(signum)
+
+    def handle_signal(self, signum):
+        if signum == signal.SIGHUP:
+            self.restart_workers()
+        elif signum == signal.SIGUSR2:
+            # Keep serving until the new program is ready and sends SIGTERM
+            self.reexec_pid = self.reexec()
+        else:
+            self.supervising = False
+
+    def restart_workers(self):
+        """Replace every worker with a fresh one, letting the old finish"""
+        old = self.children
+        self.children = {}
+        for number in sorted(old.values()):
+            self.spawn_worker(number)
+        for pid in old:
+            self.retire_worker(pid)
+
+    def retire_worker(self, pid):
+        self.retiring[pid] = time.time() + self.graceful_timeout
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def reexec(self):
+        """Start a new copy of the program to take over from this one
+
+        The new process inherits the listening socket as descriptor 3, as
+        announced by $LISTEN_FDS (unless 'reuse_port' is set, in which case
+        it binds its own), so the program must create its server from
+        'listen_fds()' when there are any.  Once it has started its workers
+        it sends this process SIGTERM.
+        """
+        pid = os.fork()
+        if pid:
+            return pid
+        try:
+            env = dict(os.environ)
+            env['WEB3REF_OLD_MASTER'] = str(os.getppid())
+            if not self.reuse_port:
+                fd = self.socket.fileno()
+                if fd != SD_LISTEN_FDS_START:
+                    os.dup2(fd, SD_LISTEN_FDS_START)
+                if hasattr(os, 'set_inheritable'):
+                    os.set_inheritable(SD_LISTEN_FDS_START, True)
+                env['LISTEN_FDS'] = '1'
+                env['LISTEN_PID'] = str(os.getpid())
+            os.execve(sys.executable, [sys.executable] + sys.argv, env)
+        finally:
+            os._exit(127)
+
+    def spawn_worker(self, number):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = number
+            return pid
+        # In the worker: serve until told to stop, and never return
+        status = 0
+        try:
+            try:
+                self.children = self.retiring = None
+                self.supervising = False
+                signal.signal(signal.SIGTERM, self.stop_accepting)
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGHUP, signal.SIG_DFL)
+                signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+                self.worker_started(number)
+                self.serve_worker()
+            except BaseException:
+                status = 1
+                self.log_event('worker %d failed:\n%s'
+                               % (number, format_exc().rstrip()))
+        finally:
+            os._exit(status)
+
+    def worker_started(self, number):
+        """Hook called in each worker process before it starts serving
+
+        By default, this replaces the inherited listening socket with a
+        fresh one when 'reuse_port' is set; the server's 'server_bind()'
+        must enable SO_REUSEPORT in that case.
+        """
+        if self.reuse_port:
+            self.socket.close()
+            self.socket = socket.socket(self.address_family, self.socket_type)
+            self.server_bind()
+            self.server_activate()
+
+    def serve_worker(self, poll_interval=0.5):
+        """Main loop of a worker process: accept until retiring"""
+        limit = self.max_requests
+        if limit and self.max_requests_jitter:
+            limit += random.randint(0, self.max_requests_jitter)
+        self.requests_served = 0
+        self.accepting = True
+        while self.accepting:
+            try:
+                ready = select.select([self], [], [], poll_interval)[0]
+            except (OSError, select.error) as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+            if ready:
+                self._handle_request_noblock()
+            if limit and self.requests_served >= limit:
+                break
+            if self.max_rss and (memory_usage() or 0) > self.max_rss:
+                break
+        # Finish what the pool threads have in hand
+        self.stop_pool()
+
+    def stop_accepting(self, signum=None, frame=None):
+        self.accepting = False
+
+    def reap_workers(self):
+        """Collect exited workers and start replacements"""
+        while self.children or self.retiring:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    self.retiring.clear()
+                break
+            if not pid:
+                break
+            if pid == self.reexec_pid:
+                self.reexec_pid = None
+                if self.supervising:
+                    self.log_event('re-executed program exited with status '
+                                   '%d (127: exec failed); still serving'
+                                   % exit_status(status))
+                continue
+            number = self.children.pop(pid, None)
+            self.retiring.pop(pid, None)
+            if status:
+                self.log_event('worker %s (pid %d) exited with status %d'
+                               % (number, pid, exit_status(status)))
+            if number is not None and self.supervising:
+                self.spawn_worker(number)
+        now = time.time()
+        for pid, deadline in list(self.retiring.items()):
+            if deadline <= now:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+
+    def log_event(self, message):
+        """Report a supervisor or worker event, by default to stderr"""
+        sys.stderr.write('[%d] %s\n' % (os.getpid(), message))
+        sys.stderr.flush()
+
+    def stop_workers(self):
+        for pid in list(self.children):
+            self.retire_worker(pid)
+        self.children.clear()
+        while self.retiring:
+            self.reap_workers()
+            if self.retiring:
+                time.sleep(0.05)
+
+    def shutdown(self):
+        if self.supervising:
+            self.supervising = False
+        elif self.accepting:
+            self.stop_accepting()
+        else:
+            TCPServer.shutdown(self)